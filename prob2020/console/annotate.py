@@ -9,6 +9,9 @@ sys.path.append(os.path.join(file_dir, '../../'))
 # package import
 import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
+import prob2020.python.reference as reference
+import prob2020.python.parallel as parallel
+from prob2020.python.mutation_store import MutationStore
 import prob2020.cython.cutils as cutils
 import prob2020.python.mutation_context as mc
 import prob2020.python.permutation as pm
@@ -19,9 +22,7 @@ import prob2020.python.mymath as math
 # external imports
 import numpy as np
 import pandas as pd
-import pysam
 import csv
-from multiprocessing import Pool
 import argparse
 import logging
 import copy
@@ -31,14 +32,14 @@ logger = logging.getLogger(__name__)  # module logger
 
 def multiprocess_permutation(bed_dict, mut_df, opts, indel_df=None):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into batches of genes.
     """
     chroms = sorted(bed_dict.keys(), key=lambda x: len(bed_dict[x]), reverse=True)
+    mut_store = MutationStore(mut_df)
     multiprocess_flag = opts['processes']>0
     if multiprocess_flag:
-        num_processes = opts['processes']
-    else:
-        num_processes = 1
+        # the output file handle stays in the main process
+        worker_opts = {k: v for k, v in opts.items() if k != 'handle'}
     #file_handle = open(opts['output'], 'w')
     file_handle = opts['handle']
     mywriter = csv.writer(file_handle, delimiter='\t', lineterminator='\n')
@@ -92,84 +93,56 @@ def multiprocess_permutation(bed_dict, mut_df, opts, indel_df=None):
                 fs_cts[0, ix] = 0 if mygene not in fs_cts_dict else fs_cts_dict[mygene]
                 inframe_cts[0, ix] = indel_cts_dict[mygene] - fs_cts[0, ix]
 
+    def add_indel_columns(gene_results):
+        """Adds the indel columns to the summary of each gene."""
+        tmp_result = []
+        for gname, grp in it.groupby(gene_results, lambda x: x[0]):
+            for l, row in enumerate(grp):
+                gene_ix = name2ix[gname]
+                fs_count = fs_cts[l, gene_ix]
+                inframe_count = inframe_cts[l, gene_ix]
+                missense_pos_ct = list(row.pop(-1).values())  # missense codon counts
+                silent_pos_ct = [1 for l in range(row[4])]
+                inactivating_ct = sum(row[5:9]) + fs_count
+                tmp_count_list = missense_pos_ct + silent_pos_ct + [inactivating_ct, inframe_count]
+                norm_ent = math.normalized_mutation_entropy(tmp_count_list)
+                tmp_result.append(row+[fs_count, inframe_count, norm_ent])
+        return tmp_result
+
     # simulate snvs
-    obs_result = []
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                # iterate through each chromosome result
-                for chrom_result in process_results:
-                    # add columns for indels
-                    if opts['summary']:
-                        tmp_chrom_result = []
-                        for gname, grp in it.groupby(chrom_result, lambda x: x[0]):
-                            for l, row in enumerate(grp):
-                                gene_ix = name2ix[gname]
-                                fs_count = fs_cts[l, gene_ix]
-                                inframe_count = inframe_cts[l, gene_ix]
-                                missense_pos_ct = list(row.pop(-1).values())  # missense codon counts
-                                silent_pos_ct = [1 for l in range(row[4])]
-                                inactivating_ct = sum(row[5:9]) + fs_count
-                                tmp_count_list = missense_pos_ct + silent_pos_ct + [inactivating_ct, inframe_count]
-                                norm_ent = math.normalized_mutation_entropy(tmp_count_list)
-                                tmp_chrom_result.append(row+[fs_count, inframe_count, norm_ent])
-                        chrom_result = tmp_chrom_result
-
-                    # write output to file
-                    mywriter.writerows(chrom_result)
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
-        else:
-            # perform simulation
-            info = (bed_dict[chroms[i]], mut_df, opts)
-            chrom_results = singleprocess_permutation(info)
-
-            # add indel columns
-            if opts['summary']:
-                tmp_chrom_result = []
-                for gname, grp in it.groupby(chrom_results, lambda x: x[0]):
-                    for l, row in enumerate(grp):
-                        gene_ix = name2ix[gname]
-                        fs_count = fs_cts[l, gene_ix]
-                        inframe_count = inframe_cts[l, gene_ix]
-                        missense_pos_ct = list(row.pop(-1).values())  # missense codon counts
-                        silent_pos_ct = [1 for l in range(row[4])]
-                        inactivating_ct = sum(row[5:9]) + fs_count
-                        tmp_count_list = missense_pos_ct + silent_pos_ct + [inactivating_ct, inframe_count]
-                        norm_ent = math.normalized_mutation_entropy(tmp_count_list)
-                        tmp_chrom_result.append(row+[fs_count, inframe_count, norm_ent])
-                chrom_results = tmp_chrom_result
-
-            # write to file
-            mywriter.writerows(chrom_results)
+    if multiprocess_flag:
+        # genes are processed in batches by a persistent pool of workers
+        bed_list = [b for chrom in chroms for b in bed_dict[chrom]]
+        results = parallel.imap_genes(singleprocess_permutation, bed_list,
+                                      mut_store, (worker_opts,), opts)
+    else:
+        results = (singleprocess_permutation((bed_dict[chrom], mut_store, opts))
+                   for chrom in chroms)
+    for gene_results in results:
+        # add indel columns
+        if opts['summary']:
+            gene_results = add_indel_columns(gene_results)
+
+        # write to file
+        mywriter.writerows(gene_results)
     #file_handle.close()
 
 
 @utils.log_error_decorator
 def singleprocess_permutation(info):
-    bed_list, mut_df, opts = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
+    bed_list, mut_store, opts = info
+    logger.info('Working on {0} genes starting with {1} ({2}) . . .'.format(
+        len(bed_list), bed_list[0].gene_name, bed_list[0].chrom))
     num_iterations = opts['num_iterations']
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = parallel.open_gene_fasta(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    max_memory = parallel.memory_per_process(opts)
 
     # go through each gene to perform simulation
     result = []
     for bed in bed_list:
         # compute context counts and somatic bases for each context
-        gene_tuple = mc.compute_mutation_context(bed, gs, mut_df, opts)
+        gene_tuple = mc.compute_mutation_context(bed, gs, mut_store, opts)
         context_cts, context_to_mutations, mutations_df, gs, sc = gene_tuple
 
         if context_to_mutations:
@@ -206,7 +179,8 @@ def singleprocess_permutation(info):
                                                 sc,
                                                 gs,
                                                 num_iterations,
-                                                drop_silent=opts['drop_silent'])
+                                                drop_silent=opts['drop_silent'],
+                                                max_memory=max_memory)
             else:
                 # Summarized results for feature for each simulation for each
                 # gene
@@ -218,11 +192,11 @@ def singleprocess_permutation(info):
                                                     num_iterations,
                                                     min_frac=opts['fraction'],
                                                     min_recur=opts['recurrent'],
-                                                    drop_silent=opts['drop_silent'])
+                                                    drop_silent=opts['drop_silent'],
+                                                    max_memory=max_memory)
             result += tmp_result
 
-    gene_fa.close()
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
+    logger.info('Finished working on {0} genes.'.format(len(bed_list)))
     return result
 
 
@@ -249,7 +223,8 @@ def parse_arguments():
                         help='Flag for more verbose log output')
 
     # program arguments
-    help_str = 'gene FASTA file from extract_gene_seq script'
+    help_str = ('gene FASTA file from extract_gene_seq script, or a '
+                'compiled reference from compile_reference')
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
@@ -257,9 +232,10 @@ def parse_arguments():
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'BED file annotation of genes'
+    help_str = ('BED file annotation of genes (not needed if the input '
+                'is a compiled reference)')
     parser.add_argument('-b', '--bed',
-                        type=str, required=True,
+                        type=str, default=None,
                         help=help_str)
     help_str = ('Directory containing pre-compute score information in '
                 'for VEST and evolutionary conservation in pickle format (Default: None).')
@@ -272,6 +248,13 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Total memory in MB available for simulations, shared evenly '
+                'by the processes. The number of simulations held in memory '
+                'at once is limited for each gene based on its number of '
+                'mutations (Default: None, up to 25,000 simulations at once).')
+    parser.add_argument('--max-memory',
+                        type=float, default=None,
+                        help=help_str)
     help_str = ('Number of iterations for null model simulations. If zero is '
                 'specified then output represents a result from actually observed mutations (provided by -m parameter), '
                 'otherwise results will be from simulated mutations. (Default: 0).')
@@ -377,9 +360,12 @@ def parse_arguments():
 
 def main(opts):
     # hack to index the FASTA file
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = reference.open_gene_fasta(opts['input'])
     gene_fa.close()
 
+    # compiled references also contain the BED file
+    opts['bed'] = reference.bed_path(opts['input'], opts['bed'])
+
     # Get Mutations
     mut_df = pd.read_csv(opts['mutations'], sep='\t')
     orig_num_mut = len(mut_df)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+""" This script compiles a BED file and the gene FASTA from extract_gene_seq
+into a single memory mappable reference file. The compiled reference can be
+used in place of the gene FASTA (-i option) and BED file in other scripts.
+"""
+# fix problems with pythons terrible import system
+import sys
+import os
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+sys.path.append(os.path.join(file_dir, '../../'))
+
+import prob2020.python.utils as utils
+import prob2020.python.reference as reference
+
+# actually important imports
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)  # module logger
+
+
+def parse_arguments():
+    info = 'Compiles a BED file and gene FASTA into a single reference file'
+    parser = argparse.ArgumentParser(description=info)
+
+    # logging arguments
+    parser.add_argument('-ll', '--log-level',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Write a log file (--log-level=DEBUG for debug mode, '
+                        '--log-level=INFO for info mode)')
+    parser.add_argument('-l', '--log',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Path to log file. (accepts stdout)')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Flag for more verbose log output')
+
+    # program arguments
+    help_str = 'gene FASTA file from extract_gene_seq.py script'
+    parser.add_argument('-i', '--input',
+                        type=str, required=True,
+                        help=help_str)
+    help_str = 'BED file annotation of genes'
+    parser.add_argument('-b', '--bed',
+                        type=str, required=True,
+                        help=help_str)
+    help_str = ('Levels of sequence context to pre-compute, e.g. "-c 1.5 3". '
+                'Other levels are computed when used (Default: None).')
+    parser.add_argument('-c', '--context',
+                        type=float, nargs='*', default=[],
+                        help=help_str)
+    help_str = 'Output compiled reference file'
+    parser.add_argument('-o', '--output',
+                        type=str, required=True,
+                        help=help_str)
+    args = parser.parse_args()
+
+    # handle logging
+    if args.log_level or args.log:
+        if args.log:
+            log_file = args.log
+        else:
+            log_file = ''  # auto-name the log file
+    else:
+        log_file = os.devnull
+    log_level = args.log_level
+    utils.start_logging(log_file=log_file,
+                        log_level=log_level,
+                        verbose=args.verbose)  # start logging
+
+    # log user entered command
+    logger.info('Command: {0}'.format(' '.join(sys.argv)))
+
+    return vars(args)
+
+
+def main(opts):
+    reference.compile_reference(opts['bed'], opts['input'],
+                                opts['output'], opts['context'])
+
+
+def cli_main():
+    opts = parse_arguments()
+    main(opts)
+
+if __name__ == "__main__":
+    cli_main()
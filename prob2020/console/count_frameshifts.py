@@ -7,6 +7,7 @@ sys.path.append(os.path.join(file_dir, '../'))
 
 import prob2020.python.utils as utils
 import prob2020.python.indel as indel
+from prob2020.python.mutation_store import MutationStore
 import pandas as pd
 import argparse
 
@@ -18,20 +19,14 @@ def count_frameshifts(mut_df,
                       use_unmapped=False):
     fs_cts = {}  # frameshift count information for each gene
     fs_df = indel.keep_frameshifts(mut_df)
+    fs_store = MutationStore(fs_df)
     fs_lens = indel.get_frameshift_lengths(num_bins)
 
     for bed in utils.bed_generator(bed_path):
-        gene_df = fs_df[fs_df['Gene']==bed.gene_name]
-
-        # find it frameshift actually is on gene annotation
-        fs_pos = []
-        for ix, row in gene_df.iterrows():
-            indel_pos = [row['Start_Position'], row['End_Position']]
-            coding_pos = bed.query_position(bed.strand, row['Chromosome'], indel_pos)
-            fs_pos.append(coding_pos)
+        gene_df = fs_store.gene_mutations(bed.gene_name).copy()
 
         # mark frameshifts that could not be mapped to reference tx
-        gene_df['unmapped'] = [(1 if x is None else 0) for x in fs_pos]
+        gene_df['unmapped'] = indel.unmapped_indels(gene_df, bed)
         total_fs = len(gene_df)
         unmapped_fs = len(gene_df[gene_df['unmapped']==1])
 
@@ -69,7 +69,8 @@ def parse_arguments():
         advance_parser = parser.add_argument_group(title='Advanced options')
 
         # set the CLI params
-        help_str = 'gene FASTA file from extract_gene_seq.py script'
+        help_str = ('gene FASTA file from extract_gene_seq.py script, or a '
+                    'compiled reference from compile_reference')
         major_parser.add_argument('-i', '--input',
                                   type=str, required=True,
                                   help=help_str)
@@ -78,9 +79,10 @@ def parse_arguments():
         major_parser.add_argument('-m', '--mutations',
                                   type=str, required=True,
                                   help=help_str)
-        help_str = 'BED file annotation of genes'
+        help_str = ('BED file annotation of genes (not needed if the input '
+                    'is a compiled reference)')
         major_parser.add_argument('-b', '--bed',
-                                  type=str, required=True,
+                                  type=str, default=None,
                                   help=help_str)
         help_str = ('Number of processes to use for parallelization. 0 indicates using a single '
                     'process without using a multiprocessing pool '
@@ -88,6 +90,13 @@ def parse_arguments():
         major_parser.add_argument('-p', '--processes',
                                   type=int, default=0,
                                   help=help_str)
+        help_str = ('Total memory in MB available for simulations, shared evenly '
+                    'by the processes. The number of simulations held in memory '
+                    'at once is limited for each gene based on its number of '
+                    'mutations (Default: None, up to 25,000 simulations at once).')
+        advance_parser.add_argument('--max-memory',
+                                    type=float, default=None,
+                                    help=help_str)
         help_str = ('Number of iterations for null model. p-value precision '
                     'increases with more iterations, however this will also '
                     'increase the run time (Default: 100,000).')
@@ -100,6 +109,38 @@ def parse_arguments():
         advance_parser.add_argument('-sc', '--stop-criteria',
                                     type=int, default=1000,
                                     help=help_str)
+        help_str = ('Significance level for stopping simulations early once a gene\'s '
+                    'p-value is confidently above it (sequential probability ratio '
+                    'test), in addition to --stop-criteria. Applies to the oncogene, '
+                    'tsg, hotmaps1d and effect tests (Default: None).')
+        advance_parser.add_argument('--stop-alpha',
+                                    type=float, default=None,
+                                    help=help_str)
+        help_str = ('Extrapolate p-values smaller than 1/--num-iterations by fitting '
+                    'a generalized Pareto distribution to the tail of the simulated '
+                    'null distribution, and report 95%% confidence intervals of the '
+                    'p-values in additional "CI low" and "CI high" columns. Applies '
+                    'to the oncogene, tsg and hotmaps1d tests (Default: False).')
+        advance_parser.add_argument('--tail-fit',
+                                    action='store_true', default=False,
+                                    help=help_str)
+        help_str = ('Screen genes with --screen-iterations iterations first, then '
+                    'rerun with --num-iterations only the genes whose q-value could '
+                    'still be below --screen-fdr given the 95%% confidence interval of '
+                    'the screening p-values, which are reported in additional "CI low" '
+                    'and "CI high" columns (Default: False).')
+        advance_parser.add_argument('--screen',
+                                    action='store_true', default=False,
+                                    help=help_str)
+        help_str = 'Number of iterations for the screening pass (Default: 1,000).'
+        advance_parser.add_argument('--screen-iterations',
+                                    type=int, default=1000,
+                                    help=help_str)
+        help_str = ('False discovery rate threshold used to select genes for the '
+                    'second pass of screening (Default: 0.1).')
+        advance_parser.add_argument('--screen-fdr',
+                                    type=float, default=.1,
+                                    help=help_str)
         help_str = ('Number of DNA bases to use as context. 0 indicates no context. '
                     '1 indicates only use the mutated base.  1.5 indicates using '
                     'the base context used in CHASM '
@@ -132,6 +173,13 @@ def parse_arguments():
             advance_parser.add_argument('-d', '--deleterious',
                                         type=int, default=1,
                                         help=help_str)
+            help_str = ('Compute p-values exactly from the null distribution of '
+                        'deleterious mutation counts instead of by simulations. '
+                        '--num-iterations and --stop-criteria are ignored when '
+                        'set (Default: False).')
+            advance_parser.add_argument('--exact',
+                                        action='store_true', default=False,
+                                        help=help_str)
         elif i == 2:
             help_str = ('Sequence window size for HotMAPS 1D algorithm '
                         'by number of codons (Default: 3)')
@@ -169,6 +217,11 @@ def parse_arguments():
                                     action='store_true',
                                     default=False,
                                     help=help_str)
+        help_str = ('Directory to cache the sequence context of each gene, so '
+                    'contexts for a gene FASTA are only computed once (Default: None).')
+        advance_parser.add_argument('--context-index',
+                                    type=str, default=None,
+                                    help=help_str)
         help_str = ('Use mutations that are not mapped to the the single reference '
                     'transcript for a gene specified in the bed file indicated by '
                     'the -b option.')
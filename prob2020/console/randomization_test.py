@@ -10,6 +10,9 @@ sys.path.append(os.path.join(file_dir, '../../'))
 import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
 from prob2020.python.sequence_context import SequenceContext
+import prob2020.python.reference as reference
+import prob2020.python.parallel as parallel
+from prob2020.python.mutation_store import MutationStore
 import prob2020.python.mutation_context as mc
 import prob2020.python.count_frameshifts as cf
 import prob2020.python.process_result as pr
@@ -17,61 +20,78 @@ import prob2020.python.p_value as mypval
 
 # external imports
 import argparse
-import pysam
 import pandas as pd
-import numpy as np
-from multiprocessing import Pool
 import logging
 
 logger = logging.getLogger(__name__)  # module logger
 
+# p-value columns of each kind of test used to select genes for the second
+# pass of screening
+SCREEN_P_VALUES = {
+    'oncogene': ['entropy p-value', 'vest p-value'],
+    'tsg': ['inactivating p-value'],
+    'hotmaps1d': ['p-value'],
+    'effect': ['entropy-on-effect p-value'],
+}
+
 
 @utils.log_error_decorator
 def singleprocess_permutation(info):
     # initialize input
-    bed_list, mut_df, opts, fs_cts_df, p_inactivating = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
-    gene_fa = pysam.Fastafile(opts['input'])
+    bed_list, mut_store, opts, fs_cts_df, p_inactivating = info
+    logger.info('Working on {0} genes starting with {1} ({2}) . . .'.format(
+        len(bed_list), bed_list[0].gene_name, bed_list[0].chrom))
+    gene_fa = parallel.open_gene_fasta(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    context_index = reference.get_context_index(gene_fa, opts['context'],
+                                                opts.get('context_index'))
+    max_memory = parallel.memory_per_process(opts)
+    stop_alpha = opts.get('stop_alpha')
+    tail_fit = opts.get('tail_fit', False)
+    p_value_ci = report_p_value_ci(opts)
 
     # list of columns that are needed
     cols = ['Chromosome', 'Start_Position', 'Reference_Allele',
             'Tumor_Allele', 'Variant_Classification',]
     # conditionally add protein_change column if exists
-    if 'Protein_Change' in mut_df.columns:
+    if 'Protein_Change' in mut_store.columns:
         cols += ['Protein_Change']
 
-    # figure out which genes actually have a mutation
-    genes_with_mut = set(mut_df['Gene'].unique())
-
     # iterate through each gene
     result = []
     for bed in bed_list:
-        if bed.gene_name not in genes_with_mut:
+        # a chunk of the iterations of a large gene returns its null
+        # distribution tallies for merging
+        chunk = bed if isinstance(bed, parallel.GeneChunk) else None
+        if chunk is not None:
+            bed = chunk.bed
+            num_iterations = chunk.num_iterations
+        else:
+            num_iterations = opts['num_iterations']
+        is_chunk = chunk is not None
+        prev_null_counts = chunk.null_counts if is_chunk else None
+
+        # each gene (and chunk) has its own random number stream, so results
+        # do not depend on the order or process genes are run in
+        seed = utils.seed_sequence(opts['seed'], bed.gene_name, opts['kind'],
+                                   chunk.index if is_chunk else 0)
+        null_counts = None
+
+        if bed.gene_name not in mut_store:
             # skip genes with no mutations
             continue
 
         # prepare info for running permutation test
-        mut_info = mut_df.loc[mut_df['Gene']==bed.gene_name, cols]
+        mut_info = mut_store.gene_mutations(bed.gene_name, cols)
         gs.set_gene(bed)
-        sc = SequenceContext(gs, seed=opts['seed'])
+        sc = SequenceContext(gs, seed=seed, context_index=context_index)
 
         # count total mutations in gene
         total_mut = len(mut_info)
 
-        # fix nucleotide letter if gene is on - strand
-        if bed.strand == '-':
-            rc = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
-            mut_info.loc[:, 'Tumor_Allele'] = rc
-
         # get coding positions, mutations unmapped to the reference tx will have
         # NA for a coding position
-        pos_list = []
-        for ix, row in mut_info.iterrows():
-            coding_pos = bed.query_position(bed.strand, row['Chromosome'], row['Start_Position'])
-            pos_list.append(coding_pos)
-        mut_info.loc[:, 'Coding Position'] = pos_list
+        mut_info = mc.map_mutations(mut_info, bed)
 
         # recover mutations that could not be mapped to the reference transcript
         # for a gene before being dropped (next step)
@@ -92,12 +112,20 @@ def singleprocess_permutation(info):
             # calculate position based permutation results
             tmp_result = mypval.calc_position_p_value(mut_info, unmapped_mut_info, sc,
                                                       gs, bed, opts['score_dir'],
-                                                      opts['num_iterations'],
+                                                      num_iterations,
                                                       opts['stop_criteria'],
                                                       0,  # no recurrent mutation pseudo count
                                                       opts['recurrent'],
-                                                      opts['fraction'])
-            result.append(tmp_result + [total_mut, unmapped_muts])
+                                                      opts['fraction'],
+                                                      return_null_counts=is_chunk,
+                                                      max_memory=max_memory,
+                                                      stop_alpha=stop_alpha,
+                                                      tail_fit=tail_fit,
+                                                      p_value_ci=p_value_ci,
+                                                      prev_null_counts=prev_null_counts)
+            if is_chunk:
+                tmp_result, null_counts = tmp_result
+            gene_result = tmp_result + [total_mut, unmapped_muts]
         elif opts['kind'] == 'tsg':
             # calculate results for deleterious mutation permutation test
             #fs_ct = fs_cts_df['total'][bed.gene_name]
@@ -106,91 +134,228 @@ def singleprocess_permutation(info):
             # simulation
             tmp_result = mypval.calc_deleterious_p_value(mut_info, unmapped_mut_info,
                                                          sc, gs, bed,
-                                                         opts['num_iterations'],
+                                                         num_iterations,
                                                          opts['stop_criteria'],
                                                          opts['deleterious'],
                                                          0,  # no deleterious mutation pseudo count
-                                                         opts['seed'])
-            result.append(tmp_result + [num_mapped_muts, unmapped_muts])
+                                                         seed,
+                                                         opts.get('exact', False),
+                                                         return_null_counts=is_chunk,
+                                                         max_memory=max_memory,
+                                                         stop_alpha=stop_alpha,
+                                                         tail_fit=tail_fit,
+                                                         p_value_ci=p_value_ci,
+                                                         prev_null_counts=prev_null_counts)
+            if is_chunk:
+                tmp_result, null_counts = tmp_result
+            gene_result = tmp_result + [num_mapped_muts, unmapped_muts]
                                         #fs_ct, fs_unmapped])
         elif opts['kind'] == 'hotmaps1d':
-            # save null distribution if user option specified
-            if opts['null_distr_dir']:
-                if not os.path.exists(opts['null_distr_dir']): os.mkdir(opts['null_distr_dir'])
-                save_path = os.path.join(opts['null_distr_dir'], bed.gene_name + '.{0}.txt')
-            else:
-                save_path = None
+            # save null distribution if user option specified, chunks save
+            # the null distribution once the last chunk finished
+            save_path = null_save_path(opts, bed.gene_name) if not is_chunk else None
             # calculate position based permutation results
             mywindow = list(map(int, opts['window'].split(',')))
-            tmp_result = mypval.calc_hotmaps_p_value(mut_info, unmapped_mut_info, sc,
-                                                     gs, bed,
-                                                     mywindow,
-                                                     opts['num_iterations'],
-                                                     opts['stop_criteria'],
-                                                     opts['report_index'],
-                                                     null_save_path=save_path)
-            result.extend(tmp_result)
+            gene_result = mypval.calc_hotmaps_p_value(mut_info, unmapped_mut_info, sc,
+                                                      gs, bed,
+                                                      mywindow,
+                                                      num_iterations,
+                                                      opts['stop_criteria'],
+                                                      opts['report_index'],
+                                                      null_save_path=save_path,
+                                                      return_null_counts=is_chunk,
+                                                      max_memory=max_memory,
+                                                      stop_alpha=stop_alpha,
+                                                      tail_fit=tail_fit,
+                                                      p_value_ci=p_value_ci,
+                                                      prev_null_counts=prev_null_counts)
+            if is_chunk:
+                gene_result, null_counts = gene_result
         elif opts['kind'] == 'protein':
             tmp_result = mypval.calc_protein_p_value(mut_info, unmapped_mut_info,
                                                      sc, gs, bed,
                                                      opts['neighbor_graph_dir'],
-                                                     opts['num_iterations'],
+                                                     num_iterations,
                                                      opts['stop_criteria'],
                                                      opts['recurrent'],
-                                                     opts['fraction'])
-            result.append(tmp_result + [total_mut, unmapped_muts])
+                                                     opts['fraction'],
+                                                     max_memory=max_memory)
+            gene_result = tmp_result + [total_mut, unmapped_muts]
         else:
             # calc results for entropy-on-effect permutation test
             tmp_result = mypval.calc_effect_p_value(mut_info, unmapped_mut_info,
                                                     sc, gs, bed,
-                                                    opts['num_iterations'],
+                                                    num_iterations,
                                                     0, #  no recurrent mutation pseudo count
                                                     opts['recurrent'],
-                                                    opts['fraction'])
-            result.append(tmp_result + [total_mut, unmapped_muts])
+                                                    opts['fraction'],
+                                                    max_memory=max_memory,
+                                                    stop_thresh=opts['stop_criteria'],
+                                                    stop_alpha=stop_alpha,
+                                                    p_value_ci=p_value_ci)
+            gene_result = tmp_result + [total_mut, unmapped_muts]
+
+        # hotmaps reports a row for each mutated codon
+        if is_chunk:
+            result.append(parallel.ChunkResult(chunk, gene_result, null_counts))
+        elif opts['kind'] == 'hotmaps1d':
+            result.extend(gene_result)
+        else:
+            result.append(gene_result)
 
-    gene_fa.close()
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
+    logger.info('Finished working on {0} genes.'.format(len(bed_list)))
     return result
 
 
+def report_p_value_ci(opts):
+    """Whether results contain the confidence intervals of p-values, which
+    tail fits report and screening needs to select candidate genes."""
+    return opts.get('tail_fit', False) or opts.get('p_value_ci', False)
+
+
+def null_save_path(opts, gene_name):
+    """Path to save the hotmaps null distribution of a gene, if requested."""
+    if not opts['null_distr_dir']:
+        return None
+    if not os.path.exists(opts['null_distr_dir']): os.mkdir(opts['null_distr_dir'])
+    return os.path.join(opts['null_distr_dir'], gene_name + '.{0}.txt')
+
+
 def multiprocess_permutation(bed_dict, mut_df, opts,
                              fs_cts_df=None, p_inactivating=None):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into batches of genes.
+
+    The iterations of genes with many mutations are split into chunks (for
+    the oncogene, tsg and hotmaps1d tests), which run one after another and
+    may run on different processes. Each chunk continues from the null
+    distribution of the previous chunks, so simulations stop at the same
+    point as in a single chunk. Genes are split the same way regardless of
+    the number of processes, so seeded results do not change with
+    --processes.
     """
     chroms = sorted(bed_dict.keys(), key=lambda x: len(bed_dict[x]), reverse=True)
-    multiprocess_flag = opts['processes']>0
-    if multiprocess_flag:
-        num_processes = opts['processes']
+    mut_store = MutationStore(mut_df)
+    split_iterations = (opts['kind'] in ['oncogene', 'hotmaps1d'] or
+                        (opts['kind'] == 'tsg' and not opts.get('exact', False)))
+    if opts['processes'] > 0:
+        # genes are processed in batches by a persistent pool of workers
+        bed_list = [b for chrom in chroms for b in bed_dict[chrom]]
+        batch_results = parallel.imap_genes(singleprocess_permutation,
+                                            bed_list, mut_store,
+                                            (opts, fs_cts_df, p_inactivating),
+                                            opts, split_iterations)
     else:
-        num_processes = 1
+        # genes are split into the same chunks as with a pool, the next
+        # chunks of a gene run in this process after its list of genes
+        bed_lists = [bed_dict[chrom] for chrom in chroms]
+        if split_iterations:
+            bed_lists = [parallel.split_genes(b, mut_store, opts['num_iterations'])
+                         for b in bed_lists]
+        batch_results = parallel.map_genes(singleprocess_permutation, bed_lists,
+                                           mut_store, (opts, fs_cts_df, p_inactivating))
+
     result_list = []
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts, fs_cts_df, p_inactivating)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                for chrom_result in process_results:
-                    result_list += chrom_result
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
-        else:
-            info = (bed_dict[chroms[i]], mut_df, opts, fs_cts_df, p_inactivating)
-            result_list += singleprocess_permutation(info)
+    for batch_result in batch_results:
+        gene_results, complete = parallel.collect_chunks(batch_result)
+        result_list += gene_results
+
+        # p-values of genes split into chunks from the tallies of the last chunk
+        for chunk_result in complete:
+            save_path = (null_save_path(opts, chunk_result.gene_name)
+                         if opts['kind'] == 'hotmaps1d' else None)
+            gene_result = mypval.chunk_p_values(opts['kind'],
+                                                chunk_result.result,
+                                                chunk_result.null_counts,
+                                                null_save_path=save_path,
+                                                tail_fit=opts.get('tail_fit', False),
+                                                p_value_ci=report_p_value_ci(opts))
+            if opts['kind'] == 'hotmaps1d':
+                result_list += gene_result
+            else:
+                result_list.append(gene_result)
 
+    # results finish in a different order depending on the processes, so
+    # they are put in BED order (a stable sort keeps each gene's rows)
+    gene_order = {b.gene_name: i
+                  for i, b in enumerate(b for chrom in chroms for b in bed_dict[chrom])}
+    result_list.sort(key=lambda x: gene_order[x[0]])
+    return result_list
+
+
+def screen_permutation(bed_dict, mut_df, opts,
+                       fs_cts_df=None, p_inactivating=None):
+    """Runs the permutation test in two passes to save simulations on genes
+    which are clearly not significant.
+
+    All genes are first run with opts['screen_iterations'] iterations. Genes
+    whose q-value could still be below opts['screen_fdr'] given the lower
+    confidence bound of their p-values (see mypval.screen_candidates) are
+    then rerun with opts['num_iterations'] iterations. The results need to
+    contain the p-value confidence intervals (opts['p_value_ci']).
+
+    Returns
+    -------
+    result_list : list
+        results of multiprocess_permutation, using the second pass for
+        the candidate genes
+    """
+    screen_opts = dict(opts, num_iterations=opts['screen_iterations'])
+    screen_result = multiprocess_permutation(bed_dict, mut_df, screen_opts,
+                                             fs_cts_df, p_inactivating)
+    if not screen_result:
+        return screen_result
+
+    # find genes which could be significant, hotmaps q-values are
+    # computed separately for each window
+    screen_df = handle_results(screen_result, screen_opts)
+    if opts['kind'] == 'hotmaps1d':
+        groups = [grp for w, grp in screen_df.groupby('window length')]
+    else:
+        groups = [screen_df]
+    candidates = set()
+    for grp in groups:
+        for p_col in SCREEN_P_VALUES[opts['kind']]:
+            # p-values without an interval are not simulated
+            pval_lower = grp[p_col + ' CI low'].astype(float).fillna(grp[p_col])
+            is_candidate = mypval.screen_candidates(pval_lower, opts['screen_fdr'])
+            candidates.update(grp.loc[is_candidate, 'gene'])
+    logger.info('Screening found {0} candidate genes out of {1} genes.'.format(
+        len(candidates), screen_df['gene'].nunique()))
+
+    # rerun the candidate genes with the full number of iterations
+    cand_bed_dict = {chrom: [b for b in bed_dict[chrom] if b.gene_name in candidates]
+                     for chrom in bed_dict}
+    cand_bed_dict = {chrom: beds for chrom, beds in cand_bed_dict.items() if beds}
+    cand_mut_df = mut_df[mut_df['Gene'].isin(candidates)]
+    result_list = [r for r in screen_result if r[0] not in candidates]
+    if cand_bed_dict:
+        result_list += multiprocess_permutation(cand_bed_dict, cand_mut_df, opts,
+                                                fs_cts_df, p_inactivating)
     return result_list
 
 
+def handle_results(permutation_result, opts):
+    """Formats the results of multiprocess_permutation as a data frame
+    with BH q-values."""
+    if opts['kind'] == 'oncogene':
+        return pr.handle_oncogene_results(permutation_result,
+                                          opts['num_iterations'],
+                                          p_value_ci=report_p_value_ci(opts))
+    elif opts['kind'] == 'tsg':
+        return pr.handle_tsg_results(permutation_result,
+                                     p_value_ci=report_p_value_ci(opts))
+    elif opts['kind'] == 'hotmaps1d':
+        return pr.handle_hotmaps_results(permutation_result,
+                                         report_index=opts['report_index'],
+                                         p_value_ci=report_p_value_ci(opts))
+    elif opts['kind'] == 'protein':
+        return pr.handle_protein_results(permutation_result)
+    elif opts['kind'] == 'effect':
+        return pr.handle_effect_results(permutation_result,
+                                        p_value_ci=report_p_value_ci(opts))
+
+
 def parse_arguments():
     # make a parser
     info = 'Performs a randomization-based test on the oncogene and TSG score'
@@ -214,7 +379,8 @@ def parse_arguments():
                         help='Flag for more verbose log output')
 
     # program arguments
-    help_str = 'gene FASTA file from extract_gene_seq.py script'
+    help_str = ('gene FASTA file from extract_gene_seq.py script, or a '
+                'compiled reference from compile_reference')
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
@@ -222,9 +388,10 @@ def parse_arguments():
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'BED file annotation of genes'
+    help_str = ('BED file annotation of genes (not needed if the input '
+                'is a compiled reference)')
     parser.add_argument('-b', '--bed',
-                        type=str, required=True,
+                        type=str, default=None,
                         help=help_str)
     help_str = 'Directory containing score information in pickle files (Default: None).'
     parser.add_argument('-s', '--score-dir',
@@ -240,6 +407,13 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Total memory in MB available for simulations, shared evenly '
+                'by the processes. The number of simulations held in memory '
+                'at once is limited for each gene based on its number of '
+                'mutations (Default: None, up to 25,000 simulations at once).')
+    parser.add_argument('--max-memory',
+                        type=float, default=None,
+                        help=help_str)
     help_str = ('Number of iterations for null model. p-value precision '
                 'increases with more iterations, however this will also '
                 'increase the run time (Default: 10000).')
@@ -252,6 +426,21 @@ def parse_arguments():
     parser.add_argument('-sc', '--stop-criteria',
                         type=int, default=1000,
                         help=help_str)
+    help_str = ('Significance level for stopping simulations early once a gene\'s '
+                'p-value is confidently above it (sequential probability ratio '
+                'test), in addition to --stop-criteria. Applies to the oncogene, '
+                'tsg, hotmaps1d and effect tests (Default: None).')
+    parser.add_argument('--stop-alpha',
+                        type=float, default=None,
+                        help=help_str)
+    help_str = ('Extrapolate p-values smaller than 1/--num-iterations by fitting '
+                'a generalized Pareto distribution to the tail of the simulated '
+                'null distribution, and report 95%% confidence intervals of the '
+                'p-values in additional "CI low" and "CI high" columns. Applies '
+                'to the oncogene, tsg and hotmaps1d tests (Default: False).')
+    parser.add_argument('--tail-fit',
+                        action='store_true', default=False,
+                        help=help_str)
     help_str = ('Kind of permutation test to perform ("oncogene" or "tsg"). "position-based" permutation '
                 'test is intended to find oncogenes using position based statistics. '
                 'The "deleterious" permutation test is intended to find tumor '
@@ -269,6 +458,11 @@ def parse_arguments():
     parser.add_argument('-c', '--context',
                         type=float, default=1.5,
                         help=help_str)
+    help_str = ('Directory to cache the sequence context of each gene, so '
+                'contexts for a gene FASTA are only computed once (Default: None).')
+    parser.add_argument('--context-index',
+                        type=str, default=None,
+                        help=help_str)
     help_str = ('Use mutations that are not mapped to the the single reference '
                 'transcript for a gene specified in the bed file indicated by '
                 'the -b option.')
@@ -304,6 +498,14 @@ def parse_arguments():
     parser.add_argument('-d', '--deleterious',
                         type=int, default=1,
                         help=help_str)
+    help_str = ('Compute the tsg p-value exactly from the null distribution '
+                'of deleterious mutation counts instead of by simulations. '
+                '--num-iterations and --stop-criteria are ignored for the '
+                'tsg test when set (Default: False).')
+    parser.add_argument('--exact',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
     help_str = ('Maximum TSG score to allow gene to be tested for oncogene '
                 'permutation test. Values greater than one indicate all '
                 'genes will be tested (Default: 1.01).')
@@ -358,9 +560,12 @@ def parse_arguments():
 
 def main(opts, mut_df=None, frameshift_df=None):
     # hack to index the FASTA file
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = reference.open_gene_fasta(opts['input'])
     gene_fa.close()
 
+    # compiled references also contain the BED file
+    opts['bed'] = reference.bed_path(opts['input'], opts.get('bed'))
+
     # Get Mutations
     if mut_df is None:
         mut_df = pd.read_csv(opts['mutations'], sep='\t')
@@ -381,6 +586,7 @@ def main(opts, mut_df=None, frameshift_df=None):
                 'information (Droped: {1})'.format(len(mut_df), orig_num_mut - len(mut_df)))
 
     # count frameshifts
+    p_inactivating = None
     if opts['kind'] == 'tsg':
         if frameshift_df is None:
             # read in mutations
@@ -409,25 +615,21 @@ def main(opts, mut_df=None, frameshift_df=None):
     # read BED file
     bed_dict = utils.read_bed(opts['bed'])
 
+    # screening needs simulated p-values
+    is_screen = (opts.get('screen') and opts['kind'] in SCREEN_P_VALUES and
+                 not (opts['kind'] == 'tsg' and opts.get('exact', False)) and
+                 opts['screen_iterations'] < opts['num_iterations'])
+
     # Perform BH p-value adjustment and tidy up data for output
-    if opts['kind'] == 'oncogene':
-        permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
-        permutation_df = pr.handle_oncogene_results(permutation_result,
-                                                    opts['num_iterations'])
-    elif opts['kind'] == 'tsg':
+    if is_screen:
+        # candidates are selected by the confidence intervals of p-values
+        opts = dict(opts, p_value_ci=True)
+        permutation_result = screen_permutation(bed_dict, mut_df, opts,
+                                                frameshift_df, p_inactivating)
+    else:
         permutation_result = multiprocess_permutation(bed_dict, mut_df, opts,
                                                       frameshift_df, p_inactivating)
-        permutation_df = pr.handle_tsg_results(permutation_result)
-    elif opts['kind'] == 'hotmaps1d':
-        permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
-                                                      #frameshift_df, p_inactivating)
-        permutation_df = pr.handle_hotmaps_results(permutation_result)
-    elif opts['kind'] == 'protein':
-        permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
-        permutation_df = pr.handle_protein_results(permutation_result)
-    elif opts['kind'] == 'effect':
-        permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
-        permutation_df = pr.handle_effect_results(permutation_result)
+    permutation_df = handle_results(permutation_result, opts)
 
     # save output
     if opts['output']:
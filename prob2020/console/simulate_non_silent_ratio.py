@@ -10,14 +10,15 @@ sys.path.append(os.path.join(file_dir, '../../'))
 import prob2020.python.permutation as pm
 import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
+import prob2020.python.reference as reference
+import prob2020.python.parallel as parallel
+from prob2020.python.mutation_store import MutationStore
 import prob2020.cython.cutils as cutils
 import prob2020.python.mutation_context as mc
 
 # external imports
 import numpy as np
 import pandas as pd
-import pysam
-from multiprocessing import Pool
 import argparse
 import logging
 import copy
@@ -31,14 +32,11 @@ cols = ['non-silent count', 'silent count', 'nonsense count',
 
 def multiprocess_permutation(bed_dict, mut_df, opts):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into batches of genes.
     """
     chroms = sorted(bed_dict.keys())
+    mut_store = MutationStore(mut_df)
     multiprocess_flag = opts['processes']>0
-    if multiprocess_flag:
-        num_processes = opts['processes']
-    else:
-        num_processes = 1
     num_permutations = opts['num_permutations']
     if not opts['by_sample']:
         obs_result = []
@@ -53,70 +51,43 @@ def multiprocess_permutation(bed_dict, mut_df, opts):
     else:
         result_list = [[0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
 
-    # iterate over each chromosome
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                for chrom_result, obs_mutations in process_results:
-                    for j in range(num_permutations):
-                        result_list[j][0] += chrom_result[j][0]
-                        result_list[j][1] += chrom_result[j][1]
-                        result_list[j][2] += chrom_result[j][2]
-                        result_list[j][3] += chrom_result[j][3]
-                        result_list[j][4] += chrom_result[j][4]
-                        result_list[j][5] += chrom_result[j][5]
-                        result_list[j][6] += chrom_result[j][6]
-                        if opts['score_dir']:
-                            result_list[j][7] += chrom_result[j][7]
-                            result_list[j][8] += chrom_result[j][8]
-
-                    if not opts['by_sample']:
-                        obs_result.append(obs_mutations)
-                    else:
-                        obs_result = obs_result + obs_mutations
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
+    if multiprocess_flag:
+        # genes are processed in batches by a persistent pool of workers
+        bed_list = [b for chrom in chroms for b in bed_dict[chrom]]
+        results = parallel.imap_genes(singleprocess_permutation, bed_list,
+                                      mut_store, (opts,), opts)
+    else:
+        results = (singleprocess_permutation((bed_dict[chrom], mut_store, opts))
+                   for chrom in chroms)
+    for chrom_result, obs_mutations in results:
+        for j in range(num_permutations):
+            result_list[j][0] += chrom_result[j][0]
+            result_list[j][1] += chrom_result[j][1]
+            result_list[j][2] += chrom_result[j][2]
+            result_list[j][3] += chrom_result[j][3]
+            result_list[j][4] += chrom_result[j][4]
+            result_list[j][5] += chrom_result[j][5]
+            result_list[j][6] += chrom_result[j][6]
+            if opts['score_dir']:
+                result_list[j][7] += chrom_result[j][7]
+                result_list[j][8] += chrom_result[j][8]
+        if not opts['by_sample']:
+            obs_result.append(obs_mutations)
         else:
-            info = (bed_dict[chroms[i]], mut_df, opts)
-            chrom_result, obs_mutations = singleprocess_permutation(info)
-            for j in range(num_permutations):
-                result_list[j][0] += chrom_result[j][0]
-                result_list[j][1] += chrom_result[j][1]
-                result_list[j][2] += chrom_result[j][2]
-                result_list[j][3] += chrom_result[j][3]
-                result_list[j][4] += chrom_result[j][4]
-                result_list[j][5] += chrom_result[j][5]
-                result_list[j][6] += chrom_result[j][6]
-                if opts['score_dir']:
-                    result_list[j][7] += chrom_result[j][7]
-                    result_list[j][8] += chrom_result[j][8]
-            if not opts['by_sample']:
-                obs_result.append(obs_mutations)
-            else:
-                obs_result = obs_result + obs_mutations
+            obs_result = obs_result + obs_mutations.reindex(obs_result.index, fill_value=0)
 
     return result_list, obs_result
 
 
 @utils.log_error_decorator
 def singleprocess_permutation(info):
-    bed_list, mut_df, opts = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
+    bed_list, mut_store, opts = info
+    logger.info('Working on {0} genes starting with {1} ({2}) . . .'.format(
+        len(bed_list), bed_list[0].gene_name, bed_list[0].chrom))
     num_permutations = opts['num_permutations']
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = parallel.open_gene_fasta(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    max_memory = parallel.memory_per_process(opts)
 
     # variables for recording the actual observed number of non-silent
     # vs. silent mutations
@@ -131,7 +102,7 @@ def singleprocess_permutation(info):
         obs_vest = 0
         obs_mga_entropy = 0
     else:
-        uniq_samp = mut_df['Tumor_Sample'].unique()
+        uniq_samp = mut_store.column('Tumor_Sample').unique()
         obs_df = pd.DataFrame(np.zeros((len(uniq_samp), len(cols))),
                               index=uniq_samp, columns=cols)
 
@@ -142,7 +113,7 @@ def singleprocess_permutation(info):
         result = [[0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
     for bed in bed_list:
         # compute context counts and somatic bases for each context
-        gene_tuple = mc.compute_mutation_context(bed, gs, mut_df, opts)
+        gene_tuple = mc.compute_mutation_context(bed, gs, mut_store, opts)
         context_cts, context_to_mutations, mutations_df, gs, sc = gene_tuple
 
         if context_to_mutations:
@@ -204,39 +175,36 @@ def singleprocess_permutation(info):
                     obs_df.loc[tsamp,:] = obs_df.loc[tsamp,:] + np.array(tmp_result)
 
             ## Do permutations
-            # calculate non silent count
-            #tmp_result = pm.non_silent_ratio_permutation(context_cts,
-                                                         #context_to_mutations,
-                                                         #sc,  # sequence context obj
-                                                         #gs,  # gene sequence obj
-                                                         #num_permutations)
-            tmp_result = pm.summary_permutation(context_cts,
-                                                context_to_mutations,
-                                                sc,  # sequence context obj
-                                                gs,  # gene sequence obj
-                                                opts['score_dir'],
-                                                num_permutations)
+            if opts['score_dir']:
+                # scores need the position of every simulated mutation
+                tmp_result = pm.summary_permutation(context_cts,
+                                                    context_to_mutations,
+                                                    sc,  # sequence context obj
+                                                    gs,  # gene sequence obj
+                                                    opts['score_dir'],
+                                                    num_permutations,
+                                                    max_memory=max_memory)
+                # keep mutation type counts and scores
+                tmp_result = [row[3:10] + row[12:14] for row in tmp_result]
+            else:
+                # only simulate the count of each mutation type
+                tmp_result = pm.non_silent_ratio_permutation(context_cts,
+                                                             context_to_mutations,
+                                                             sc,  # sequence context obj
+                                                             gs,  # gene sequence obj
+                                                             num_permutations,
+                                                             max_memory=max_memory)
         else:
             if opts['score_dir']:
-                tmp_result = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
+                tmp_result = [[0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
             else:
-                tmp_result = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
+                tmp_result = [[0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
 
         # increment the non-silent/silent counts for each permutation
-        offset = 3
         for j in range(num_permutations):
-            result[j][0] += tmp_result[j][0+offset]
-            result[j][1] += tmp_result[j][1+offset]
-            result[j][2] += tmp_result[j][2+offset]
-            result[j][3] += tmp_result[j][3+offset]
-            result[j][4] += tmp_result[j][4+offset]
-            result[j][5] += tmp_result[j][5+offset]
-            result[j][6] += tmp_result[j][6+offset]
-            if opts['score_dir']:
-                result[j][7] += tmp_result[j][9+offset]
-                result[j][8] += tmp_result[j][10+offset]
+            for k in range(len(result[j])):
+                result[j][k] += tmp_result[j][k]
 
-    gene_fa.close()
     if not opts['by_sample']:
         obs_result = [obs_non_silent, obs_silent, obs_nonsense,
                       obs_loststop, obs_splice_site, obs_loststart, obs_missense]
@@ -244,7 +212,7 @@ def singleprocess_permutation(info):
             obs_result.extend([obs_mga_entropy, obs_vest])
     else:
         obs_result = obs_df
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
+    logger.info('Finished working on {0} genes.'.format(len(bed_list)))
     return result, obs_result
 
 
@@ -267,7 +235,8 @@ def parse_arguments():
                         help='Path to log file. (accepts "stdout")')
 
     # program arguments
-    help_str = 'gene FASTA file from extract_gene_seq.py script'
+    help_str = ('gene FASTA file from extract_gene_seq.py script, or a '
+                'compiled reference from compile_reference')
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
@@ -275,9 +244,10 @@ def parse_arguments():
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'BED file annotation of genes'
+    help_str = ('BED file annotation of genes (not needed if the input '
+                'is a compiled reference)')
     parser.add_argument('-b', '--bed',
-                        type=str, required=True,
+                        type=str, default=None,
                         help=help_str)
     help_str = ('Number of processes to use. 0 indicates using a single '
                 'process without using a multiprocessing pool '
@@ -285,6 +255,13 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Total memory in MB available for simulations, shared evenly '
+                'by the processes. The number of simulations held in memory '
+                'at once is limited for each gene based on its number of '
+                'mutations (Default: None, up to 25,000 simulations at once).')
+    parser.add_argument('--max-memory',
+                        type=float, default=None,
+                        help=help_str)
     help_str = ('Number of permutations for null model. p-value precision '
                 'increases with more permutations (Default: 10000).')
     parser.add_argument('-n', '--num-permutations',
@@ -359,9 +336,12 @@ def main(opts):
         cols.extend(['Total MGAEntropy', 'Total Missense VEST'])
 
     # hack to index the FASTA file
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = reference.open_gene_fasta(opts['input'])
     gene_fa.close()
 
+    # compiled references also contain the BED file
+    opts['bed'] = reference.bed_path(opts['input'], opts['bed'])
+
     # Get Mutations
     mut_df = pd.read_csv(opts['mutations'], sep='\t')
     orig_num_mut = len(mut_df)
@@ -1,15 +1,18 @@
 #include <map>
 #include <cmath>
 #include <string>
+#include <vector>
+#include <algorithm>
 
 #define M_LOG2E 1.44269504088896340736L //log2(e)
 
 /* Log base 2 */
-inline long double log2(const long double x){
+inline long double log2_ld(const long double x){
     return  log(x) * M_LOG2E;
 }
 
-/* Calculates all position-based statistics in one function.
+/* Calculates all position-based statistics from the number of
+ * mutations at each mutated position.
  * Specifically it calculates:
  * 1. number of recurrent missense mutations
  * 2. fraction of uniform missense entropy
@@ -17,30 +20,26 @@ inline long double log2(const long double x){
  *
  * Parameters
  * ----------
- * pos_ctr : map<int, int>
- *      maps positions to number of mutations
- *
- * Returns
- * -------
- * out : map<string, double>
- *      STL map contianer containing position statistics
+ * counts : vector<int>
+ *      number of mutations for each mutated position, ordered by position
+ * out : double*
+ *      array of length three to store the recurrent count, entropy
+ *      fraction and delta entropy
  */
-std::map<std::string, double> calc_position_statistics(std::map<int, int> pos_ctr,
-                                                       float min_frac=0.02,
-                                                       int min_recurrent=2,
-                                                       int is_observed=1){
+inline void position_statistics(const std::vector<int> &counts,
+                                float min_frac,
+                                int min_recurrent,
+                                int is_observed,
+                                double *out){
     int recurrent_sum = 0, val = 0, min_frac_thresh = 0;
-    // int min_recurrent = 2;  // by default need two recurrent mutations
     long double myent_2 = 0.0L, myent_e = 0.0L, mysum = 0.0L, p = 0.0L;
     long double frac_of_uniform_ent = 1.0L, num_pos = 0.0L;
     long double delta_ent = 0.0L;
-    std::map<std::string, double> out;
-    typedef std::map<int, int>::iterator it_type;
+    std::size_t k;
 
     // count total mutations
-    for(it_type iterator = pos_ctr.begin(); iterator != pos_ctr.end(); iterator++) {
-        val = iterator->second;
-        mysum += val;
+    for(k = 0; k < counts.size(); k++) {
+        mysum += counts[k];
     }
 
     // set definition of recurrent count number based either on the minimum or 
@@ -49,12 +48,11 @@ std::map<std::string, double> calc_position_statistics(std::map<int, int> pos_ct
     min_recurrent = ((min_recurrent>min_frac_thresh) ?  min_recurrent:min_frac_thresh);
 
     // calculate entropy 
-    for(it_type iterator = pos_ctr.begin(); iterator != pos_ctr.end(); iterator++) {
+    for(k = 0; k < counts.size(); k++) {
         // get number of mutations per position
-        val = iterator->second;
+        val = counts[k];
 
         // add to recurrent count if defined as recurrently mutated position
-        //if (val>=min_recurrent+is_observed){
         if (val>=min_recurrent && is_observed==1){
             recurrent_sum += val;
         } else if(val>=2 && is_observed==0){
@@ -62,17 +60,16 @@ std::map<std::string, double> calc_position_statistics(std::map<int, int> pos_ct
         }
 
         // update entropy metrics
-        //if (val<min_recurrent+is_observed){
         if (val<min_recurrent && is_observed==1){
             p = 1 / mysum;
             for (int i=0; i<val; i++){
-                myent_2 -= p * log2(p);
+                myent_2 -= p * log2_ld(p);
                 myent_e -= p * log(p);
                 num_pos += 1;
             }
         } else {
             p = val / mysum;
-            myent_2 -= p * log2(p);
+            myent_2 -= p * log2_ld(p);
             myent_e -= p * log(p);
             num_pos += 1;
         }
@@ -83,17 +80,116 @@ std::map<std::string, double> calc_position_statistics(std::map<int, int> pos_ct
         delta_ent = log(num_pos) - myent_e;
     }
     if (mysum > 1) {
-        frac_of_uniform_ent = myent_2 / log2(mysum);
+        frac_of_uniform_ent = myent_2 / log2_ld(mysum);
     }
 
+    out[0] = recurrent_sum;
+    out[1] = frac_of_uniform_ent;
+    out[2] = delta_ent;
+}
+
+
+/* Calculates all position-based statistics in one function.
+ *
+ * Parameters
+ * ----------
+ * pos_ctr : map<int, int>
+ *      maps positions to number of mutations
+ *
+ * Returns
+ * -------
+ * out : map<string, double>
+ *      STL map contianer containing position statistics
+ */
+std::map<std::string, double> calc_position_statistics(std::map<int, int> pos_ctr,
+                                                       float min_frac=0.02,
+                                                       int min_recurrent=2,
+                                                       int is_observed=1){
+    double stats[3];
+    std::vector<int> counts;
+    std::map<std::string, double> out;
+    typedef std::map<int, int>::iterator it_type;
+
+    for(it_type iterator = pos_ctr.begin(); iterator != pos_ctr.end(); iterator++) {
+        counts.push_back(iterator->second);
+    }
+    position_statistics(counts, min_frac, min_recurrent, is_observed, stats);
+
     // put output in a map container
-    out["recurrent"] = recurrent_sum;
-    out["entropy_fraction"] = frac_of_uniform_ent;
-    out["delta_entropy"] = delta_ent;
+    out["recurrent"] = stats[0];
+    out["entropy_fraction"] = stats[1];
+    out["delta_entropy"] = stats[2];
     return(out);
 }
 
 
+/* Calculates the position-based statistics for a batch of simulations.
+ *
+ * Each row of the codon position matrix is a single simulation. Only
+ * mutations flagged in the missense mask are counted. Positions are
+ * sorted within a row so the statistics are accumulated in the same
+ * order as calc_position_statistics. No python objects are touched,
+ * so this may be called without holding the GIL.
+ *
+ * Parameters
+ * ----------
+ * codon_pos : int*
+ *      row-major num_rows X num_cols matrix of codon positions
+ * is_missense : unsigned char*
+ *      row-major num_rows X num_cols matrix, non-zero if missense
+ * pseudo_count : int
+ *      number of mutations for a dummy position added to each row
+ * recurrent, entropy_fraction, delta_entropy : double*
+ *      output arrays of length num_rows
+ */
+void calc_position_statistics_batch(const int *codon_pos,
+                                    const unsigned char *is_missense,
+                                    int num_rows,
+                                    int num_cols,
+                                    int pseudo_count,
+                                    float min_frac,
+                                    int min_recurrent,
+                                    int is_observed,
+                                    double *recurrent,
+                                    double *entropy_fraction,
+                                    double *delta_entropy){
+    double stats[3];
+    std::vector<int> pos, counts;
+    const int *row_pos;
+    const unsigned char *row_mask;
+    pos.reserve(num_cols);
+    counts.reserve(num_cols + 1);
+
+    for (int r=0; r<num_rows; r++){
+        row_pos = codon_pos + (std::size_t) r * num_cols;
+        row_mask = is_missense + (std::size_t) r * num_cols;
+
+        // collect the missense positions
+        pos.clear();
+        for (int c=0; c<num_cols; c++){
+            if (row_mask[c]) pos.push_back(row_pos[c]);
+        }
+        std::sort(pos.begin(), pos.end());
+
+        // count mutations per position
+        counts.clear();
+        for (std::size_t k=0; k<pos.size(); k++){
+            if (k > 0 && pos[k] == pos[k-1]){
+                counts.back() += 1;
+            } else {
+                counts.push_back(1);
+            }
+        }
+        if (pseudo_count) counts.push_back(pseudo_count);
+
+        position_statistics(counts, min_frac, min_recurrent, is_observed, stats);
+        recurrent[r] = stats[0];
+        entropy_fraction[r] = stats[1];
+        delta_entropy[r] = stats[2];
+    }
+}
+
+
 /* Calculates the effect-based statistics in one function.
  *
  * Parameters
@@ -140,7 +236,7 @@ std::map<std::string, double> calc_effect_statistics(std::map<int, int> pos_ctr,
         if (pos==-1){
             num_inactivating = val;
             p = val / mysum;
-            myent_2 -= p * log2(p);
+            myent_2 -= p * log2_ld(p);
             num_pos += 1;
             continue;
         }
@@ -157,19 +253,19 @@ std::map<std::string, double> calc_effect_statistics(std::map<int, int> pos_ctr,
         if (val<min_recurrent && is_observed==1){
             p = 1 / mysum;
             for (int i=0; i<val; i++){
-                myent_2 -= p * log2(p);
+                myent_2 -= p * log2_ld(p);
                 num_pos += 1;
             }
         } else {
             p = val / mysum;
-            myent_2 -= p * log2(p);
+            myent_2 -= p * log2_ld(p);
             num_pos += 1;
         }
     }
 
     // normalize the entropy metrics
     if (mysum > 1) {
-        frac_of_uniform_ent = myent_2 / log2(mysum);
+        frac_of_uniform_ent = myent_2 / log2_ld(mysum);
     }
 
     // put output in a map container
@@ -26,6 +26,21 @@ cdef extern from "permutation.hpp":
                                                int is_obs)
 
 
+cdef extern from "permutation.hpp" nogil:
+    # batch kernel runs without the GIL
+    void calc_position_statistics_batch(const int *codon_pos,
+                                        const unsigned char *is_missense,
+                                        int num_rows,
+                                        int num_cols,
+                                        int pseudo_count,
+                                        float min_frac,
+                                        int min_recurrent,
+                                        int is_obs,
+                                        double *recurrent,
+                                        double *entropy_fraction,
+                                        double *delta_entropy)
+
+
 @cython.cdivision(True)
 def pos_to_codon(gene_seq, int pos):
     """Retrieves information about the codon a nucleotide position is in.
@@ -78,12 +93,7 @@ def calc_pos_info(aa_mut_pos,
                   int is_obs=1):
     cdef:
         map[int, int] pos_ctr
-        map[string, double] pos_info
-        int num_recur = 0
-        double frac_pos_ent = 0.0
-        double delta_pos_ent = 0.0
         int i, num_pos
-        DTYPE_INT_t[::1] pos_array
         cdef int DUMMY_INT = 9999999  # dummy pos if prior used
     tmp_pos_list = []
     num_pos = len(aa_mut_pos)
@@ -99,17 +109,94 @@ def calc_pos_info(aa_mut_pos,
                 pos_ctr[pos] += 1
                 tmp_pos_list.append(pos)
 
+    # get position statistics
+    codon_pos = np.array([tmp_pos_list], dtype=np.intc)
+    is_missense = np.ones(codon_pos.shape, dtype=np.uint8)
+    num_recur, frac_pos_ent, delta_pos_ent = calc_pos_info_batch(codon_pos,
+                                                                 is_missense,
+                                                                 pseudo_count,
+                                                                 min_frac,
+                                                                 min_recur,
+                                                                 is_obs)
+
     # add pseudo-counts if specified
     if pseudo_count:
         pos_ctr[DUMMY_INT] = pseudo_count
 
-    # get position statistics
-    # pos_info = calc_position_statistics(pos_ctr, min_frac, min_recur, is_obs)
-    pos_info = calc_position_statistics(pos_ctr, min_frac, min_recur, is_obs)
-    num_recur = <int> pos_info["recurrent"]
-    frac_pos_ent = pos_info["entropy_fraction"]
-    delta_pos_ent = pos_info["delta_entropy"]
-    return num_recur, frac_pos_ent, delta_pos_ent, pos_ctr
+    return int(num_recur[0]), float(frac_pos_ent[0]), float(delta_pos_ent[0]), pos_ctr
+
+
+def calc_pos_info_batch(codon_pos,
+                        is_missense,
+                        int pseudo_count=0,
+                        double min_frac=0.0,
+                        int min_recur=2,
+                        int is_obs=1):
+    """Calculates position-based statistics for a batch of simulations.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        num_simulations X num_mutations matrix of codon positions
+    is_missense : np.array
+        boolean matrix, same shape as codon_pos, indicating which
+        mutations are missense
+    pseudo_count : int, default: 0
+        number of mutations at a dummy position added to each simulation
+    min_frac : float, default: 0.0
+        minimum fraction of missense mutations for a recurrent position
+    min_recur : int, default: 2
+        minimum number of mutations for a recurrent position
+    is_obs : int, default: 1
+        whether the mutations are observed (1) or simulated (0)
+
+    Returns
+    -------
+    num_recur : np.array
+        number of recurrent missense mutations for each simulation
+    frac_pos_ent : np.array
+        fraction of uniform missense entropy for each simulation
+    delta_pos_ent : np.array
+        delta entropy compared to uniform for each simulation
+    """
+    cdef:
+        int[:, ::1] codon_view
+        unsigned char[:, ::1] missense_view
+        double[::1] recur_view, ent_view, delta_ent_view
+        int num_rows, num_cols
+        float min_frac_float = min_frac
+
+    codon_pos = np.ascontiguousarray(codon_pos, dtype=np.intc)
+    is_missense = np.ascontiguousarray(is_missense, dtype=np.uint8)
+    if codon_pos.shape[1] == 0:
+        # use a single non-missense column so views have valid pointers
+        codon_pos = np.zeros((codon_pos.shape[0], 1), dtype=np.intc)
+        is_missense = np.zeros((codon_pos.shape[0], 1), dtype=np.uint8)
+    num_rows, num_cols = codon_pos.shape
+
+    num_recur = np.zeros(num_rows, dtype=np.float64)
+    frac_pos_ent = np.zeros(num_rows, dtype=np.float64)
+    delta_pos_ent = np.zeros(num_rows, dtype=np.float64)
+    if num_rows == 0:
+        return num_recur.astype(int), frac_pos_ent, delta_pos_ent
+
+    codon_view = codon_pos
+    missense_view = is_missense
+    recur_view = num_recur
+    ent_view = frac_pos_ent
+    delta_ent_view = delta_pos_ent
+    with nogil:
+        calc_position_statistics_batch(&codon_view[0, 0],
+                                       &missense_view[0, 0],
+                                       num_rows, num_cols,
+                                       pseudo_count,
+                                       min_frac_float,
+                                       min_recur,
+                                       is_obs,
+                                       &recur_view[0],
+                                       &ent_view[0],
+                                       &delta_ent_view[0])
+    return num_recur.astype(int), frac_pos_ent, delta_pos_ent
 
 
 def calc_effect_info(aa_mut_pos,
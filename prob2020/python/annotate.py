@@ -11,14 +11,12 @@ def annotate_maf(coding_pos, somatic_base, gene_seq):
     gene_name = gene_seq.bed.gene_name
     strand = gene_seq.bed.strand
     chrom = gene_seq.bed.chrom
-    gene_seq.bed.init_genome_coordinates()  # map seq pos to genome
 
     # determine result of random positions
     maf_list = []
 
     # get genome coordinate
-    pos2genome = np.vectorize(lambda x: gene_seq.bed.seqpos2genome[x]+1)
-    genome_coord = pos2genome(coding_pos)
+    genome_coord = gene_seq.bed.seqpos_to_genome(coding_pos) + 1
 
     # get info about mutations
     tmp_mut_info = mc.get_aa_mut_info(coding_pos,
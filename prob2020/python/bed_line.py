@@ -1,5 +1,6 @@
 """Parses an individual line in a BED file."""
 from collections import namedtuple
+import numpy as np
 import logging
 
 # Initialize a global named tuple to make handling BED lines less awkward
@@ -30,7 +31,15 @@ class BedLine(object):
         >>> bed.query_position('+', 'chr3', 41265559)
         0
 
+    Exon coordinates are also held in NumPy arrays (exon_starts, exon_ends
+    and the cumulative exon lengths in exon_offsets) so that entire arrays of
+    positions can be mapped with query_positions and seqpos_to_genome.
     """
+    __slots__ = ('bed_tuple', 'gene_name', 'chrom', 'chrom_start', 'strand',
+                 'exons', 'exon_lens', 'num_exons', 'cds_len',
+                 'five_ss_len', 'three_ss_len', 'pos2ss', 'seqpos2genome',
+                 'exon_starts', 'exon_ends', 'exon_offsets',
+                 '_window_starts', '_window_ends', '_sorted_windows')
 
     def __init__(self, line):
         # make input a list of strings
@@ -54,6 +63,10 @@ class BedLine(object):
         # set exons
         self._init_exons()
 
+    def __reduce__(self):
+        """Pickle only the original BED fields (e.g. for multiprocessing)."""
+        return (self.__class__, (list(self.bed_tuple),))
+
     def _filter_utr(self, ex):
         """Filter out UTR regions from the exon list (ie retain only coding regions).
 
@@ -126,8 +139,31 @@ class BedLine(object):
         self.cds_len = sum(self.exon_lens)
         self.five_ss_len = 2*(self.num_exons-1)
         self.three_ss_len = 2*(self.num_exons-1)
+        self._init_exon_arrays()
         self._init_splice_site_pos()
 
+    def _init_exon_arrays(self):
+        """Stores the exon coordinates as arrays used to map positions.
+
+        Each exon is also given a window extending over the two bases of
+        the adjacent splice sites (except before the first and after the
+        last exon). A genomic position maps to the first exon whose window
+        contains it.
+        """
+        exon_array = np.array(self.exons, dtype=np.int64).reshape(-1, 2)
+        self.exon_starts = exon_array[:, 0]
+        self.exon_ends = exon_array[:, 1]
+        self.exon_offsets = np.zeros(self.num_exons+1, dtype=np.int64)
+        np.cumsum(self.exon_ends - self.exon_starts, out=self.exon_offsets[1:])
+
+        self._window_starts = self.exon_starts - 2
+        self._window_ends = self.exon_ends + 2
+        if self.num_exons:
+            self._window_starts[0] = self.exon_starts[0]
+            self._window_ends[-1] = self.exon_ends[-1]
+        # windows of very short exons/introns can be out of order
+        self._sorted_windows = bool(np.all(np.diff(self._window_starts) >= 0))
+
     def _init_splice_site_pos(self):
         # dictionary mapping internal position format to position
         # in list of 5'/3' splice sites
@@ -156,45 +192,57 @@ class BedLine(object):
 
     def init_genome_coordinates(self) :
         """Creates the self.seqpos2genome dictionary that converts positions
-        relative to the sequence to genome coordinates."""
-        self.seqpos2genome = {}
-
-        # record genome positions for each sequence position
-        seq_pos = 0
-        for estart, eend in self.exons:
-            for genome_pos in range(estart, eend):
-                if self.strand == '+':
-                    self.seqpos2genome[seq_pos] = genome_pos
-                elif self.strand == '-':
-                    tmp = self.cds_len - seq_pos - 1
-                    self.seqpos2genome[tmp] = genome_pos
-                seq_pos += 1
-
-        # recode 5' splice site locations
-        for i in range(0, self.five_ss_len):
-            seq_pos = self.cds_len + i
-            ss_ix = i // 2  # the ss_ix'th 5'ss starting from upstream tx
-            pos_in_ss = i % 2  # whether first/second nuc in splice site
-
-            # determine genome coordinates for 5' splice site
-            if self.strand == '+':
-                self.seqpos2genome[seq_pos] = self.exons[ss_ix][1] + pos_in_ss
-            else:
-                exon_pos = -1 - ss_ix
-                self.seqpos2genome[seq_pos] = self.exons[exon_pos][0] - pos_in_ss - 1
-
-        # recode 3' splice site locations
-        for i in range(0, self.three_ss_len):
-            seq_pos = self.cds_len + self.five_ss_len + i
-            ss_ix = i // 2  # the ss_ix'th 3'ss starting from upstream tx
-            pos_in_ss = i % 2  # whether first/second nuc in splice site
-
-            # determine genome coordinates for 3' splice site
-            if self.strand == '+':
-                self.seqpos2genome[seq_pos] = self.exons[ss_ix+1][0] - 2 + pos_in_ss
-            else:
-                exon_pos = -1 - ss_ix
-                self.seqpos2genome[seq_pos] = self.exons[exon_pos-1][1] + 1 - pos_in_ss
+        relative to the sequence to genome coordinates.
+
+        Prefer seqpos_to_genome, which converts an array of positions without
+        creating a dictionary entry for every position.
+        """
+        seq_pos = np.arange(self.cds_len + self.five_ss_len + self.three_ss_len)
+        self.seqpos2genome = dict(zip(seq_pos.tolist(),
+                                      self.seqpos_to_genome(seq_pos).tolist()))
+
+    def seqpos_to_genome(self, seq_pos):
+        """Converts positions relative to the sequence to genome coordinates.
+
+        Parameters
+        ----------
+        seq_pos : np.array
+            positions along the coding sequence, followed by the 5' and 3'
+            splice sites (same convention as query_position)
+
+        Returns
+        -------
+        genome_pos : np.array
+            0-based genome coordinate for each position
+        """
+        seq_pos = np.asarray(seq_pos, dtype=np.int64)
+        genome_pos = np.empty(seq_pos.shape, dtype=np.int64)
+
+        # coding positions
+        is_cds = seq_pos < self.cds_len
+        cds_pos = seq_pos[is_cds]
+        if self.strand == '-':
+            cds_pos = self.cds_len - cds_pos - 1
+        exon_ix = np.searchsorted(self.exon_offsets, cds_pos, side='right') - 1
+        genome_pos[is_cds] = self.exon_starts[exon_ix] + cds_pos - self.exon_offsets[exon_ix]
+
+        # 5' splice sites
+        ss_pos = seq_pos - self.cds_len
+        is_five = ~is_cds & (ss_pos < self.five_ss_len)
+        ss_ix, pos_in_ss = np.divmod(ss_pos[is_five], 2)
+        if self.strand == '+':
+            genome_pos[is_five] = self.exon_ends[ss_ix] + pos_in_ss
+        else:
+            genome_pos[is_five] = self.exon_starts[-1-ss_ix] - pos_in_ss - 1
+
+        # 3' splice sites
+        is_three = ~is_cds & ~is_five
+        ss_ix, pos_in_ss = np.divmod(ss_pos[is_three] - self.five_ss_len, 2)
+        if self.strand == '+':
+            genome_pos[is_three] = self.exon_starts[ss_ix+1] - 2 + pos_in_ss
+        else:
+            genome_pos[is_three] = self.exon_ends[-2-ss_ix] + 1 - pos_in_ss
+        return genome_pos
 
     def query_position(self, strand, chr, genome_coord):
         """Provides the relative position on the coding sequence for a given
@@ -231,30 +279,74 @@ class BedLine(object):
                 return None
 
         # return position if contained within coding region or splice site
-        for i, (estart, eend) in enumerate(self.exons):
-            # in coding region
-            if estart <= genome_coord < eend:
-                if strand == '+':
-                    prev_lens = sum(self.exon_lens[:i])  # previous exon lengths
-                    pos = prev_lens + (genome_coord - estart)
-                elif strand == '-':
-                    prev_lens = sum(self.exon_lens[:i])  # previous exon lengths
-                    pos = prev_lens + (genome_coord - estart)
-                    pos = self.cds_len - pos - 1  # flip coords because neg strand
-                return pos
-            # in splice site
-            elif (eend <= genome_coord < eend + 2) and i != self.num_exons-1:
-                if strand == '+':
-                    pos = self.cds_len + 2*i + (genome_coord - eend)
-                elif strand == '-':
-                    pos = self.cds_len + self.five_ss_len + 2*(self.num_exons-(i+2)) + (genome_coord - eend)
-                return pos
-            # in splice site
-            elif (estart - 2 <= genome_coord < estart) and i != 0:
-                if strand == '-':
-                    pos = self.cds_len + 2*(self.num_exons-(i+2)) + (genome_coord - (estart - 2))
-                elif strand == '+':
-                    pos = self.cds_len + self.five_ss_len + 2*(i-1) + (genome_coord - (estart - 2))
-                return pos
+        pos = self.query_positions([chr], [genome_coord], strand)[0]
+        return int(pos) if pos >= 0 else None
+
+    def query_positions(self, chroms, coords, strand=None):
+        """Provides the relative positions on the coding sequence for an
+        array of genomic positions.
+
+        Positions follow the same convention as query_position, i.e.
+        coding positions are followed by the 5' and then 3' splice sites.
+
+        Parameters
+        ----------
+        chroms : array-like
+            chromosome of each position, provided to check validity of
+            query (not enforced, same as query_position)
+        coords : array-like
+            0-based genome positions
+        strand : str or None
+            strand to report positions on, defaults to the gene's strand
 
+        Returns
+        -------
+        pos : np.array
+            position of each mutation in the coding sequence, -1 if the
+            position does not match a region found in self.exons
+        """
+        if strand is None:
+            strand = self.strand
+        coords = np.asarray(coords, dtype=np.int64)
+        pos = np.full(coords.shape, -1, dtype=np.int64)
+        if not self.num_exons or strand not in ('+', '-'):
+            return pos
+
+        # find the first exon whose window contains each position
+        if self._sorted_windows:
+            window_ends = np.maximum.accumulate(self._window_ends)
+            exon_ix = np.searchsorted(window_ends, coords, side='right')
+            is_valid = exon_ix < self.num_exons
+            exon_ix[~is_valid] = 0
+            is_valid &= self._window_starts[exon_ix] <= coords
+        else:
+            in_window = ((self._window_starts <= coords[..., None]) &
+                         (coords[..., None] < self._window_ends))
+            exon_ix = in_window.argmax(axis=-1)
+            is_valid = in_window.any(axis=-1)
+        estart = self.exon_starts[exon_ix]
+        eend = self.exon_ends[exon_ix]
+
+        # coding region
+        is_cds = is_valid & (estart <= coords) & (coords < eend)
+        cds_pos = self.exon_offsets[exon_ix] + (coords - estart)
+        if strand == '-':
+            cds_pos = self.cds_len - cds_pos - 1
+        pos[is_cds] = cds_pos[is_cds]
+
+        # splice site after the exon
+        is_after = is_valid & (coords >= eend)
+        if strand == '+':
+            ss_pos = self.cds_len + 2*exon_ix + (coords - eend)
+        else:
+            ss_pos = self.cds_len + self.five_ss_len + 2*(self.num_exons-(exon_ix+2)) + (coords - eend)
+        pos[is_after] = ss_pos[is_after]
+
+        # splice site before the exon
+        is_before = is_valid & (coords < estart)
+        if strand == '-':
+            ss_pos = self.cds_len + 2*(self.num_exons-(exon_ix+2)) + (coords - (estart - 2))
+        else:
+            ss_pos = self.cds_len + self.five_ss_len + 2*(exon_ix-1) + (coords - (estart - 2))
+        pos[is_before] = ss_pos[is_before]
         return pos
@@ -0,0 +1,208 @@
+"""Exact (simulation-free) p-values for the deleterious mutation test.
+
+Under the null model of the randomization-based test each mutation is
+placed independently and uniformly at random among the positions in the
+gene sharing the mutation's sequence context. The number of deleterious
+mutations is therefore a sum of independent Bernoulli variables, i.e.
+a Poisson-binomial random variable, whose success probabilities only
+depend on the sequence context and somatic base of each mutation.
+"""
+import numpy as np
+import scipy.stats as stats
+import scipy.special as special
+from scipy.optimize import brentq
+from prob2020.python.gene_effect_table import GeneEffectTable
+
+import logging
+logger = logging.getLogger(__name__)  # module logger
+
+# number of mutations in a gene above which the saddlepoint
+# approximation is used instead of the exact convolution
+MAX_EXACT_MUTATIONS = 10000
+
+
+def group_probabilities(probs):
+    """Groups identical Bernoulli success probabilities.
+
+    Parameters
+    ----------
+    probs : np.array
+        success probability for each Bernoulli trial
+
+    Returns
+    -------
+    uniq_probs : np.array
+        distinct success probabilities
+    counts : np.array
+        number of trials with each distinct success probability
+    """
+    uniq_probs, counts = np.unique(np.asarray(probs, dtype=float),
+                                   return_counts=True)
+    return uniq_probs, counts
+
+
+def poisson_binomial_sf(probs, k):
+    """Computes P(X >= k) for a Poisson-binomial random variable X by
+    convolving the binomial distributions of trials with identical
+    success probabilities.
+
+    Parameters
+    ----------
+    probs : np.array
+        success probability for each Bernoulli trial
+    k : int
+        minimum number of successes
+
+    Returns
+    -------
+    pval : float
+        probability of at least k successes
+    """
+    if k <= 0:
+        return 1.0
+    uniq_probs, counts = group_probabilities(probs)
+    pmf = np.ones(1)
+    for p, n in zip(uniq_probs, counts):
+        binom_pmf = stats.binom.pmf(np.arange(n+1), n, p)
+        pmf = np.convolve(pmf, binom_pmf)
+    pval = pmf[k:].sum()
+    return float(min(pval, 1.0))
+
+
+def saddlepoint_sf(probs, k):
+    """Approximates P(X >= k) for a Poisson-binomial random variable X.
+
+    Uses the Lugannani-Rice saddlepoint approximation with the second
+    continuity correction for lattice distributions (Butler, 2007).
+
+    Parameters
+    ----------
+    probs : np.array
+        success probability for each Bernoulli trial
+    k : int
+        minimum number of successes
+
+    Returns
+    -------
+    pval : float
+        approximate probability of at least k successes
+    """
+    uniq_probs, counts = group_probabilities(probs)
+
+    # trials that always (or never) succeed do not contribute variance
+    k = k - counts[uniq_probs >= 1].sum()
+    is_random = (uniq_probs > 0) & (uniq_probs < 1)
+    uniq_probs, counts = uniq_probs[is_random], counts[is_random]
+    num_random = counts.sum()
+    if k <= 0:
+        return 1.0
+    elif k > num_random:
+        return 0.0
+
+    # cumulant generating function and its derivatives
+    logit_p = special.logit(uniq_probs)
+    log_q = np.log1p(-uniq_probs)
+    def cgf(s):
+        return np.sum(counts * (log_q + np.logaddexp(0, s + logit_p)))
+    def cgf_prime(s):
+        return np.sum(counts * special.expit(s + logit_p))
+    def cgf_second(s):
+        tmp_p = special.expit(s + logit_p)
+        return np.sum(counts * tmp_p * (1 - tmp_p))
+
+    # solve for saddlepoint on the continuity corrected count
+    k_corrected = k - 0.5
+    mean = cgf_prime(0)
+    if np.isclose(k_corrected, mean, rtol=0, atol=1e-8):
+        # saddlepoint at zero, normal approximation is exact to first order
+        return float(stats.norm.sf(0))
+    bound = 1.0
+    while np.sign(cgf_prime(-bound) - k_corrected) == np.sign(cgf_prime(bound) - k_corrected):
+        bound *= 2
+    s_hat = brentq(lambda s: cgf_prime(s) - k_corrected, -bound, bound)
+
+    w = np.sign(s_hat) * np.sqrt(2 * (s_hat * k_corrected - cgf(s_hat)))
+    u = 2 * np.sinh(s_hat / 2) * np.sqrt(cgf_second(s_hat))
+    pval = stats.norm.sf(w) - stats.norm.pdf(w) * (1/w - 1/u)
+    return float(min(max(pval, 0.0), 1.0))
+
+
+def deleterious_probabilities(context_counts,
+                              context_to_mut,
+                              seq_context,
+                              gene_seq):
+    """Computes the probability that each mutation would be deleterious
+    if randomly placed among positions with the same sequence context.
+
+    Parameters
+    ----------
+    context_counts : pd.Series
+        number of mutations for each context
+    context_to_mut : dict
+        dictionary mapping nucleotide context to a list of observed
+        somatic base changes.
+    seq_context : SequenceContext
+        Sequence context for the entire gene sequence (regardless
+        of where mutations occur). The nucleotide contexts are
+        identified at positions along the gene.
+    gene_seq : GeneSequence
+        Sequence of gene of interest
+
+    Returns
+    -------
+    probs : np.array
+        probability of being deleterious for each mutation
+    """
+    effect_table = GeneEffectTable(gene_seq)
+    probs = []
+    for one_context in context_counts.index.tolist():
+        context_pos = seq_context.context_positions(one_context)
+        base_ix = effect_table.base_index(context_to_mut[one_context])
+        prob_del = effect_table.is_deleterious[context_pos, :].mean(axis=0)
+        probs.append(prob_del[base_ix])
+    return np.hstack(probs) if probs else np.zeros(0)
+
+
+def deleterious_exact(obs_del,
+                      context_counts,
+                      context_to_mut,
+                      seq_context,
+                      gene_seq,
+                      max_exact_mutations=MAX_EXACT_MUTATIONS):
+    """Calculates the p-value for the number of deleterious mutations in a
+    single gene without simulations.
+
+    The p-value is the probability of observing at least obs_del
+    deleterious mutations under the same null model as
+    permutation.deleterious_permutation. Genes with more than
+    max_exact_mutations mutations use a saddlepoint approximation.
+
+    Parameters
+    ----------
+    obs_del : int
+        observed number of deleterious mutations
+    context_counts : pd.Series
+        number of mutations for each context
+    context_to_mut : dict
+        dictionary mapping nucleotide context to a list of observed
+        somatic base changes.
+    seq_context : SequenceContext
+        Sequence context for the entire gene sequence (regardless
+        of where mutations occur). The nucleotide contexts are
+        identified at positions along the gene.
+    gene_seq : GeneSequence
+        Sequence of gene of interest
+    max_exact_mutations : int
+        maximum number of mutations to compute the exact distribution
+
+    Returns
+    -------
+    del_pval : float
+        p-value for the number of deleterious mutations
+    """
+    probs = deleterious_probabilities(context_counts, context_to_mut,
+                                      seq_context, gene_seq)
+    if len(probs) > max_exact_mutations:
+        logger.debug('Using saddlepoint approximation for {0} ({1} mutations)'.format(gene_seq.bed.gene_name, len(probs)))
+        return saddlepoint_sf(probs, obs_del)
+    return poisson_binomial_sf(probs, obs_del)
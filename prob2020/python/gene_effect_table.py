@@ -0,0 +1,279 @@
+"""Pre-computes the effect of every possible SNV in a gene.
+
+The GeneEffectTable replaces repeated calls to
+mutation_context.get_aa_mut_info in the simulation loops. All amino acids
+and variant classifications are encoded as small integers so that the
+effect of an entire batch of simulated mutations can be retrieved by
+fancy indexing.
+"""
+import numpy as np
+import prob2020.python.utils as utils
+
+# nucleotides a somatic base may take, the order defines the base index.
+# 'N' is allowed since it passes utils.is_valid_nuc, but never forms a
+# valid codon.
+bases = 'ACGTN'
+base2ix = {b: i for i, b in enumerate(bases)}
+N_IX = base2ix['N']
+
+# integer code for missing information (e.g. codon not in codon table)
+NA = -1
+
+# integer codes for amino acid residues. The last element of aa_names is
+# used when decoding NA, which mirrors get_aa_mut_info returning None.
+aa_letters = 'ACDEFGHIKLMNPQRSTVWY*'
+aa_names = list(aa_letters) + ['Splice_Site', None]
+aa2code = {aa: i for i, aa in enumerate(aa_names[:-1])}
+STOP = aa2code['*']
+SPLICE_SITE = aa2code['Splice_Site']
+
+# integer codes for the variant classification, order matches utils.variant_snv
+variant_names = utils.variant_snv + ['']
+MISSENSE = variant_names.index('Missense_Mutation')
+SILENT = variant_names.index('Silent')
+NONSENSE = variant_names.index('Nonsense_Mutation')
+SPLICE = variant_names.index('Splice_Site')
+NONSTOP = variant_names.index('Nonstop_Mutation')
+LOST_START = variant_names.index('Translation_Start_Site')
+
+# object arrays used to convert integer codes back to strings
+_aa_name_array = np.array(aa_names, dtype=object)
+_variant_name_array = np.array(variant_names, dtype=object)
+
+# map ascii characters to base index
+_nuc_lookup = np.full(256, N_IX, dtype=np.int8)
+for _b in 'ACGT':
+    _nuc_lookup[ord(_b)] = base2ix[_b]
+
+# map a codon, encoded as 25*b1 + 5*b2 + b3, to an amino acid code
+_codon_weights = np.array([25, 5, 1], dtype=np.int16)
+_codon2aa = np.full(len(bases)**3, NA, dtype=np.int8)
+for _codon, _aa in utils.codon_table.items():
+    if len(_codon) == 3:
+        _codon2aa[np.dot([base2ix[n] for n in _codon], _codon_weights)] = aa2code[_aa]
+
+
+def encode_seq(seq):
+    """Converts a nucleotide string into an array of base indices.
+
+    Parameters
+    ----------
+    seq : str
+        nucleotide sequence (upper case)
+
+    Returns
+    -------
+    seq_ix : np.array
+        base index for each nucleotide, anything besides A, C, G, or T
+        is encoded as N.
+    """
+    if not seq:
+        return np.zeros(0, dtype=np.int8)
+    return _nuc_lookup[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+
+def encode_aa(aa_list):
+    """Converts a list of amino acid residues into integer codes.
+
+    Parameters
+    ----------
+    aa_list : list of str
+        amino acid residues, e.g. as returned by mutation_context.get_aa_mut_info
+
+    Returns
+    -------
+    aa_codes : np.array
+        amino acid code for each residue (NA if unrecognized)
+    """
+    return np.array([aa2code.get(aa, NA) for aa in aa_list], dtype=np.int8)
+
+
+class GeneEffectTable(object):
+    """The GeneEffectTable holds the effect of every possible SNV in a gene.
+
+    Positions follow the same convention as SequenceContext, i.e. coding
+    positions are followed by the 5' and then 3' splice site positions.
+    Attributes depending on the somatic base are 2-D arrays indexed by
+    [position, base index].
+
+    Attributes
+    ----------
+    ref_aa : np.array
+        reference amino acid code for each position
+    somatic_aa : np.array
+        somatic amino acid code for each position and somatic base
+    codon_pos : np.array
+        0-based codon position for each position (NA for splice sites)
+    variant_class : np.array
+        variant classification code for each position and somatic base
+    is_deleterious : np.array
+        boolean indicating whether a mutation at each position and
+        somatic base is deleterious (nonsense, lost stop, splice site
+        or lost start)
+    is_missense : np.array
+        boolean indicating whether a mutation at each position and
+        somatic base changes the amino acid at a codon position (missense
+        or lost start), following cutils.calc_pos_info
+    ref_nuc : np.array
+        reference nucleotide for each position
+    """
+
+    def __init__(self, gene_seq):
+        self._init_coding(gene_seq)
+        self._init_splice_site(gene_seq)
+        self._init_variant_class()
+
+    def _init_coding(self, gene_seq):
+        """Computes the effect of SNVs for positions in the coding region."""
+        cds_len = gene_seq.bed.cds_len
+        seq_ix = encode_seq(gene_seq.exon_seq[:cds_len])
+
+        # pad incomplete codons with N so they do not translate
+        num_codons = -(-cds_len // 3)
+        padded_seq = np.full(3*num_codons, N_IX, dtype=np.int8)
+        padded_seq[:len(seq_ix)] = seq_ix
+        codons = padded_seq.reshape(-1, 3).astype(np.int16)
+        ref_codon_code = codons.dot(_codon_weights)
+
+        # codon information for every coding position
+        pos = np.arange(cds_len)
+        codon_pos = pos // 3
+        pos_weight = _codon_weights[pos % 3]
+        pos_codon_code = ref_codon_code[codon_pos]
+
+        # substitute each possible somatic base into the codon
+        base_ix = np.arange(len(bases), dtype=np.int16)
+        mut_codon_code = (pos_codon_code[:, None] +
+                          (base_ix[None, :] - padded_seq[:cds_len, None]) * pos_weight[:, None])
+
+        self.cds_len = cds_len
+        self._coding_ref_aa = _codon2aa[pos_codon_code]
+        self._coding_somatic_aa = _codon2aa[mut_codon_code]
+        self._coding_codon_pos = codon_pos.astype(np.int32)
+        self._coding_ref_nuc = np.array(list(gene_seq.exon_seq[:cds_len]), dtype=object)
+
+    def _init_splice_site(self, gene_seq):
+        """Sets the effect of SNVs at splice site positions and
+        concatenates the coding and splice site information."""
+        # reference nucleotides follow the order of bed.pos2ss
+        ss_ref_nuc = [ss[k]
+                      for ss_list in [gene_seq.five_prime_seq, gene_seq.three_prime_seq]
+                      for ss in ss_list
+                      for k in [1, 2]]
+        num_ss = len(ss_ref_nuc)
+
+        self.num_pos = self.cds_len + num_ss
+        self.ref_aa = np.concatenate([self._coding_ref_aa,
+                                      np.full(num_ss, SPLICE_SITE, dtype=np.int8)])
+        self.somatic_aa = np.concatenate([self._coding_somatic_aa,
+                                          np.full((num_ss, len(bases)), SPLICE_SITE, dtype=np.int8)])
+        self.codon_pos = np.concatenate([self._coding_codon_pos,
+                                         np.full(num_ss, NA, dtype=np.int32)])
+        self.ref_nuc = np.concatenate([self._coding_ref_nuc,
+                                       np.array(ss_ref_nuc, dtype=object)])
+        del self._coding_ref_aa, self._coding_somatic_aa
+        del self._coding_codon_pos, self._coding_ref_nuc
+
+    def _init_variant_class(self):
+        """Classifies each SNV, following cutils.get_variant_classification."""
+        ref_aa = np.broadcast_to(self.ref_aa[:, None], self.somatic_aa.shape)
+        somatic_aa = self.somatic_aa
+        is_valid = (ref_aa != NA) & (somatic_aa != NA)
+        is_diff = is_valid & (ref_aa != somatic_aa)
+        is_start = (self.codon_pos == 0)[:, None]
+
+        # later assignments take precedence over earlier ones
+        var_class = np.full(somatic_aa.shape, NA, dtype=np.int8)
+        var_class[is_valid] = SILENT
+        var_class[is_diff] = MISSENSE
+        var_class[is_diff & is_start] = LOST_START
+        var_class[is_diff & (ref_aa == STOP)] = NONSTOP
+        var_class[is_diff & (somatic_aa == STOP)] = NONSENSE
+        var_class[ref_aa == SPLICE_SITE] = SPLICE
+        self.variant_class = var_class
+        self.is_deleterious = np.in1d(var_class, [NONSENSE, NONSTOP, SPLICE, LOST_START]).reshape(var_class.shape)
+        self.is_missense = (var_class == MISSENSE) | (var_class == LOST_START)
+
+    def base_index(self, somatic_base):
+        """Converts a list of somatic bases into base indices.
+
+        Parameters
+        ----------
+        somatic_base : list of str
+            somatic nucleotide for each mutation
+
+        Returns
+        -------
+        base_ix : np.array
+            base index for each mutation
+        """
+        return np.array([base2ix.get(b, N_IX) for b in somatic_base], dtype=np.intp)
+
+    def effects(self, pos, base_ix):
+        """Looks up the effect of a batch of mutations.
+
+        Parameters
+        ----------
+        pos : np.array
+            positions of mutations, e.g. a num_permutations X num_mutations
+            matrix of simulated positions
+        base_ix : np.array
+            base index of the somatic base for each mutation (column of pos)
+
+        Returns
+        -------
+        effects : dict
+            integer arrays with the same shape as pos for the reference AA,
+            somatic AA, codon position and variant classification
+        """
+        effects = {'Reference AA': self.ref_aa[pos],
+                   'Somatic AA': self.somatic_aa[pos, base_ix],
+                   'Codon Pos': self.codon_pos[pos],
+                   'Variant Class': self.variant_class[pos, base_ix],
+                   'Position': pos}
+        return effects
+
+    def deleterious_count(self, pos, base_ix):
+        """Counts the deleterious mutations in each row of a batch.
+
+        Parameters
+        ----------
+        pos : np.array
+            num_permutations X num_mutations matrix of mutation positions
+        base_ix : np.array
+            base index of the somatic base for each mutation (column of pos)
+
+        Returns
+        -------
+        del_count : np.array
+            number of deleterious mutations for each row of pos
+        """
+        return self.is_deleterious[pos, base_ix].sum(axis=1)
+
+    def mut_info(self, effects, row):
+        """Decodes a single row of a batch of effects into the same format
+        returned by mutation_context.get_aa_mut_info.
+
+        Parameters
+        ----------
+        effects : dict
+            output from the effects method
+        row : int
+            row of the batch to decode
+
+        Returns
+        -------
+        aa_info : dict
+            information about the somatic mutation effect on AA's
+        """
+        codon_pos = effects['Codon Pos'][row]
+        aa_info = {'Codon Pos': [(int(c) if c != NA else None) for c in codon_pos],
+                   'Reference Nuc': self.ref_nuc[effects['Position'][row]].tolist(),
+                   'Reference AA': _aa_name_array[effects['Reference AA'][row]].tolist(),
+                   'Somatic AA': _aa_name_array[effects['Somatic AA'][row]].tolist()}
+        return aa_info
+
+    def variant_classification(self, effects, row):
+        """Returns the variant classification strings for a single row of
+        a batch of effects (empty string if unclassifiable)."""
+        return _variant_name_array[effects['Variant Class'][row]].tolist()
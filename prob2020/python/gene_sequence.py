@@ -77,6 +77,10 @@ class GeneSequence(object):
         three_prime_ss : list of str
             list of 3' splice site sequences
         """
+        # compiled references return all sequences of a gene at once
+        if hasattr(self.fasta, 'fetch_gene'):
+            return self.fasta.fetch_gene(self.bed.gene_name)
+
         exons = []
         three_prime_ss = []
         five_prime_ss = []
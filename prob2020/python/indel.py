@@ -14,11 +14,6 @@ def simulate_indel_counts(indel_df, bed_dict,
     bed_genes = [mybed
                  for chrom in bed_dict
                  for mybed in bed_dict[chrom]]
-    tmp = []
-    for b in bed_genes:
-        b.init_genome_coordinates()
-        tmp.append(b)
-    bed_genes = tmp
     gene_lengths = pd.Series([b.cds_len for b in bed_genes],
                               index=[b.gene_name for b in bed_genes])
 
@@ -27,7 +22,7 @@ def simulate_indel_counts(indel_df, bed_dict,
     indel_lens = indel_df['indel len'].copy().values
     is_fs = (indel_lens % 3) > 0
     indel_ixs = np.arange(len(indel_lens))
-    prng = np.random.RandomState(seed=seed)
+    prng = np.random.default_rng(utils.seed_sequence(seed, 'indel counts'))
 
     # randomly reassign indels
     mygene_cts = prng.multinomial(len(indel_lens), gene_prob, size=num_permutations)
@@ -57,11 +52,6 @@ def simulate_indel_maf(indel_df, bed_dict,
     bed_genes = [mybed
                 for chrom in bed_dict
                 for mybed in bed_dict[chrom]]
-    tmp = []
-    for b in bed_genes:
-        b.init_genome_coordinates()
-        tmp.append(b)
-    bed_genes = tmp
     gene_lengths = pd.Series([b.cds_len for b in bed_genes],
                                 index=[b.gene_name for b in bed_genes])
 
@@ -70,7 +60,8 @@ def simulate_indel_maf(indel_df, bed_dict,
     indel_lens = indel_df['indel len'].copy().values
     indel_types = indel_df['indel type'].copy().values
     indel_ixs = np.arange(len(indel_lens))
-    prng = np.random.RandomState(seed=seed)
+    seed_seq = utils.seed_sequence(seed, 'indel maf')
+    prng = np.random.default_rng(seed_seq)
 
     for i in range(num_permutations):
         # randomly reassign indels
@@ -88,18 +79,20 @@ def simulate_indel_maf(indel_df, bed_dict,
             prev_indel_ix = indel_ix
             num_gene_indels = mygene_cts[nonzero_ix[j]]
             indel_ix += num_gene_indels
+            gene_bed = bed_genes[nonzero_ix[j]]
             maf_lines = counts2maf(num_gene_indels,
                                    indel_lens[prev_indel_ix:indel_ix],
                                    indel_types[prev_indel_ix:indel_ix],
-                                   bed_genes[nonzero_ix[j]])
+                                   gene_bed,
+                                   seed=utils.seed_sequence(seed_seq, i, gene_bed.gene_name))
             yield maf_lines
 
 
 def counts2maf(num_indels, myindel_lens, myindel_types, gene_bed, seed=None):
     maf_list = []
-    prng = np.random.RandomState(seed=seed)
-    pos = prng.randint(low=0, high=gene_bed.cds_len, size=num_indels)
-    genome_pos = [gene_bed.seqpos2genome[p] for p in pos]
+    prng = np.random.default_rng(seed)
+    pos = prng.integers(low=0, high=gene_bed.cds_len, size=num_indels)
+    genome_pos = gene_bed.seqpos_to_genome(pos).tolist()
     is_frame_shift = myindel_lens%3
     for i, gpos in enumerate(genome_pos):
         if myindel_types[i] == 'INS':
@@ -122,6 +115,31 @@ def counts2maf(num_indels, myindel_lens, myindel_types, gene_bed, seed=None):
     return maf_list
 
 
+def unmapped_indels(indel_df, gene_bed):
+    """Finds indels which do not map to the reference transcript of a gene.
+
+    An indel maps to the reference transcript if either its start or end
+    position falls within the coding region or splice sites.
+
+    Parameters
+    ----------
+    indel_df : pd.DataFrame
+        indels in a single gene, containing the Chromosome, Start_Position
+        and End_Position columns
+    gene_bed : BedLine
+        BED line of the gene
+
+    Returns
+    -------
+    is_unmapped : np.array
+        1 for indels not mapping to the reference transcript, else 0
+    """
+    chroms = indel_df['Chromosome'].values
+    start_pos = gene_bed.query_positions(chroms, indel_df['Start_Position'].values)
+    end_pos = gene_bed.query_positions(chroms, indel_df['End_Position'].values)
+    return ((start_pos < 0) & (end_pos < 0)).astype(int)
+
+
 def compute_indel_length(fs_df):
     """Computes the indel length accounting for wether it is an insertion or
     deletion.
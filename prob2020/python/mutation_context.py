@@ -1,7 +1,9 @@
 from prob2020.python import utils
 import prob2020.python.sequence_context
+import prob2020.python.reference
 import prob2020.python.indel as indel
 from prob2020.python.gene_sequence import GeneSequence
+from prob2020.python.mutation_store import MutationStore, SharedMutationStore
 from prob2020.python.amino_acid import AminoAcid
 import prob2020.cython.cutils as cutils
 import numpy as np
@@ -52,9 +54,57 @@ def get_all_context_names(context_num):
         return trinucs
 
 
+def map_mutations(mut_info, bed, seq_context=None):
+    """Maps the mutations of a gene onto the reference transcript.
+
+    Coding positions, strand corrected alleles and, optionally, sequence
+    contexts are found for all of the gene's mutations at once.
+
+    Parameters
+    ----------
+    mut_info : pd.DataFrame
+        mutations in a single gene, containing the Chromosome,
+        Start_Position (0-based) and Tumor_Allele columns
+    bed : BedLine
+        BED line of the gene
+    seq_context : SequenceContext or None
+        if provided, add a Context column for mutations which map
+        to the reference transcript
+
+    Returns
+    -------
+    mut_info : pd.DataFrame
+        copy of the mutations with the Tumor_Allele reverse complemented
+        for genes on the - strand and a "Coding Position" column, which is
+        NA for mutations that do not map to the reference transcript
+    """
+    mut_info = mut_info.copy()
+
+    # fix nucleotide letter if gene is on - strand
+    if bed.strand == '-':
+        rc = {a: utils.rev_comp(a) for a in mut_info['Tumor_Allele'].unique()}
+        mut_info['Tumor_Allele'] = mut_info['Tumor_Allele'].map(rc)
+
+    # get coding positions
+    pos = bed.query_positions(mut_info['Chromosome'].values,
+                              mut_info['Start_Position'].values)
+    is_mapped = pos >= 0
+    mut_info['Coding Position'] = np.where(is_mapped, pos, np.nan)
+
+    # get sequence context
+    if seq_context is not None:
+        contexts = np.full(len(pos), None, dtype=object)
+        contexts[is_mapped] = seq_context.pos_contexts(pos[is_mapped])
+        mut_info['Context'] = contexts
+    return mut_info
+
+
 def compute_mutation_context(bed, gs, df, opts):
     # prepare info for running permutation test
-    gene_mut = df[df['Gene']==bed.gene_name]
+    if isinstance(df, (MutationStore, SharedMutationStore)):
+        gene_mut = df.gene_mutations(bed.gene_name)
+    else:
+        gene_mut = df[df['Gene']==bed.gene_name]
     cols = ['Chromosome', 'Start_Position', 'Reference_Allele',
             'Tumor_Allele', 'Variant_Classification', 'Protein_Change',
             'Tumor_Sample', 'Tumor_Type']
@@ -62,25 +112,19 @@ def compute_mutation_context(bed, gs, df, opts):
     gs.set_gene(bed)
 
     # get sequence context
-    if 'seed' in opts:
-        sc = prob2020.python.sequence_context.SequenceContext(gs, seed=opts['seed'])
-    else:
-        sc = prob2020.python.sequence_context.SequenceContext(gs)
+    context_index = prob2020.python.reference.get_context_index(gs.fasta,
+                                                                opts['context'],
+                                                                opts.get('context_index'))
+    seed = utils.seed_sequence(opts.get('seed'), bed.gene_name)
+    sc = prob2020.python.sequence_context.SequenceContext(gs, seed=seed,
+                                                         context_index=context_index)
 
     # count total mutations in gene
     total_mut = len(mut_info)
 
-    # fix nucleotide letter if gene is on - strand
-    if bed.strand == '-':
-        mut_info.loc[:,'Tumor_Allele'] = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
-
     # get coding positions, mutations unmapped to the reference tx will have
     # NA for a coding position
-    pos_list = []
-    for ix, row in mut_info.iterrows():
-        coding_pos = bed.query_position(bed.strand, row['Chromosome'], row['Start_Position'])
-        pos_list.append(coding_pos)
-    mut_info['Coding Position'] = pos_list
+    mut_info = map_mutations(mut_info, bed, sc)
 
     # recover mutations that could not be mapped to the reference transcript
     # for a gene before being dropped (next step)
@@ -95,7 +139,6 @@ def compute_mutation_context(bed, gs, df, opts):
             'Tumor_Sample', 'Tumor_Type']
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
 
         # group mutations by context
         unmapped_mut_df = pd.DataFrame(unmapped_mut_info)
@@ -353,7 +396,7 @@ def is_nonsilent(mut_df, bed_dict, opts):
                  for b in bed_dict[chrom]]
 
     # initiate gene sequences
-    gene_fa = pysam.Fastafile(opts['input'])
+    gene_fa = prob2020.python.reference.open_gene_fasta(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
 
     # non-silent SNV classes
@@ -364,12 +407,12 @@ def is_nonsilent(mut_df, bed_dict, opts):
     mut_df['is_nonsilent'] = 0
     indel_flag = indel.is_indel_annotation(mut_df)
     mut_df.loc[indel_flag, 'is_nonsilent'] = 1
-    snv_df = mut_df[~indel_flag]
+    snv_store = MutationStore(mut_df[~indel_flag])
 
     # iterate over each gene
     for bed in gene_beds:
         # initiate for this gene
-        tmp_df = snv_df[snv_df['Gene']==bed.gene_name]
+        tmp_df = snv_store.gene_mutations(bed.gene_name)
         gs.set_gene(bed)
 
         # compute context counts and somatic bases for each context
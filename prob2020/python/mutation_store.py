@@ -0,0 +1,308 @@
+"""Mutations indexed by gene.
+
+Selecting a gene's mutations with a boolean mask scans the entire mutation
+table, so looping over genes costs O(genes x mutations). The MutationStore
+groups the mutations once so that the mutations of each gene occupy a
+contiguous range of rows, which can then be sliced directly.
+
+For multiprocessing, a MutationStore can be saved as memory-mapped column
+files with MutationStore.share. Worker processes then only receive a small
+SharedMutationStore handle and read the columns through the page cache
+instead of each receiving a pickled copy of the mutations.
+"""
+import numpy as np
+import pandas as pd
+import os
+import atexit
+import shutil
+import tempfile
+
+# columns with few distinct values that are stored as categoricals
+CATEGORICAL_COLS = ['Gene', 'Chromosome', 'Reference_Allele',
+                    'Tumor_Allele', 'Variant_Classification']
+
+
+class MutationStore(object):
+    """Mutations grouped so that each gene's rows are contiguous.
+
+    Mutations within a gene keep their original order, so slicing a gene
+    returns the same rows as mut_df[mut_df['Gene']==gene].
+
+    Parameters
+    ----------
+    mut_df : pd.DataFrame
+        mutations containing a Gene column
+    categorical_cols : list of str
+        columns to convert to a categorical dtype (if present)
+
+    Attributes
+    ----------
+    df : pd.DataFrame
+        mutations sorted by gene
+    gene2range : dict
+        maps a gene name to the (start, end) rows of its mutations in df
+    """
+
+    def __init__(self, mut_df, categorical_cols=CATEGORICAL_COLS):
+        # stable sort keeps the order of mutations within each gene
+        gene_codes, genes = pd.factorize(mut_df['Gene'])
+        order = np.argsort(gene_codes, kind='stable')
+        order = order[gene_codes[order] >= 0]  # drop missing gene names
+        df = mut_df.iloc[order].copy()
+        for col in categorical_cols:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        self.df = df
+
+        # contiguous range of rows for each gene
+        counts = np.bincount(gene_codes[order], minlength=len(genes))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.gene2range = {g: (int(offsets[i]), int(offsets[i+1]))
+                           for i, g in enumerate(genes)}
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def columns(self):
+        """Names of the mutation columns."""
+        return list(self.df.columns)
+
+    def column(self, col):
+        """Returns a column for all mutations in the store."""
+        return self.df[col]
+
+    def __contains__(self, gene):
+        return gene in self.gene2range
+
+    @property
+    def genes(self):
+        """Names of genes with at least one mutation."""
+        return list(self.gene2range.keys())
+
+    def gene_mutations(self, gene, cols=None):
+        """Gets the mutations of a single gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+        cols : list of str or None
+            columns to return, all columns if None
+
+        Returns
+        -------
+        gene_df : pd.DataFrame
+            mutations in the gene (empty if the gene has no mutations)
+        """
+        start, end = self.gene2range.get(gene, (0, 0))
+        gene_df = self.df.iloc[start:end]
+        if cols is not None:
+            gene_df = gene_df[cols]
+        return gene_df
+
+    def subset(self, genes):
+        """Creates a MutationStore containing only the given genes.
+
+        Parameters
+        ----------
+        genes : list of str
+            gene names to keep
+
+        Returns
+        -------
+        mut_store : MutationStore
+            mutations for the genes, e.g. to send to a worker process
+        """
+        ranges = [self.gene2range[g] for g in genes if g in self.gene2range]
+        if ranges:
+            rows = np.concatenate([np.arange(s, e) for s, e in ranges])
+        else:
+            rows = np.zeros(0, dtype=int)
+        return MutationStore(self.df.iloc[rows], categorical_cols=[])
+
+    def share(self, path=None):
+        """Saves the mutations as memory-mapped column files.
+
+        Columns of strings are saved as integer codes along with the
+        distinct values, so that every file can be memory mapped.
+
+        Parameters
+        ----------
+        path : str or None
+            directory to save the columns, a temporary directory is
+            created if None
+
+        Returns
+        -------
+        shared_store : SharedMutationStore
+            handle to the saved mutations which is cheap to pickle
+        """
+        if path is None:
+            path = tempfile.mkdtemp(prefix='prob2020_mutations_')
+            # make sure temporary files are removed, even after errors
+            atexit.register(shutil.rmtree, path, True)
+        elif not os.path.exists(path):
+            os.makedirs(path)
+
+        columns = []
+        for i, col in enumerate(self.df.columns):
+            values = self.df[col]
+            if values.dtype.name == 'category':
+                kind = 'category'
+                codes, uniq = values.cat.codes.values, values.cat.categories
+            elif values.dtype == object:
+                kind = 'object'
+                codes, uniq = pd.factorize(values)
+            else:
+                kind = 'array'
+                np.save(os.path.join(path, 'col{0}.npy'.format(i)), values.values)
+                columns.append((col, kind))
+                continue
+            np.save(os.path.join(path, 'col{0}.npy'.format(i)), codes)
+            uniq = np.asarray(uniq)
+            if uniq.dtype == object:
+                # strings are memory mappable as fixed width unicode
+                if all(isinstance(u, str) for u in uniq):
+                    uniq = uniq.astype(str)
+            np.save(os.path.join(path, 'uniq{0}.npy'.format(i)), uniq)
+            columns.append((col, kind))
+
+        # keep integer row labels, e.g. to assign results to the input
+        if self.df.index.dtype.kind in 'iu':
+            np.save(os.path.join(path, 'index.npy'), self.df.index.values)
+        return SharedMutationStore(path, columns, dict(self.gene2range))
+
+
+class SharedMutationStore(object):
+    """Handle to the memory-mapped columns saved by MutationStore.share.
+
+    SharedMutationStore has the same interface for reading mutations as
+    MutationStore. Pickling the handle only copies the directory, column
+    names and the row ranges of its genes; the columns are memory mapped
+    the first time they are read within a process.
+
+    Parameters
+    ----------
+    path : str
+        directory containing the column files
+    columns : list of tuple
+        (name, kind) of each column
+    gene2range : dict
+        maps a gene name to the (start, end) rows of its mutations
+    """
+
+    def __init__(self, path, columns, gene2range):
+        self.path = path
+        self._columns = columns
+        self.gene2range = gene2range
+        self._arrays = {}
+
+    def __getstate__(self):
+        # memory maps are re-opened by each process
+        return {'path': self.path, '_columns': self._columns,
+                'gene2range': self.gene2range}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._arrays = {}
+
+    def __len__(self):
+        return sum(end - start for start, end in self.gene2range.values())
+
+    def __contains__(self, gene):
+        return gene in self.gene2range
+
+    @property
+    def genes(self):
+        """Names of genes with at least one mutation."""
+        return list(self.gene2range.keys())
+
+    @property
+    def columns(self):
+        """Names of the mutation columns."""
+        return [col for col, kind in self._columns]
+
+    def _load(self, name):
+        """Memory maps a saved array (once per process)."""
+        if name not in self._arrays:
+            file_path = os.path.join(self.path, name + '.npy')
+            try:
+                self._arrays[name] = np.load(file_path, mmap_mode='r')
+            except ValueError:
+                # object arrays can not be memory mapped
+                self._arrays[name] = np.load(file_path, allow_pickle=True)
+        return self._arrays[name]
+
+    def _read_column(self, i, start, end):
+        """Reads rows start to end of the i-th column."""
+        col, kind = self._columns[i]
+        values = self._load('col{0}'.format(i))[start:end]
+        if kind == 'array':
+            return np.array(values)
+        uniq_name = 'uniq{0}'.format(i)
+        if uniq_name + '_index' not in self._arrays:
+            self._arrays[uniq_name + '_index'] = pd.Index(self._load(uniq_name))
+        categories = self._arrays[uniq_name + '_index']
+        values = pd.Categorical.from_codes(np.asarray(values), categories=categories)
+        if kind == 'object':
+            values = np.asarray(values, dtype=object)
+        return values
+
+    def gene_mutations(self, gene, cols=None):
+        """Gets the mutations of a single gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+        cols : list of str or None
+            columns to return, all columns if None
+
+        Returns
+        -------
+        gene_df : pd.DataFrame
+            mutations in the gene (empty if the gene has no mutations)
+        """
+        start, end = self.gene2range.get(gene, (0, 0))
+        return self._read_rows(start, end, cols)
+
+    def _read_rows(self, start, end, cols=None):
+        """Reads a range of rows into a DataFrame."""
+        if cols is None:
+            cols = self.columns
+        col2ix = {col: i for i, (col, kind) in enumerate(self._columns)}
+        data = {col: self._read_column(col2ix[col], start, end) for col in cols}
+        if os.path.exists(os.path.join(self.path, 'index.npy')):
+            index = np.array(self._load('index')[start:end])
+        else:
+            index = None
+        return pd.DataFrame(data, index=index, columns=cols)
+
+    def column(self, col):
+        """Returns a column for all mutations of the genes in the store."""
+        ranges = sorted(self.gene2range.values())
+        if not ranges:
+            return self._read_rows(0, 0, [col])[col]
+        return pd.concat([self._read_rows(s, e, [col])[col] for s, e in ranges])
+
+    def subset(self, genes):
+        """Creates a handle containing only the given genes.
+
+        Parameters
+        ----------
+        genes : list of str
+            gene names to keep
+
+        Returns
+        -------
+        shared_store : SharedMutationStore
+            handle for the genes, sharing the same column files
+        """
+        gene2range = {g: self.gene2range[g] for g in genes if g in self.gene2range}
+        return SharedMutationStore(self.path, self._columns, gene2range)
+
+    def close(self):
+        """Removes the column files."""
+        self._arrays = {}
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -4,6 +4,9 @@ import prob2020.python.permutation as pm
 import prob2020.cython.cutils as cutils
 import prob2020.python.utils as utils
 import prob2020.python.scores as scores
+import prob2020.python.exact as exact
+import prob2020.python.gene_effect_table as ge
+import prob2020.python.tail_fit as tf
 
 # external imports
 import numpy as np
@@ -61,6 +64,32 @@ def bh_fdr(pval):
     return pval_adj[original_order]
 
 
+def screen_candidates(pval_lower, fdr):
+    """Finds genes which could be significant with more simulations.
+
+    The BH q-values are computed from the lower confidence bound of each
+    p-value, which gives the smallest q-values consistent with the
+    simulations performed so far.
+
+    Parameters
+    ----------
+    pval_lower : np.array
+        lower confidence bound of the p-values estimated from a low number
+        of simulations, NaN if untested
+    fdr : float
+        false discovery rate threshold
+
+    Returns
+    -------
+    is_candidate : np.array
+        whether each p-value could reach the fdr threshold
+    """
+    pval_lower = np.nan_to_num(np.asarray(pval_lower, dtype=float), nan=1.0)
+    if not len(pval_lower):
+        return np.zeros(0, dtype=bool)
+    return bh_fdr(pval_lower) <= fdr
+
+
 def calc_deleterious_p_value(mut_info,
                              unmapped_mut_info,
                              sc,
@@ -70,10 +99,18 @@ def calc_deleterious_p_value(mut_info,
                              stop_thresh,
                              del_threshold,
                              pseudo_count,
-                             seed=None):
+                             seed=None,
+                             use_exact=False,
+                             return_null_counts=False,
+                             max_memory=None,
+                             stop_alpha=None,
+                             tail_fit=False,
+                             p_value_ci=False,
+                             prev_null_counts=None):
     """Calculates the p-value for the number of inactivating SNV mutations.
 
-    Calculates p-value based on how many simulations exceed the observed value.
+    Calculates p-value based on how many simulations exceed the observed value,
+    or exactly from the Poisson-binomial null distribution if use_exact is set.
 
     Parameters
     ----------
@@ -97,13 +134,42 @@ def calc_deleterious_p_value(mut_info,
     num_permutations : int
         number of permutations to perform to estimate p-value. more permutations
         means more precision on the p-value.
-    seed : int (Default: None)
-        seed number to random number generator (None to be randomly set)
+    use_exact : bool (Default: False)
+        compute the p-value exactly instead of by simulations
+    return_null_counts : bool (Default: False)
+        leave the p-value as None and also return the null distribution
+        tallies (None if no simulations were performed), e.g. to continue
+        the simulations in another chunk (see chunk_p_values)
+    max_memory : int or None (Default: None)
+        memory budget in bytes for the simulations
+    stop_alpha : float or None (Default: None)
+        stop simulations once the p-value is confidently above this
+        significance level
+    tail_fit : bool (Default: False)
+        extrapolate small p-values from the tail of the null distribution
+        and add the confidence interval of the p-value to the result
+    p_value_ci : bool (Default: False)
+        add the confidence interval of the p-value to the result
+    prev_null_counts : dict or None (Default: None)
+        null distribution tallies of the previous chunks of simulations
+        to continue from
+
+    Returns
+    -------
+    result : list
+        gene name, number of inactivating mutations, p-value and the
+        number of simulations performed (followed by the lower and upper
+        confidence bound of the p-value if tail_fit or p_value_ci is set)
     """
     #prng = np.random.RandomState(seed)
+    null_counts = None
+    num_iter = 0
+    del_ci_low, del_ci_high = None, None
+    tail_size = tf.TAIL_SIZE if tail_fit else None
+    report_ci = tail_fit or p_value_ci
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        mut_info['Context'] = sc.pos_contexts(mut_info['Coding Position'].values)
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -125,23 +191,46 @@ def calc_deleterious_p_value(mut_info,
 
         # skip permutation test if number of deleterious mutations is not at
         # least meet some user-specified threshold
-        if num_del >= del_threshold:
+        if num_del >= del_threshold and use_exact:
+            # compute p-value without simulations
+            del_p_value = exact.deleterious_exact(num_del,
+                                                  context_cts,
+                                                  context_to_mutations,
+                                                  sc,  # sequence context obj
+                                                  gs)  # gene sequence obj
+        elif num_del >= del_threshold:
             # perform permutations
-            del_p_value = pm.deleterious_permutation(num_del,
+            null_counts = pm.deleterious_permutation(num_del,
                                                      context_cts,
                                                      context_to_mutations,
                                                      sc,  # sequence context obj
                                                      gs,  # gene sequence obj
                                                      num_permutations,
                                                      stop_thresh,
-                                                     pseudo_count)
+                                                     pseudo_count,
+                                                     return_null_counts=True,
+                                                     max_memory=max_memory,
+                                                     stop_alpha=stop_alpha,
+                                                     tail_size=tail_size,
+                                                     prev_null_counts=prev_null_counts)
+            num_iter = null_counts['num_sim']
+            if return_null_counts:
+                del_p_value = None
+            elif report_ci:
+                del_p_value, del_ci_low, del_ci_high = pm.deleterious_p_value_ci(num_del, null_counts)
+            else:
+                del_p_value = pm.deleterious_p_value(null_counts)
         else:
             del_p_value = None
     else:
         num_del = 0
         del_p_value = None
 
-    result = [bed.gene_name, num_del, del_p_value]
+    result = [bed.gene_name, num_del, del_p_value, num_iter]
+    if report_ci:
+        result += [del_ci_low, del_ci_high]
+    if return_null_counts:
+        return result, null_counts
     return result
 
 
@@ -155,10 +244,21 @@ def calc_position_p_value(mut_info,
                           stop_thresh,
                           pseudo_count,
                           min_recurrent,
-                          min_fraction):
+                          min_fraction,
+                          return_null_counts=False,
+                          max_memory=None,
+                          stop_alpha=None,
+                          tail_fit=False,
+                          p_value_ci=False,
+                          prev_null_counts=None):
+    null_counts = None
+    num_iter = 0
+    pval_cis = [None] * 4
+    tail_size = tf.TAIL_SIZE if tail_fit else None
+    report_ci = tail_fit or p_value_ci
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        mut_info['Context'] = sc.pos_contexts(mut_info['Coding Position'].values)
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -170,7 +270,8 @@ def calc_position_p_value(mut_info,
 
         # get vest scores for gene if directory provided
         if score_dir:
-            gene_vest = scores.read_vest_pickle(bed.gene_name, score_dir)
+            num_codons = bed.cds_len // 3 + 1
+            gene_vest = scores.read_vest_array(bed.gene_name, score_dir, num_codons)
             if gene_vest is None:
                 logger.warning('Could not find VEST scores for {0}, skipping . . .'.format(bed.gene_name))
         else:
@@ -189,23 +290,39 @@ def calc_position_p_value(mut_info,
                                                                      min_frac=min_fraction,
                                                                      min_recur=min_recurrent)
         # get vest score for actual mutations
-        vest_score = scores.compute_vest_stat(gene_vest,
-                                              aa_mut_info['Reference AA'],
-                                              aa_mut_info['Somatic AA'],
-                                              aa_mut_info['Codon Pos'])
+        obs_codon_pos = np.array([[(c if c is not None else ge.NA)
+                                   for c in aa_mut_info['Codon Pos']]], dtype=int)
+        vest_score = scores.compute_vest_stat_batch(gene_vest,
+                                                    ge.encode_aa(aa_mut_info['Reference AA'])[None, :],
+                                                    ge.encode_aa(aa_mut_info['Somatic AA'])[None, :],
+                                                    obs_codon_pos)[0]
+        vest_score = float(vest_score)
 
         # perform simulations to get p-value
         observed_stats = (num_recurrent, pos_ent, delta_pos_ent, vest_score)
-        permutation_result = pm.position_permutation(observed_stats,
-                                                     context_cts,
-                                                     context_to_mutations,
-                                                     sc,  # sequence context obj
-                                                     gs,  # gene sequence obj
-                                                     gene_vest,
-                                                     num_permutations,
-                                                     stop_thresh,
-                                                     pseudo_count)
-        ent_p_value, vest_p_value = permutation_result
+        null_counts = pm.position_permutation(observed_stats,
+                                              context_cts,
+                                              context_to_mutations,
+                                              sc,  # sequence context obj
+                                              gs,  # gene sequence obj
+                                              gene_vest,
+                                              num_permutations,
+                                              stop_thresh,
+                                              pseudo_count,
+                                              return_null_counts=True,
+                                              max_memory=max_memory,
+                                              stop_alpha=stop_alpha,
+                                              tail_size=tail_size,
+                                              prev_null_counts=prev_null_counts)
+        num_iter = null_counts['num_sim']
+        if return_null_counts:
+            ent_p_value, vest_p_value = None, None
+        elif report_ci:
+            ent_pval_ci, vest_pval_ci = pm.position_p_value_cis(observed_stats, null_counts)
+            ent_p_value, vest_p_value = ent_pval_ci[0], vest_pval_ci[0]
+            pval_cis = list(ent_pval_ci[1:]) + list(vest_pval_ci[1:])
+        else:
+            ent_p_value, vest_p_value = pm.position_p_values(null_counts)
     else:
         num_recurrent = 0
         pos_ent = 0
@@ -213,7 +330,11 @@ def calc_position_p_value(mut_info,
         ent_p_value = 1.0
         vest_p_value = 1.0
     result = [bed.gene_name, num_recurrent, pos_ent, vest_score,
-              ent_p_value, vest_p_value]
+              ent_p_value, vest_p_value, num_iter]
+    if report_ci:
+        result += pval_cis
+    if return_null_counts:
+        return result, null_counts
     return result
 
 
@@ -226,10 +347,18 @@ def calc_hotmaps_p_value(mut_info,
                          num_permutations,
                          stop_thresh,
                          report_index=False,
-                         null_save_path=None):
+                         null_save_path=None,
+                         return_null_counts=False,
+                         max_memory=None,
+                         stop_alpha=None,
+                         tail_fit=False,
+                         p_value_ci=False,
+                         prev_null_counts=None):
+    null_counts = None
+    report_ci = tail_fit or p_value_ci
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        mut_info['Context'] = sc.pos_contexts(mut_info['Coding Position'].values)
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -253,7 +382,7 @@ def calc_hotmaps_p_value(mut_info,
 
         # no missense mutations
         if not pos_ct:
-            return []
+            return ([], null_counts) if return_null_counts else []
 
         # in case the index in the original mutation data frame is needed
         if report_index:
@@ -261,30 +390,128 @@ def calc_hotmaps_p_value(mut_info,
             pos2ix = mut_info.groupby('Codon Pos').groups
 
         # perform simulations to get p-value
-        pval_dict = pm.hotmaps_permutation(window_sum_dict,
-                                           context_cts,
-                                           context_to_mutations,
-                                           sc,  # sequence context obj
-                                           gs,  # gene sequence obj
-                                           window_size,
-                                           num_permutations,
-                                           stop_thresh,
-                                           null_save_path=null_save_path)
+        null_counts = pm.hotmaps_permutation(window_sum_dict,
+                                             context_cts,
+                                             context_to_mutations,
+                                             sc,  # sequence context obj
+                                             gs,  # gene sequence obj
+                                             window_size,
+                                             num_permutations,
+                                             stop_thresh,
+                                             return_null_counts=True,
+                                             max_memory=max_memory,
+                                             stop_alpha=stop_alpha,
+                                             prev_null_counts=prev_null_counts)
+        num_iter = null_counts['num_iter']
+        pval_cis = {w: {k: (None, None, None) for k in window_sum_dict[w]}
+                    for w in window_sum_dict}
+        if return_null_counts:
+            pval_dict = {w: {k: None for k in window_sum_dict[w]}
+                         for w in window_sum_dict}
+        else:
+            pval_dict = pm.hotmaps_p_values(window_sum_dict, null_counts, null_save_path)
+            if report_ci:
+                pval_cis = pm.hotmaps_p_value_cis(window_sum_dict, null_counts,
+                                                  use_tail=tail_fit)
+                pval_dict = {w: {k: pval_cis[w][k][0] for k in pval_cis[w]}
+                             for w in pval_cis}
 
         # prepare output
         # NOTE: internally codon positions start at 0, so add 1 for the output
         # to the user.
         if not report_index:
-            result = [[bed.gene_name, mywin, k+1, pos_ct[k], window_sum_dict[mywin][k], pval_dict[mywin][k]]
+            result = [[bed.gene_name, mywin, k+1, pos_ct[k], window_sum_dict[mywin][k], pval_dict[mywin][k], num_iter]
                       for mywin in window_sum_dict
                       for k in window_sum_dict[mywin]]
         else:
-            result = [[bed.gene_name, mywin, k+1, pos2ix[k][0], pos_ct[k], window_sum_dict[mywin][k], pval_dict[mywin][k]]
+            result = [[bed.gene_name, mywin, k+1, pos2ix[k][0], pos_ct[k], window_sum_dict[mywin][k], pval_dict[mywin][k], num_iter]
                       for mywin in window_sum_dict
                       for k in window_sum_dict[mywin]]
+        if report_ci:
+            # confidence intervals in the same order as the rows
+            ci_list = [pval_cis[mywin][k][1:]
+                       for mywin in window_sum_dict
+                       for k in window_sum_dict[mywin]]
+            for row, ci in zip(result, ci_list):
+                row.extend(ci)
 
     else:
         result = []
+    if return_null_counts:
+        return result, null_counts
+    return result
+
+
+def chunk_p_values(kind, result, null_counts, null_save_path=None,
+                   tail_fit=False, p_value_ci=False):
+    """Calculates the p-values of a gene whose simulations were split into
+    chunks, e.g. to run a large gene on several processes.
+
+    Each chunk continues from the null distribution tallies of the previous
+    chunks, so the tallies of the last chunk cover all simulations.
+
+    Parameters
+    ----------
+    kind : str
+        kind of test, either oncogene, tsg or hotmaps1d
+    result : list
+        result of the last chunk, as returned by the calc_*_p_value
+        functions with return_null_counts set
+    null_counts : dict or None
+        null distribution tallies of the last chunk, None if no simulations
+        were performed
+    null_save_path : str or None
+        File path to save the hotmaps null distribution. If None, don't save it.
+    tail_fit : bool
+        extrapolate small p-values from the tail of the null distribution
+    p_value_ci : bool
+        the chunk results contain the confidence interval columns (always
+        the case with tail_fit)
+
+    Returns
+    -------
+    result : list
+        result of the gene with the p-values from all chunks
+    """
+    if null_counts is None:
+        # no simulations were performed
+        return result
+    report_ci = tail_fit or p_value_ci
+
+    if kind == 'oncogene':
+        if report_ci:
+            # the delta entropy is not used for p-values
+            obs_stat = (result[1], result[2], 0, result[3])
+            ent_pval_ci, vest_pval_ci = pm.position_p_value_cis(obs_stat, null_counts)
+            result[4:6] = ent_pval_ci[0], vest_pval_ci[0]
+            result[7:11] = list(ent_pval_ci[1:]) + list(vest_pval_ci[1:])
+        else:
+            result[4:6] = pm.position_p_values(null_counts)
+        result[6] = null_counts['num_sim']
+    elif kind == 'tsg':
+        if report_ci:
+            result[2], result[4], result[5] = pm.deleterious_p_value_ci(result[1], null_counts)
+        else:
+            result[2] = pm.deleterious_p_value(null_counts)
+        result[3] = null_counts['num_sim']
+    elif kind == 'hotmaps1d':
+        # rows contain the window, codon position (starting at 1), windowed
+        # sum, p-value and number of simulations (followed by the confidence
+        # interval of the p-value if reported)
+        offset = 2 if report_ci else 0
+        obs_stat = {}
+        for row in result:
+            obs_stat.setdefault(row[1], {})[row[2]-1] = row[-3-offset]
+        pval_dict = pm.hotmaps_p_values(obs_stat, null_counts, null_save_path)
+        if report_ci:
+            pval_cis = pm.hotmaps_p_value_cis(obs_stat, null_counts, use_tail=tail_fit)
+        for row in result:
+            row[-2-offset] = pval_dict[row[1]][row[2]-1]
+            row[-1-offset] = null_counts['num_iter']
+            if report_ci:
+                pval_ci = pval_cis[row[1]][row[2]-1]
+                row[-4] = pval_ci[0]
+                row[-2:] = pval_ci[1:]
     return result
 
 
@@ -297,7 +524,8 @@ def calc_protein_p_value(mut_info,
                          num_permutations,
                          stop_thresh,
                          min_recurrent,
-                         min_fraction):
+                         min_fraction,
+                         max_memory=None):
     """Computes the p-value for clustering on a neighbor graph composed
     of codons connected with edges if they are spatially near in 3D protein
     structure.
@@ -312,7 +540,7 @@ def calc_protein_p_value(mut_info,
     """
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        mut_info['Context'] = sc.pos_contexts(mut_info['Coding Position'].values)
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -343,8 +571,9 @@ def calc_protein_p_value(mut_info,
                                                                              min_frac=min_fraction,
                                                                              min_recur=min_recurrent)
         try:
-            # get vest score for actual mutations
-            graph_score, coverage = scores.compute_ng_stat(gene_graph, pos_ct)
+            # get graph score for actual mutations
+            graph_matrix = scores.neighbor_graph_matrix(gene_graph)
+            graph_score, coverage = scores.compute_ng_stat(graph_matrix, pos_ct)
 
             # perform simulations to get p-value
             protein_p_value, norm_graph_score = pm.protein_permutation(
@@ -352,7 +581,8 @@ def calc_protein_p_value(mut_info,
                 context_to_mutations,
                 sc,  # sequence context obj
                 gs,  # gene sequence obj
-                gene_graph, num_permutations, stop_thresh
+                graph_matrix, num_permutations, stop_thresh,
+                max_memory=max_memory
             )
         except Exception as err:
             exc_info = sys.exc_info()
@@ -377,10 +607,15 @@ def calc_effect_p_value(mut_info,
                         num_permutations,
                         pseudo_count,
                         min_recurrent,
-                        min_fraction):
+                        min_fraction,
+                        max_memory=None,
+                        stop_thresh=100,
+                        stop_alpha=None,
+                        p_value_ci=False):
+    ent_ci_low, ent_ci_high = None, None
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        mut_info['Context'] = sc.pos_contexts(mut_info['Coding Position'].values)
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -390,15 +625,6 @@ def calc_effect_p_value(mut_info,
         context_to_mutations = dict((name, group['Tumor_Allele'])
                                     for name, group in tmp_df.groupby('Context'))
 
-        # perform permutations
-        permutation_result = pm.effect_permutation(context_cts,
-                                                   context_to_mutations,
-                                                   sc,  # sequence context obj
-                                                   gs,  # gene sequence obj
-                                                   num_permutations,
-                                                   pseudo_count)
-        effect_entropy_list, recur_list, inactivating_list = permutation_result  # unpack results
-
         # get effect info for actual mutations
         aa_mut_info = mc.get_aa_mut_info(mut_info['Coding Position'],
                                          mut_info['Tumor_Allele'].tolist(),
@@ -412,15 +638,34 @@ def calc_effect_p_value(mut_info,
                                                                           min_frac=min_fraction,
                                                                           min_recur=min_recurrent)
 
+        # perform permutations
+        permutation_result = pm.effect_permutation(context_cts,
+                                                   context_to_mutations,
+                                                   sc,  # sequence context obj
+                                                   gs,  # gene sequence obj
+                                                   num_permutations,
+                                                   pseudo_count,
+                                                   max_memory=max_memory,
+                                                   obs_ent=effect_ent,
+                                                   stop_criteria=stop_thresh,
+                                                   stop_alpha=stop_alpha)
+        effect_entropy_list, recur_list, inactivating_list = permutation_result  # unpack results
+
         # calculate permutation p-value
+        num_iter = len(effect_entropy_list)
         entropy_num_nulls = sum([1 for null_ent in effect_entropy_list
                                  if null_ent-utils.epsilon <= effect_ent])
-        ent_p_value = entropy_num_nulls / float(num_permutations)
+        ent_p_value = entropy_num_nulls / float(num_iter)
+        if p_value_ci:
+            ent_ci_low, ent_ci_high = tf.p_value_ci(-effect_ent, entropy_num_nulls, num_iter)[1:]
     else:
         num_recur = 0
         num_inactivating = 0
         effect_ent = 0
         ent_p_value = 1.0
+        num_iter = 0
     result = [bed.gene_name, num_recur, num_inactivating,
-              effect_ent, ent_p_value]
+              effect_ent, ent_p_value, num_iter]
+    if p_value_ci:
+        result += [ent_ci_low, ent_ci_high]
     return result
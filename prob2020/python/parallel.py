@@ -0,0 +1,391 @@
+"""Runs per-gene work on a persistent pool of worker processes.
+
+Work is split into batches of genes ordered by their estimated cost, so
+that large genes start first and the remaining cores are kept busy with
+small batches. The iterations of a gene with many mutations can be split
+into chunks (GeneChunk), each continuing from the null distribution
+tallies of the previous chunks. A chunk is only sent once the previous
+chunks finished without reaching the stopping rules, so the simulations
+of a gene stop at the same point as in a single chunk. The pool is created
+once; its initializer opens the gene FASTA (or compiled reference) and
+receives the data shared by all tasks, so each task only sends the BED
+lines of its genes. Results are yielded as soon as each batch finishes.
+"""
+import prob2020.python.reference as reference
+from multiprocessing import Pool
+import numpy as np
+import queue
+import sys
+
+import logging
+logger = logging.getLogger(__name__)  # module logger
+
+# number of batches per process, more batches balance the load better
+BATCHES_PER_PROCESS = 4
+
+# number of simulated mutations (iterations X mutations) in a chunk of a
+# gene's iterations, genes needing more are split into several chunks
+CHUNK_MUTATIONS = 2**25
+
+# gene FASTA handles opened in this process
+_gene_fasta = {}
+
+# function and arguments used by the tasks of a worker process
+_worker = {}
+
+
+class GeneChunk(object):
+    """Part of the iterations of a gene's permutation test.
+
+    Parameters
+    ----------
+    bed : BedLine
+        gene to process
+    index : int
+        number of the chunk, chunks run in this order
+    chunk_iterations : list of int
+        number of iterations performed by each chunk of the gene
+    null_counts : dict or None
+        null distribution tallies of the previous chunks to continue from,
+        None for the first chunk
+    """
+
+    def __init__(self, bed, index, chunk_iterations, null_counts=None):
+        self.bed = bed
+        self.index = index
+        self.chunk_iterations = chunk_iterations
+        self.num_chunks = len(chunk_iterations)
+        self.num_iterations = chunk_iterations[index]
+        self.null_counts = null_counts
+        self.gene_name = bed.gene_name
+        self.chrom = bed.chrom
+        self.cds_len = bed.cds_len
+
+
+class ChunkResult(object):
+    """Result of a GeneChunk along with the null distribution tallies of
+    the gene's simulations up to the end of the chunk."""
+
+    def __init__(self, chunk, result, null_counts):
+        self.gene_name = chunk.gene_name
+        self.chunk = chunk
+        self.result = result
+        self.null_counts = null_counts
+
+    def next_chunk(self):
+        """Returns the chunk continuing the gene's simulations, or None if
+        the simulations stopped within this chunk or it was the last one."""
+        chunk = self.chunk
+        if self.null_counts is None or chunk.index + 1 == chunk.num_chunks:
+            return None
+
+        # hotmaps counts simulations separately from null values
+        key = 'num_iter' if 'num_iter' in self.null_counts else 'num_sim'
+        prev_iter = chunk.null_counts[key] if chunk.null_counts is not None else 0
+        if self.null_counts[key] - prev_iter < chunk.num_iterations:
+            # the stopping rules were reached within the chunk
+            return None
+        return GeneChunk(chunk.bed, chunk.index+1, chunk.chunk_iterations,
+                         self.null_counts)
+
+
+def num_gene_chunks(num_mut, num_iterations):
+    """Number of chunks to split a gene's iterations into.
+
+    The number of chunks only depends on the gene and the number of
+    iterations, and not on the number of processes, so that results
+    are the same regardless of how genes are distributed.
+
+    Parameters
+    ----------
+    num_mut : int
+        number of mutations in the gene
+    num_iterations : int
+        number of iterations for the gene
+
+    Returns
+    -------
+    num_chunks : int
+        number of chunks, each with a separate random number stream
+    """
+    if not num_iterations:
+        return 1
+    num_chunks = -(-num_mut * num_iterations // CHUNK_MUTATIONS)
+    return int(max(1, min(num_chunks, num_iterations)))
+
+
+def split_genes(bed_list, mut_store, num_iterations):
+    """Replaces genes with too many simulated mutations by the first chunk
+    of their iterations.
+
+    Parameters
+    ----------
+    bed_list : list of BedLine
+        genes to process
+    mut_store : MutationStore or SharedMutationStore
+        mutations indexed by gene
+    num_iterations : int
+        number of iterations per gene
+
+    Returns
+    -------
+    split_list : list of BedLine or GeneChunk
+        genes, with large genes replaced by their first GeneChunk
+    """
+    split_list = []
+    for bed in bed_list:
+        start, end = mut_store.gene2range.get(bed.gene_name, (0, 0))
+        num_chunks = num_gene_chunks(end - start, num_iterations)
+        if num_chunks > 1:
+            chunk_iters = np.diff(np.linspace(0, num_iterations, num_chunks+1).astype(int))
+            split_list.append(GeneChunk(bed, 0, [int(n) for n in chunk_iters]))
+        else:
+            split_list.append(bed)
+    return split_list
+
+
+def collect_chunks(batch_result):
+    """Separates the results of gene chunks from the results of whole genes.
+
+    Parameters
+    ----------
+    batch_result : list
+        results returned for a batch of genes
+
+    Returns
+    -------
+    results : list
+        results of whole genes
+    complete : list of ChunkResult
+        results of the last chunks of genes whose simulations finished
+    """
+    results, complete = [], []
+    for result in batch_result:
+        if not isinstance(result, ChunkResult):
+            results.append(result)
+        elif result.next_chunk() is None:
+            complete.append(result)
+    return results, complete
+
+
+def next_chunks(batch_result):
+    """Chunks continuing the simulations of the genes in a batch result
+    which did not reach the stopping rules."""
+    chunks = [r.next_chunk() for r in batch_result if isinstance(r, ChunkResult)]
+    return [c for c in chunks if c is not None]
+
+
+def memory_per_process(opts):
+    """Memory budget in bytes of each process for simulations.
+
+    Parameters
+    ----------
+    opts : dict
+        command line options, uses the max_memory (in MB) and processes options
+
+    Returns
+    -------
+    max_memory : int or None
+        memory budget of a single process, None if no budget was specified
+    """
+    if not opts.get('max_memory'):
+        return None
+    return int(opts['max_memory'] * 2**20 // max(opts['processes'], 1))
+
+
+def open_gene_fasta(path):
+    """Opens the gene FASTA or compiled reference once per process.
+
+    Parameters
+    ----------
+    path : str
+        path to gene FASTA or compiled reference
+
+    Returns
+    -------
+    gene_fa : pysam.Fastafile or CompiledReference
+        handle shared by all genes processed in this process
+    """
+    if path not in _gene_fasta:
+        _gene_fasta[path] = reference.open_gene_fasta(path)
+    return _gene_fasta[path]
+
+
+def gene_cost(bed, mut_store):
+    """Estimates the relative cost of processing a gene, i.e. the number of
+    mutations plus a small overhead for the gene's sequence. The cost of a
+    gene is shared evenly by its chunks."""
+    if bed.gene_name not in mut_store:
+        return 0
+    start, end = mut_store.gene2range[bed.gene_name]
+    cost = (end - start) + 1 + bed.cds_len / 1000.
+    if isinstance(bed, GeneChunk):
+        cost /= bed.num_chunks
+    return cost
+
+
+def gene_batches(bed_list, mut_store, num_batches, num_iterations=None):
+    """Splits genes with mutations into batches ordered by decreasing cost.
+
+    If num_iterations is provided, genes with many mutations are replaced
+    by the first GeneChunk of their iterations (see split_genes).
+
+    Parameters
+    ----------
+    bed_list : list of BedLine
+        genes to process
+    mut_store : MutationStore or SharedMutationStore
+        mutations indexed by gene
+    num_batches : int
+        approximate number of batches to create
+    num_iterations : int or None
+        number of iterations per gene, None to never split genes into chunks
+
+    Returns
+    -------
+    batches : list of list of BedLine or GeneChunk
+        batches of genes, the most expensive batches first
+    """
+    if num_iterations is not None:
+        bed_list = split_genes(bed_list, mut_store, num_iterations)
+    costs = [(gene_cost(b, mut_store), i, b) for i, b in enumerate(bed_list)]
+    costs = sorted([c for c in costs if c[0] > 0], key=lambda x: (-x[0], x[1]))
+    if not costs:
+        return []
+    max_cost = sum(c[0] for c in costs) / float(num_batches)
+
+    # genes more expensive than the target batch cost run on their own
+    batches, batch, batch_cost = [], [], 0
+    for cost, _, bed in costs:
+        if batch and batch_cost + cost > max_cost:
+            batches.append(batch)
+            batch, batch_cost = [], 0
+        batch.append(bed)
+        batch_cost += cost
+    batches.append(batch)
+    return batches
+
+
+def _init_worker(func, args, input_path):
+    """Initializes a worker process of the pool."""
+    _worker['func'] = func
+    _worker['args'] = args
+    # handles inherited from the parent process share its file offsets
+    _gene_fasta.clear()
+    open_gene_fasta(input_path)
+
+
+def _run_batch(bed_list):
+    """Runs the worker's function on a batch of genes."""
+    return _worker['func']((bed_list,) + _worker['args'])
+
+
+def imap_genes(func, bed_list, mut_store, args, opts, split_iterations=False):
+    """Applies func to batches of genes, yielding results as they finish.
+
+    func is called with a tuple of (bed_list, mut_store) + args, the same
+    format used when running in a single process. If split_iterations is
+    set, bed_list may also contain GeneChunks for which func should return
+    a ChunkResult. The next chunk of a gene is sent once its previous chunk
+    finished without reaching the stopping rules (see next_chunks).
+
+    Parameters
+    ----------
+    func : function
+        module level function processing a list of genes
+    bed_list : list of BedLine
+        genes to process
+    mut_store : MutationStore
+        mutations indexed by gene
+    args : tuple
+        additional arguments passed to func
+    opts : dict
+        command line options, uses the processes and input options (and
+        num_iterations if split_iterations is set)
+    split_iterations : bool
+        split the iterations of genes with many mutations into chunks
+
+    Yields
+    ------
+    result
+        return value of func for each batch of genes (in order of completion)
+    """
+    num_processes = opts['processes']
+    if split_iterations:
+        batches = gene_batches(bed_list, mut_store, num_processes*BATCHES_PER_PROCESS,
+                               num_iterations=opts['num_iterations'])
+    else:
+        batches = gene_batches(bed_list, mut_store, num_processes*BATCHES_PER_PROCESS)
+    logger.info('Processing {0} genes in {1} batches using {2} processes . . .'.format(
+        len(set(b.gene_name for batch in batches for b in batch)),
+        len(batches), num_processes))
+
+    # workers read the mutations from memory-mapped files
+    shared_store = mut_store.share()
+    pool = Pool(processes=num_processes,
+                initializer=_init_worker,
+                initargs=(func, (shared_store,) + tuple(args), opts['input']))
+
+    # results (or errors) of the batches in order of completion
+    finished = queue.Queue()
+
+    def submit(batch):
+        pool.apply_async(_run_batch, (batch,),
+                         callback=finished.put,
+                         error_callback=finished.put)
+
+    try:
+        for batch in batches:
+            submit(batch)
+        num_pending = len(batches)
+        while num_pending:
+            result = finished.get()
+            num_pending -= 1
+            if isinstance(result, BaseException):
+                raise result
+
+            # continue the genes whose chunks did not reach the stopping rules
+            for chunk in next_chunks(result):
+                submit([chunk])
+                num_pending += 1
+            yield result
+    except KeyboardInterrupt:
+        logger.info('Exited by user. ctrl-c')
+        sys.exit(0)
+    finally:
+        # all results were received (or an error occurred) at this point
+        pool.terminate()
+        pool.join()
+        shared_store.close()
+
+
+def map_genes(func, bed_lists, mut_store, args):
+    """Applies func to lists of genes in this process, yielding results as
+    they finish.
+
+    The next chunks of the genes of a list run right after it (see
+    imap_genes).
+
+    Parameters
+    ----------
+    func : function
+        function processing a list of genes
+    bed_lists : list of list of BedLine or GeneChunk
+        lists of genes to process
+    mut_store : MutationStore
+        mutations indexed by gene
+    args : tuple
+        additional arguments passed to func
+
+    Yields
+    ------
+    result
+        return value of func for each list of genes
+    """
+    pending = list(bed_lists)
+    while pending:
+        result = func((pending.pop(0), mut_store) + tuple(args))
+        chunks = next_chunks(result)
+        if chunks:
+            pending.insert(0, chunks)
+        yield result
@@ -2,8 +2,156 @@ import numpy as np
 import csv
 import prob2020.python.utils as utils
 from ..cython import cutils
-import prob2020.python.mutation_context as mc
 import prob2020.python.scores as scores
+from prob2020.python.gene_effect_table import GeneEffectTable
+import prob2020.python.gene_effect_table as ge
+import prob2020.python.tail_fit as tail_fit
+
+# maximum number of elements in a simulations X protein length matrix
+MAX_WINDOW_ELEMENTS = 2**22
+
+# estimated bytes of memory per simulated mutation in a batch of simulations,
+# covering the random positions, their effects and temporary arrays
+BYTES_PER_MUTATION = 64
+
+# simulations in the first batch of tests with early stopping, later
+# batches grow by BATCH_GROWTH up to the maximum batch size
+FIRST_BATCH = 200
+BATCH_GROWTH = 4
+
+# the sequential probability ratio test for futility compares a p-value
+# equal to the significance level against one FUTILITY_RATIO times larger,
+# stopping a gene whose p-value equals the significance level with a
+# probability of about FUTILITY_ERROR
+FUTILITY_RATIO = 2.
+FUTILITY_ERROR = 1e-3
+
+
+def memory_batch_size(num_mut, max_memory=None, max_batch=25000):
+    """Calculates the number of simulations per batch for a gene.
+
+    Parameters
+    ----------
+    num_mut : int
+        number of mutations simulated in the gene
+    max_memory : int or None
+        memory budget in bytes of a single process, None to use max_batch
+    max_batch : int
+        number of simulations per batch without a memory budget
+
+    Returns
+    -------
+    max_batch : int
+        maximum number of simulations per batch
+    """
+    if not max_memory:
+        return max_batch
+    return max(1, int(max_memory // (BYTES_PER_MUTATION * max(num_mut, 1))))
+
+
+def split_batches(num_permutations, max_batch):
+    """Splits the simulations into batches of at most max_batch simulations."""
+    if not num_permutations:
+        return []
+    max_batch = min(num_permutations, max_batch)
+    num_batches = num_permutations // max_batch
+    remainder = num_permutations % max_batch
+    batch_sizes = [max_batch] * num_batches
+    if remainder:
+        batch_sizes += [remainder]
+    return batch_sizes
+
+
+def ramp_batches(num_permutations, max_batch,
+                 first_batch=FIRST_BATCH, growth=BATCH_GROWTH):
+    """Splits the simulations into batches of geometrically increasing size.
+
+    Genes reaching the stopping criteria after few simulations only pay for
+    small batches, while genes needing many simulations quickly reach
+    max_batch. Simulations beyond the stopping point are limited to the
+    current batch, i.e. at most growth times the simulations already done.
+
+    Parameters
+    ----------
+    num_permutations : int
+        total number of simulations
+    max_batch : int
+        maximum number of simulations per batch
+    first_batch : int
+        number of simulations in the first batch
+    growth : int
+        factor by which consecutive batches grow
+
+    Returns
+    -------
+    batch_sizes : list of int
+        number of simulations in each batch
+    """
+    batch_sizes = []
+    batch_size = max(1, min(first_batch, max_batch))
+    remaining = num_permutations
+    while remaining > 0:
+        batch_sizes.append(min(batch_size, remaining))
+        remaining -= batch_sizes[-1]
+        batch_size = min(batch_size * growth, max_batch)
+    return batch_sizes
+
+
+def futility_bound(num_sim, stop_alpha):
+    """Number of null values at least as extreme as the observed statistic
+    needed to conclude the p-value is above stop_alpha.
+
+    Wald's sequential probability ratio test compares p=stop_alpha against
+    p=FUTILITY_RATIO*stop_alpha. Its log-likelihood ratio is linear in the
+    number of extreme null values, so the boundary is a line in num_sim.
+
+    Parameters
+    ----------
+    num_sim : int or np.array
+        number of simulations performed
+    stop_alpha : float
+        significance level
+
+    Returns
+    -------
+    bound : float or np.array
+        minimum number of extreme null values to stop for futility
+    """
+    p0 = stop_alpha
+    p1 = min(FUTILITY_RATIO * stop_alpha, (1 + stop_alpha) / 2.)
+    log_extreme = np.log(p1 / p0)
+    log_not_extreme = np.log((1 - p0) / (1 - p1))
+    return (np.log(1. / FUTILITY_ERROR) + num_sim * log_not_extreme) / (log_extreme + log_not_extreme)
+
+
+def sequential_stop(null_cts, num_sim, stop_criteria, stop_alpha=None):
+    """Checks the stopping rules, e.g. after each simulation of a batch.
+
+    Simulations stop once stop_criteria null values are at least as extreme
+    as the observed statistic, which gives the requested precision on the
+    p-value. If stop_alpha is provided, simulations also stop once the
+    p-value is confidently above stop_alpha (see futility_bound).
+
+    Parameters
+    ----------
+    null_cts : np.array
+        cumulative number of extreme null values, e.g. after each simulation
+    num_sim : np.array or int
+        cumulative number of null values corresponding to null_cts
+    stop_criteria : int
+        number of extreme null values to stop at
+    stop_alpha : float or None
+        significance level for futility stopping, None to disable it
+
+    Returns
+    -------
+    is_done : np.array
+        whether the simulations can stop at each element of null_cts
+    """
+    is_done = null_cts >= stop_criteria
+    if stop_alpha:
+        is_done |= null_cts >= futility_bound(num_sim, stop_alpha)
+    return is_done
 
 
 def deleterious_permutation(obs_del,
@@ -14,7 +162,12 @@ def deleterious_permutation(obs_del,
                             num_permutations=10000,
                             stop_criteria=100,
                             pseudo_count=0,
-                            max_batch=25000):
+                            max_batch=25000,
+                            return_null_counts=False,
+                            max_memory=None,
+                            stop_alpha=None,
+                            tail_size=None,
+                            prev_null_counts=None):
     """Performs null-permutations for deleterious mutation statistics
     in a single gene.
 
@@ -37,65 +190,108 @@ def deleterious_permutation(obs_del,
         Pseudo-count for number of deleterious mutations for each
         permutation of the null distribution. Increasing pseudo_count
         makes the statistical test more stringent.
+    return_null_counts : bool, default: False
+        return the null distribution tallies instead of the p-value, e.g.
+        to continue the simulations in another chunk
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
+    stop_alpha : float or None
+        stop once the p-value is confidently above this significance level
+        (see sequential_stop)
+    tail_size : int or None
+        number of largest null values to keep in the null distribution
+        tallies for tail_fit, None to not keep them
+    prev_null_counts : dict or None
+        null distribution tallies of previous simulations of the gene to
+        continue from, e.g. the preceding chunks of its iterations. The
+        stopping rules then apply to all simulations of the gene.
 
     Returns
     -------
-    del_count_list : list
-        list of deleterious mutation counts under the null
+    del_pval : float
+        p-value for the number of deleterious mutations
     """
     mycontexts = context_counts.index.tolist()
     somatic_base = [base
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget,
+    # starting with small batches in case the stopping criteria is met early
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    batch_sizes = ramp_batches(num_permutations, max_batch)
+
+    # buffer re-used for the simulated positions of each batch
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
     num_sim = 0
     null_del_ct = 0
+    null_tail = np.zeros(0)
+    stop_flag = False
+    if prev_null_counts is not None:
+        num_sim = prev_null_counts['num_sim']
+        null_del_ct = prev_null_counts['deleterious']
+        if tail_size:
+            null_tail = prev_null_counts['tail']['deleterious']
+        stop_flag = bool(sequential_stop(null_del_ct, num_sim, stop_criteria, stop_alpha))
     for j, batch_size in enumerate(batch_sizes):
         # stop iterations if reached sufficient precision
-        if null_del_ct >= stop_criteria:
-            #j = j - 1
+        if stop_flag:
             break
 
         # get random positions determined by sequence context
-        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                                batch_size)
-        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
-
-        # determine result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calc deleterious mutation info
-            tmp_del_count = cutils.calc_deleterious_info(tmp_mut_info['Reference AA'],
-                                                         tmp_mut_info['Somatic AA'],
-                                                         tmp_mut_info['Codon Pos'])
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+
+        # count deleterious mutations for every simulation in the batch
+        tmp_del_count = effect_table.deleterious_count(tmp_mut_pos, base_ix)
+
+        # update empricial null distribution, stopping at the simulation
+        # which reaches sufficient precision on the p-value
+        cum_null_del_ct = null_del_ct + np.cumsum(tmp_del_count >= obs_del)
+        cum_num_sim = num_sim + np.arange(1, batch_size+1)
+        is_done = sequential_stop(cum_null_del_ct, cum_num_sim, stop_criteria, stop_alpha)
+        stop_flag = is_done.any()
+        i = np.argmax(is_done) if stop_flag else batch_size - 1
+        null_del_ct = cum_null_del_ct[i]
+        if tail_size:
+            null_tail = tail_fit.top_values(np.concatenate([null_tail, tmp_del_count[:i+1]]),
+                                            tail_size)
 
-            # update empricial null distribution
-            if tmp_del_count >= obs_del: null_del_ct += 1
-
-            # stop if reach sufficient precision on p-value
-            if null_del_ct >= stop_criteria:
-                break
         # update number of simulations
         num_sim += i + 1
 
-    #num_sim = j*max_batch + i+1
-    del_pval = float(null_del_ct) / (num_sim)
+    null_counts = {'num_sim': num_sim, 'deleterious': null_del_ct}
+    if tail_size:
+        null_counts['tail'] = {'deleterious': null_tail}
+    if return_null_counts:
+        return null_counts
+    return deleterious_p_value(null_counts)
+
 
+def deleterious_p_value(null_counts):
+    """Calculates the deleterious p-value from the null distribution tallies."""
+    #num_sim = j*max_batch + i+1
+    del_pval = float(null_counts['deleterious']) / (null_counts['num_sim'])
     return del_pval
 
 
+def deleterious_p_value_ci(obs_del, null_counts):
+    """Calculates the deleterious p-value and its confidence interval,
+    extrapolating small p-values if the tail of the null distribution
+    was kept (see tail_fit.p_value_ci)."""
+    tail = null_counts['tail']['deleterious'] if 'tail' in null_counts else None
+    # continuity correction, since the counts are integers
+    return tail_fit.p_value_ci(obs_del - .5, null_counts['deleterious'],
+                               null_counts['num_sim'], tail)
+
+
 def position_permutation(obs_stat,
                          context_counts,
                          context_to_mut,
@@ -105,7 +301,12 @@ def position_permutation(obs_stat,
                          num_permutations=10000,
                          stop_criteria=100,
                          pseudo_count=0,
-                         max_batch=25000):
+                         max_batch=25000,
+                         return_null_counts=False,
+                         max_memory=None,
+                         stop_alpha=None,
+                         tail_size=None,
+                         prev_null_counts=None):
     """Performs null-permutations for position-based mutation statistics
     in a single gene.
 
@@ -124,6 +325,8 @@ def position_permutation(obs_stat,
         identified at positions along the gene.
     gene_seq : GeneSequence
         Sequence of gene of interest
+    gene_vest : np.array or None
+        dense VEST scores for the gene from scores.read_vest_array
     num_permutations : int, default: 10000
         number of permutations to create for null
     stop_criteria : int
@@ -133,13 +336,28 @@ def position_permutation(obs_stat,
         Pseudo-count for number of recurrent missense mutations for each
         permutation for the null distribution. Increasing pseudo_count
         makes the statistical test more stringent.
+    return_null_counts : bool, default: False
+        return the null distribution tallies instead of the p-values, e.g.
+        to continue the simulations in another chunk
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
+    stop_alpha : float or None
+        stop once both p-values are either confidently above this
+        significance level or precise (see sequential_stop)
+    tail_size : int or None
+        number of largest null values to keep in the null distribution
+        tallies for tail_fit (negated for the entropy), None to not keep them
+    prev_null_counts : dict or None
+        null distribution tallies of previous simulations of the gene to
+        continue from, e.g. the preceding chunks of its iterations
 
     Returns
     -------
-    num_recur_list : list
-        list of recurrent mutation counts under the null
-    entropy_list : list
-        list of position entropy values under the null
+    ent_pval : float
+        p-value for the missense position entropy
+    vest_pval : float
+        p-value for the mean VEST score
     """
     # get contexts and somatic base
     mycontexts = context_counts.index.tolist()
@@ -147,66 +365,122 @@ def position_permutation(obs_stat,
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget,
+    # starting with small batches in case the stopping criteria is met early
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    batch_sizes = ramp_batches(num_permutations, max_batch)
+
+    # buffer re-used for the simulated positions of each batch
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
     obs_recur, obs_ent, obs_delta_ent, obs_vest = obs_stat
     num_sim = 0 # number of simulations
-    null_num_recur_ct, null_entropy_ct, null_delta_entropy_ct, null_vest_ct = 0, 0, 0, 0
+    null_entropy_ct, null_vest_ct = 0, 0
+    null_tail = {'entropy': np.zeros(0), 'vest': np.zeros(0)}
+    stop_flag = False
+    if prev_null_counts is not None:
+        num_sim = prev_null_counts['num_sim']
+        null_entropy_ct = prev_null_counts['entropy']
+        null_vest_ct = prev_null_counts['vest']
+        if tail_size:
+            null_tail = dict(prev_null_counts['tail'])
+        stop_flag = bool(sequential_stop(null_vest_ct, num_sim, stop_criteria, stop_alpha) &
+                         sequential_stop(null_entropy_ct, num_sim, stop_criteria, stop_alpha))
     for j, batch_size in enumerate(batch_sizes):
         # stop iterations if reached sufficient precision
-        if null_vest_ct >= stop_criteria and null_entropy_ct >= stop_criteria:
+        if stop_flag:
             break
 
         # get random positions determined by sequence context
-        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                                batch_size)
-        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_effects = effect_table.effects(tmp_mut_pos, base_ix)
 
         # calculate position-based statistics as a result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calculate position info
-            tmp_recur_ct, tmp_entropy, tmp_delta_entropy, _ = cutils.calc_pos_info(tmp_mut_info['Codon Pos'],
-                                                                                tmp_mut_info['Reference AA'],
-                                                                                tmp_mut_info['Somatic AA'],
-                                                                                pseudo_count=pseudo_count,
-                                                                                is_obs=0)
-            # get vest scores
-            if gene_vest:
-                tmp_vest = scores.compute_vest_stat(gene_vest,
-                                                    tmp_mut_info['Reference AA'],
-                                                    tmp_mut_info['Somatic AA'],
-                                                    tmp_mut_info['Codon Pos'])
-            else:
-                tmp_vest = 0.0
+        tmp_missense = effect_table.is_missense[tmp_mut_pos, base_ix]
+        tmp_pos_info = cutils.calc_pos_info_batch(tmp_effects['Codon Pos'],
+                                                  tmp_missense,
+                                                  pseudo_count=pseudo_count,
+                                                  is_obs=0)
+        tmp_recur_ct, tmp_entropy, tmp_delta_entropy = tmp_pos_info
+
+        # get vest scores
+        tmp_vest = scores.compute_vest_stat_batch(gene_vest,
+                                                  tmp_effects['Reference AA'],
+                                                  tmp_effects['Somatic AA'],
+                                                  tmp_effects['Codon Pos'])
+
+        # update empirical null distribution counts, stopping at the
+        # simulation which reaches sufficient precision
+        cum_null_entropy_ct = null_entropy_ct + np.cumsum(tmp_entropy-utils.epsilon <= obs_ent)
+        cum_null_vest_ct = null_vest_ct + np.cumsum(tmp_vest+utils.epsilon >= obs_vest)
+        cum_num_sim = num_sim + np.arange(1, batch_size+1)
+        is_done = (sequential_stop(cum_null_vest_ct, cum_num_sim, stop_criteria, stop_alpha) &
+                   sequential_stop(cum_null_entropy_ct, cum_num_sim, stop_criteria, stop_alpha))
+        stop_flag = is_done.any()
+        i = np.argmax(is_done) if stop_flag else batch_size - 1
+        null_entropy_ct = cum_null_entropy_ct[i]
+        null_vest_ct = cum_null_vest_ct[i]
+        if tail_size:
+            # low entropy is extreme, so the entropy is negated
+            null_tail['entropy'] = tail_fit.top_values(np.concatenate([null_tail['entropy'], -tmp_entropy[:i+1]]),
+                                                       tail_size)
+            null_tail['vest'] = tail_fit.top_values(np.concatenate([null_tail['vest'], tmp_vest[:i+1]]),
+                                                    tail_size)
 
-            # update empirical null distribution counts
-            if tmp_entropy-utils.epsilon <= obs_ent: null_entropy_ct += 1
-            if tmp_vest+utils.epsilon >= obs_vest: null_vest_ct += 1
-
-            # stop iterations if reached sufficient precision
-            if null_vest_ct >= stop_criteria and null_entropy_ct >= stop_criteria:
-                break
         # update the number of simulations
         num_sim += i+1
 
-    # calculate p-value from empirical null-distribution
-    ent_pval = float(null_entropy_ct) / (num_sim)
-    vest_pval = float(null_vest_ct) / (num_sim)
+    null_counts = {'num_sim': num_sim, 'entropy': null_entropy_ct, 'vest': null_vest_ct}
+    if tail_size:
+        null_counts['tail'] = null_tail
+    if return_null_counts:
+        return null_counts
+    return position_p_values(null_counts)
+
 
+def position_p_values(null_counts):
+    """Calculates the entropy and VEST p-values from the null distribution
+    tallies."""
+    # calculate p-value from empirical null-distribution
+    ent_pval = float(null_counts['entropy']) / (null_counts['num_sim'])
+    vest_pval = float(null_counts['vest']) / (null_counts['num_sim'])
     return ent_pval, vest_pval
 
 
+def position_p_value_cis(obs_stat, null_counts):
+    """Calculates the entropy and VEST p-values with their confidence
+    intervals, extrapolating small p-values if the tail of the null
+    distribution was kept (see tail_fit.p_value_ci).
+
+    Parameters
+    ----------
+    obs_stat : tuple, (recur ct, entropy, delta entropy, mean vest)
+        tuple containing the observed statistics
+    null_counts : dict
+        null distribution tallies from position_permutation
+
+    Returns
+    -------
+    ent_pval_ci : tuple
+        (p-value, lower, upper confidence bound) for the entropy
+    vest_pval_ci : tuple
+        (p-value, lower, upper confidence bound) for the mean VEST score
+    """
+    obs_recur, obs_ent, obs_delta_ent, obs_vest = obs_stat
+    tail = null_counts.get('tail', {})
+    ent_pval_ci = tail_fit.p_value_ci(-obs_ent, null_counts['entropy'],
+                                      null_counts['num_sim'], tail.get('entropy'))
+    vest_pval_ci = tail_fit.p_value_ci(obs_vest, null_counts['vest'],
+                                       null_counts['num_sim'], tail.get('vest'))
+    return ent_pval_ci, vest_pval_ci
+
+
 def hotmaps_permutation(obs_stat,
                         context_counts,
                         context_to_mut,
@@ -216,7 +490,11 @@ def hotmaps_permutation(obs_stat,
                         num_permutations=10000,
                         stop_criteria=100,
                         max_batch=25000,
-                        null_save_path=None):
+                        null_save_path=None,
+                        return_null_counts=False,
+                        max_memory=None,
+                        stop_alpha=None,
+                        prev_null_counts=None):
     """Performs null-permutations for position-based mutation statistics
     in a single gene.
 
@@ -250,6 +528,18 @@ def hotmaps_permutation(obs_stat,
         can get quite large.
     null_save_path : str or None
         File path to save null distribution. If None, don't save it.
+    return_null_counts : bool, default: False
+        return the null distribution tallies instead of the p-values, e.g.
+        to continue the simulations in another chunk
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
+    stop_alpha : float or None
+        stop once the p-value of the largest windowed sum is confidently
+        above this significance level (see sequential_stop)
+    prev_null_counts : dict or None
+        null distribution tallies of previous simulations of the gene to
+        continue from, e.g. the preceding chunks of its iterations
 
     Returns
     -------
@@ -262,93 +552,135 @@ def hotmaps_permutation(obs_stat,
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget,
+    # starting with small batches in case the stopping criteria is met early
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    batch_sizes = ramp_batches(num_permutations, max_batch)
+
+    # buffer re-used for the simulated positions of each batch
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
+
+    # number of simulations per windowed sum calculation
+    num_codons = -(-gene_seq.bed.cds_len // 3)
+    chunk_size = max(1, MAX_WINDOW_ELEMENTS // max(num_codons, 1))
 
     # figure out which position has highest value
     max_key = {w: max(obs_stat[w], key=(lambda key: obs_stat[w][key]))
                for w in window}
 
-    # setup null dist counts
-    null_cts = {w: {k: 0 for k in obs_stat[w]}
-                for w in window }
-
-    # empirical null distribution (saved if file path provided)
-    empirical_null = {w: {} for w in window}
-
-    num_sim = 0 # number of simulations
+    # empirical null distribution as a histogram of windowed sums, which
+    # can not exceed the total number of mutations
+    num_mut = len(base_ix)
+    null_hist = {w: np.zeros(num_mut+1, dtype=np.int64) for w in window}
+    null_max_ct = {w: 0 for w in window}
+
+    num_sim = 0 # number of null values (mutated codons)
+    num_iter = 0 # number of simulations
+    stop_flag = False
+    if prev_null_counts is not None:
+        num_sim = prev_null_counts['num_sim']
+        num_iter = prev_null_counts['num_iter']
+        null_hist = {w: prev_null_counts['hist'][w].copy() for w in window}
+        null_max_ct = dict(prev_null_counts['max'])
+        stop_flag = all(sequential_stop(null_max_ct[w], num_sim, stop_criteria, stop_alpha)
+                        for w in window)
     for j, batch_size in enumerate(batch_sizes):
         # stop iterations if reached sufficient precision
-        # stop iterations if reached sufficient precision
-        stop_flag = [(null_cts[w][max_key[w]]>=stop_criteria)
-                      for w in window]
-        if all(stop_flag):
+        if stop_flag:
             break
-        #if null_cts[max_key] >= stop_criteria:
-            #break
 
         # get random positions determined by sequence context
-        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                                batch_size)
-        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
-
-        # calculate position-based statistics as a result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calculate position info
-            tmp_pos, tmp_sim = utils.calc_windowed_sum(tmp_mut_info['Codon Pos'],
-                                                 tmp_mut_info['Reference AA'],
-                                                 tmp_mut_info['Somatic AA'],
-                                                 window)
-
-            # update the counts when the empirical null passes the observed
-            for tmp_w in tmp_sim:
-                for tmp_key in tmp_sim[tmp_w]:
-                    # get mutation count for simulation
-                    val = tmp_sim[tmp_w][tmp_key]
-
-                    # add to empirical null distribution
-                    empirical_null[tmp_w].setdefault(val, 0)
-                    empirical_null[tmp_w][val] += 1
-
-                    # update counts used for p-value
-                    for key in null_cts[tmp_w]:
-                        if val >= obs_stat[tmp_w][key]:
-                            null_cts[tmp_w][key] += 1
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_codon_pos = effect_table.codon_pos[tmp_mut_pos]
+        tmp_missense = effect_table.is_missense[tmp_mut_pos, base_ix]
+
+        # calculate windowed sums for chunks of simulations, limiting the
+        # size of the simulations X protein length matrices
+        for chunk_start in range(0, batch_size, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, batch_size)
+            tmp_pos_ct, tmp_window_sum = utils.calc_windowed_sum_batch(tmp_codon_pos[chunk_start:chunk_end],
+                                                                       tmp_missense[chunk_start:chunk_end],
+                                                                       window, num_codons)
+            is_mutated = tmp_pos_ct > 0
+
+            # find the simulation which reaches sufficient precision, i.e.
+            # stop_criteria null values are at least the max observed value
+            is_done = np.ones(chunk_end - chunk_start, dtype=bool)
+            cum_num_null = num_sim + np.cumsum(is_mutated.sum(axis=1))
+            for w in window:
+                num_exceed = np.sum((tmp_window_sum[w] >= obs_stat[w][max_key[w]]) & is_mutated, axis=1)
+                cum_null_ct = null_max_ct[w] + np.cumsum(num_exceed)
+                is_done &= sequential_stop(cum_null_ct, cum_num_null, stop_criteria, stop_alpha)
+            stop_flag = is_done.any()
+            num_rows = np.argmax(is_done) + 1 if stop_flag else len(is_done)
+
+            # update the empirical null distribution
+            is_mutated = is_mutated[:num_rows]
+            for w in window:
+                tmp_vals = tmp_window_sum[w][:num_rows][is_mutated]
+                null_hist[w] += np.bincount(tmp_vals, minlength=num_mut+1)
+                null_max_ct[w] += np.sum(tmp_vals >= obs_stat[w][max_key[w]])
 
             # update the number of simulations
-            num_sim += len(tmp_pos)
+            num_sim += is_mutated.sum()
+            num_iter += num_rows
 
-            # stop iterations if reached sufficient precision
-            stop_flag = [(null_cts[w][max_key[w]]>=stop_criteria)
-                         for w in window]
-            if all(stop_flag):
+            if stop_flag:
                 break
 
-    # calculate p-value from empirical null-distribution
-    pvals = {w: {k: float(null_cts[w][k]) / (num_sim) for k in obs_stat[w]}
-             for w in window}
+    null_counts = {'num_sim': num_sim, 'num_iter': num_iter,
+                   'hist': null_hist, 'max': null_max_ct}
+    if return_null_counts:
+        return null_counts
+    return hotmaps_p_values(obs_stat, null_counts, null_save_path)
+
 
-    # save empirical distribution
-    if null_save_path:
-        for w in window:
+def hotmaps_p_values(obs_stat, null_counts, null_save_path=None):
+    """Calculates the p-value of each windowed sum from the null
+    distribution tallies.
+
+    Parameters
+    ----------
+    obs_stat : dict
+        dictionary mapping codons to the sum of mutations in a window
+    null_counts : dict
+        null distribution tallies from hotmaps_permutation
+    null_save_path : str or None
+        File path to save null distribution. If None, don't save it.
+
+    Returns
+    -------
+    pvals : dict
+        Maps mutated codon position to the calculated p-value
+    """
+    num_sim = null_counts['num_sim']
+
+    # calculate p-value from empirical null-distribution, the reverse
+    # cumulative sum gives the number of null values at least as large
+    # as each possible windowed sum
+    pvals = {}
+    for w in obs_stat:
+        null_hist = null_counts['hist'][w]
+        num_mut = len(null_hist) - 1
+        null_cts = np.cumsum(null_hist[::-1])[::-1]
+        obs_keys = list(obs_stat[w].keys())
+        obs_vals = np.array([obs_stat[w][k] for k in obs_keys], dtype=int)
+        tmp_null_cts = np.where(obs_vals <= num_mut, null_cts[np.minimum(obs_vals, num_mut)], 0)
+        pvals[w] = {k: float(tmp_null_cts[i]) / (num_sim) for i, k in enumerate(obs_keys)}
+
+        # save empirical distribution
+        if null_save_path:
             # create null distribution
             output = [['mutation_count', 'p-value']]
-            sorted_cts = sorted(empirical_null[w].keys())
-            tmp_sum = 0
-            for i in range(len(sorted_cts)):
-                tmp_sum += empirical_null[w][sorted_cts[-(i+1)]]
-                tmp_pval = tmp_sum / float(num_sim)
-                output.append([sorted_cts[-(i+1)], tmp_pval])
+            sorted_cts = np.flatnonzero(null_hist)[::-1]
+            for val in sorted_cts:
+                output.append([int(val), null_cts[val] / float(num_sim)])
             # save output
             with open(null_save_path.format(w), 'w') as handle:
                 mywriter = csv.writer(handle, delimiter='\t', lineterminator='\n')
@@ -357,19 +689,62 @@ def hotmaps_permutation(obs_stat,
     return pvals
 
 
+def hotmaps_p_value_cis(obs_stat, null_counts, use_tail=True):
+    """Calculates the p-value of each windowed sum with its confidence
+    interval, extrapolating small p-values from the tail of the null
+    histogram (see tail_fit.p_value_cis).
+
+    Parameters
+    ----------
+    obs_stat : dict
+        dictionary mapping codons to the sum of mutations in a window
+    null_counts : dict
+        null distribution tallies from hotmaps_permutation
+    use_tail : bool
+        extrapolate small p-values, otherwise only the empirical p-values
+        and their confidence intervals are calculated
+
+    Returns
+    -------
+    pval_cis : dict
+        Maps mutated codon position to the (p-value, lower, upper
+        confidence bound)
+    """
+    num_sim = null_counts['num_sim']
+    pval_cis = {}
+    for w in obs_stat:
+        null_hist = null_counts['hist'][w]
+        num_mut = len(null_hist) - 1
+        null_cts = np.cumsum(null_hist[::-1])[::-1]
+        obs_keys = list(obs_stat[w].keys())
+        obs_vals = np.array([obs_stat[w][k] for k in obs_keys], dtype=int)
+        tmp_null_cts = np.where(obs_vals <= num_mut, null_cts[np.minimum(obs_vals, num_mut)], 0)
+        # continuity correction, since the windowed sums are integers
+        tail = tail_fit.tail_from_hist(null_hist) if use_tail else None
+        tmp_pvals = tail_fit.p_value_cis(obs_vals - .5, tmp_null_cts, num_sim, tail)
+        pval_cis[w] = {k: tuple(tmp_pvals[i]) for i, k in enumerate(obs_keys)}
+    return pval_cis
+
+
 def protein_permutation(graph_score,
                         num_codons_obs,
                         context_counts,
                         context_to_mut,
                         seq_context,
                         gene_seq,
-                        gene_graph,
+                        graph_matrix,
                         num_permutations=10000,
                         stop_criteria=100,
-                        pseudo_count=0):
+                        pseudo_count=0,
+                        max_batch=25000,
+                        max_memory=None):
     """Performs null-simulations for position-based mutation statistics
     in a single gene.
 
+    The first stop_criteria-1 simulations are used to estimate the expected
+    relative increase in coverage on the graph, which normalizes both the
+    observed and simulated scores.
+
     Parameters
     ----------
     graph_score : float
@@ -387,11 +762,18 @@ def protein_permutation(graph_score,
         identified at positions along the gene.
     gene_seq : GeneSequence
         Sequence of gene of interest
+    graph_matrix : sparse.csr_matrix
+        neighbor graph smoothing matrix from scores.neighbor_graph_matrix
     num_permutations : int, default: 10000
         number of permutations to create for null
     stop_criteria : int
         stop after stop_criteria iterations are more significant
         then the observed statistic.
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
 
     Returns
     -------
@@ -405,23 +787,54 @@ def protein_permutation(graph_score,
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    batch_sizes = split_batches(num_permutations, max_batch)
+
+    # buffer re-used for the simulated positions of each batch
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
-    # calculate position-based statistics as a result of random positions
+    # simulations used to estimate the relative increase in coverage
+    num_calibrate = max(stop_criteria-1, 1)
+    graph_entropy, num_mut_codons, coverage = [], [], []
+    obs_stat = None
+
+    num_sim = 0
     null_graph_entropy_ct = 0
-    coverage_list = []
-    num_mut_list = []
-    graph_entropy_list = []
-    for i, row in enumerate(tmp_mut_pos):
-        # calculate the expected value of the relative increase in coverage
-        if i == stop_criteria-1:
-            rel_inc = [coverage_list[k] / float(num_mut_list[k])
-                       for k in range(stop_criteria-1)
-                       if coverage_list[k]]
-            exp_rel_inc = np.mean(rel_inc)
+    for j, batch_size in enumerate(batch_sizes):
+        # stop iterations if reached sufficient precision
+        if null_graph_entropy_ct >= stop_criteria:
+            break
+
+        # get random positions determined by sequence context
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_codon_pos = effect_table.codon_pos[tmp_mut_pos]
+        tmp_missense = effect_table.is_missense[tmp_mut_pos, base_ix]
+
+        # get entropy on graph-smoothed probability distribution
+        tmp_ng_stat = scores.compute_ng_stat_batch(graph_matrix, tmp_codon_pos, tmp_missense)
+        graph_entropy.append(tmp_ng_stat[0])
+        coverage.append(tmp_ng_stat[1])
+        num_mut_codons.append(tmp_ng_stat[2])
+
+        # wait until enough simulations to calculate the expected value
+        # of the relative increase in coverage
+        is_last_batch = (j == len(batch_sizes)-1)
+        if obs_stat is None:
+            if sum(len(x) for x in graph_entropy) < num_calibrate and not is_last_batch:
+                continue
+            graph_entropy = [np.concatenate(graph_entropy)]
+            coverage = [np.concatenate(coverage)]
+            num_mut_codons = [np.concatenate(num_mut_codons)]
+            calib_cov = coverage[0][:num_calibrate]
+            calib_num_mut = num_mut_codons[0][:num_calibrate]
+            exp_rel_inc = np.mean(calib_cov[calib_cov > 0] / calib_num_mut[calib_cov > 0].astype(float))
 
             # calculate observed statistic
             if num_codons_obs:
@@ -429,56 +842,23 @@ def protein_permutation(graph_score,
             else:
                 obs_stat = 1.0
 
-            # calculate statistics for simulated data
-            sim_stat_list = [ent / np.log2(exp_rel_inc*num_mut_list[l])
-                             for l, ent in enumerate(graph_entropy_list)]
-            null_graph_entropy_ct = len([s for s in sim_stat_list
-                                         if s-utils.epsilon <= obs_stat])
-
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # calculate position info
-        tmp_tuple = cutils.calc_pos_info(tmp_mut_info['Codon Pos'],
-                                         tmp_mut_info['Reference AA'],
-                                         tmp_mut_info['Somatic AA'],
-                                         pseudo_count=pseudo_count,
-                                         is_obs=0)
-        _, _, _, tmp_pos_ct = tmp_tuple
-
-        # record num of mut codons
-        if i < stop_criteria-1:
-            tmp_num_mut_codons = len(tmp_pos_ct)
-            num_mut_list.append(tmp_num_mut_codons)
-
-        # get entropy on graph-smoothed probability distribution
-        tmp_graph_entropy, tmp_coverage = scores.compute_ng_stat(gene_graph, tmp_pos_ct)
-
-        # record the "coverage" in the graph
-        if i < stop_criteria-1:
-            coverage_list.append(tmp_coverage)
-            graph_entropy_list.append(tmp_graph_entropy)
-
-        # update empirical null distribution counts
-        if i >= stop_criteria:
-            #if tmp_graph_entropy-utils.epsilon <= graph_score:
-            if tmp_num_mut_codons:
-                sim_stat = tmp_graph_entropy / np.log2(exp_rel_inc*tmp_num_mut_codons)
-            else:
-                sim_stat = 1.0
-
-            # add count
-            if sim_stat-utils.epsilon <= obs_stat:
-                null_graph_entropy_ct += 1
-
-        # stop iterations if reached sufficient precision
-        if null_graph_entropy_ct >= stop_criteria:
-            break
+        # calculate statistics for simulated data
+        tmp_graph_entropy, tmp_num_mut_codons = graph_entropy.pop(), num_mut_codons.pop()
+        coverage.pop()
+        sim_stat = np.ones(len(tmp_graph_entropy))
+        has_mut = tmp_num_mut_codons > 0
+        sim_stat[has_mut] = tmp_graph_entropy[has_mut] / np.log2(exp_rel_inc*tmp_num_mut_codons[has_mut])
+
+        # update empirical null distribution counts, stopping at the
+        # simulation which reaches sufficient precision
+        cum_null_ct = null_graph_entropy_ct + np.cumsum(sim_stat-utils.epsilon <= obs_stat)
+        is_done = cum_null_ct >= stop_criteria
+        i = np.argmax(is_done) if is_done.any() else len(sim_stat) - 1
+        null_graph_entropy_ct = cum_null_ct[i]
+        num_sim += i + 1
 
     # calculate p-value from empirical null-distribution
-    protein_pval = float(null_graph_entropy_ct) / (i+1)
+    protein_pval = float(null_graph_entropy_ct) / (num_sim)
 
     return protein_pval, obs_stat
 
@@ -488,10 +868,18 @@ def effect_permutation(context_counts,
                        seq_context,
                        gene_seq,
                        num_permutations=10000,
-                       pseudo_count=0):
+                       pseudo_count=0,
+                       max_batch=25000,
+                       max_memory=None,
+                       obs_ent=None,
+                       stop_criteria=100,
+                       stop_alpha=None):
     """Performs null-permutations for effect-based mutation statistics
     in a single gene.
 
+    All num_permutations simulations are performed unless stop_alpha is
+    provided, in which case simulations stop as described in sequential_stop.
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -511,6 +899,18 @@ def effect_permutation(context_counts,
         Pseudo-count for number of recurrent missense mutations for each
         permutation for the null distribution. Increasing pseudo_count
         makes the statistical test more stringent.
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
+    obs_ent : float or None
+        observed entropy-on-effect, needed for stopping early
+    stop_criteria : int
+        stop after stop_criteria iterations are more significant
+        then the observed statistic (only used with stop_alpha).
+    stop_alpha : float or None
+        stop once the p-value is confidently above this significance level
 
     Returns
     -------
@@ -526,39 +926,163 @@ def effect_permutation(context_counts,
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    if stop_alpha:
+        batch_sizes = ramp_batches(num_permutations, max_batch)
+    else:
+        batch_sizes = split_batches(num_permutations, max_batch)
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
-    # calculate position-based statistics as a result of random positions
     effect_entropy_list, recur_list, inactivating_list = [], [], []
-    for row in tmp_mut_pos:
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # calculate position info
-        tmp_entropy, tmp_recur, tmp_inactivating = cutils.calc_effect_info(tmp_mut_info['Codon Pos'],
-                                                                           tmp_mut_info['Reference AA'],
-                                                                           tmp_mut_info['Somatic AA'],
-                                                                           pseudo_count=pseudo_count,
-                                                                           is_obs=0)
-        effect_entropy_list.append(tmp_entropy)
-        recur_list.append(tmp_recur)
-        inactivating_list.append(tmp_inactivating)
+    null_ent_ct = 0
+    for batch_size in batch_sizes:
+        num_sim = len(effect_entropy_list)
+        # get random positions determined by sequence context
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_effects = effect_table.effects(tmp_mut_pos, base_ix)
+
+        # calculate position-based statistics as a result of random positions
+        for i in range(batch_size):
+            # get info about mutations
+            tmp_mut_info = effect_table.mut_info(tmp_effects, i)
+
+            # calculate position info
+            tmp_entropy, tmp_recur, tmp_inactivating = cutils.calc_effect_info(tmp_mut_info['Codon Pos'],
+                                                                               tmp_mut_info['Reference AA'],
+                                                                               tmp_mut_info['Somatic AA'],
+                                                                               pseudo_count=pseudo_count,
+                                                                               is_obs=0)
+            effect_entropy_list.append(tmp_entropy)
+            recur_list.append(tmp_recur)
+            inactivating_list.append(tmp_inactivating)
+
+        # stop at the simulation meeting the stopping rules
+        if stop_alpha:
+            tmp_entropy = np.array(effect_entropy_list[num_sim:])
+            cum_null_ent_ct = null_ent_ct + np.cumsum(tmp_entropy-utils.epsilon <= obs_ent)
+            cum_num_sim = num_sim + np.arange(1, batch_size+1)
+            is_done = sequential_stop(cum_null_ent_ct, cum_num_sim, stop_criteria, stop_alpha)
+            if is_done.any():
+                num_sim += np.argmax(is_done) + 1
+                del effect_entropy_list[num_sim:]
+                del recur_list[num_sim:]
+                del inactivating_list[num_sim:]
+                break
+            null_ent_ct = cum_null_ent_ct[-1]
 
     return effect_entropy_list, recur_list, inactivating_list
 
 
+def sample_class_counts(effect_table,
+                        context_counts,
+                        context_to_mut,
+                        seq_context,
+                        num_permutations=10000,
+                        position_classes=()):
+    """Samples the number of mutations in each variant class without
+    sampling individual mutation positions.
+
+    Mutations sharing a sequence context and somatic base are placed
+    uniformly among the positions with that context, so the number of
+    them falling into each variant class follows a multinomial distribution
+    with probabilities given by the gene sequence. For the variant classes
+    in position_classes, positions are additionally drawn uniformly among
+    the positions of that class, which gives the same joint distribution
+    as sampling every mutation position.
+
+    Parameters
+    ----------
+    effect_table : GeneEffectTable
+        effect of every possible mutation in the gene
+    context_counts : pd.Series
+        number of mutations for each context
+    context_to_mut : dict
+        dictionary mapping nucleotide context to a list of observed
+        somatic base changes.
+    seq_context : SequenceContext
+        Sequence context for the entire gene sequence
+    num_permutations : int, default: 10000
+        number of permutations to create for null
+    position_classes : tuple
+        variant class codes which need simulated positions
+
+    Returns
+    -------
+    class_cts : np.array
+        num_permutations X number of variant classes matrix of counts,
+        columns follow gene_effect_table.variant_names
+    class_pos : np.array
+        positions of mutations in position_classes for each permutation
+    class_pos_mask : np.array
+        boolean mask indicating which elements of class_pos are mutations
+    """
+    num_classes = len(ge.variant_names)
+    class_cts = np.zeros((num_permutations, num_classes), dtype=int)
+    class_pos, class_pos_mask = [np.zeros((num_permutations, 0), dtype=np.int32)], []
+    for one_context in context_counts.index.tolist():
+        prng = seq_context.prng_dict[one_context]
+        context_pos = seq_context.context_positions(one_context)
+        base_ix = effect_table.base_index(context_to_mut[one_context])
+        for one_base, num_mut in zip(*np.unique(base_ix, return_counts=True)):
+            # probability of each variant class for a randomly placed mutation
+            # (unclassifiable mutations are counted in the last column)
+            pos_class = effect_table.variant_class[context_pos, one_base] % num_classes
+            class_prob = np.bincount(pos_class, minlength=num_classes) / float(len(pos_class))
+            tmp_cts = prng.multinomial(num_mut, class_prob, size=num_permutations)
+            class_cts += tmp_cts
+
+            # sample positions conditional on the variant class
+            for one_class in position_classes:
+                max_ct = tmp_cts[:, one_class].max()
+                if max_ct:
+                    tmp_pos = prng.choice(context_pos[pos_class == one_class],
+                                          (num_permutations, max_ct))
+                    class_pos.append(tmp_pos)
+                    class_pos_mask.append(np.arange(max_ct) < tmp_cts[:, [one_class]])
+    class_pos = np.hstack(class_pos)
+    class_pos_mask = np.hstack(class_pos_mask) if class_pos_mask else np.zeros(class_pos.shape, dtype=bool)
+    return class_cts, class_pos, class_pos_mask
+
+
+def non_silent_counts(class_cts):
+    """Converts variant class counts into the non-silent, silent, nonsense,
+    lost stop, splice site, lost start and missense counts (same order as
+    cutils.calc_non_silent_info).
+
+    Parameters
+    ----------
+    class_cts : np.array
+        matrix of variant class counts from sample_class_counts
+
+    Returns
+    -------
+    non_silent_cts : np.array
+        num_permutations X 7 matrix of counts
+    """
+    class_order = [ge.NONSENSE, ge.NONSTOP, ge.SPLICE, ge.LOST_START, ge.MISSENSE]
+    non_silent = class_cts[:, class_order].sum(axis=1)
+    return np.column_stack([non_silent, class_cts[:, ge.SILENT], class_cts[:, class_order]])
+
+
 def non_silent_ratio_permutation(context_counts,
                                  context_to_mut,
                                  seq_context,
                                  gene_seq,
-                                 num_permutations=10000):
+                                 num_permutations=10000,
+                                 max_batch=25000,
+                                 max_memory=None):
     """Performs null-permutations for non-silent ratio across all genes.
 
+    Only the number of mutations in each variant class is simulated (see
+    sample_class_counts), since the positions are not needed.
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -574,35 +1098,26 @@ def non_silent_ratio_permutation(context_counts,
         Sequence of gene of interest
     num_permutations : int, default: 10000
         number of permutations to create for null
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
 
     Returns
     -------
-    non_silent_count_list : list of tuples
-        list of non-silent and silent mutation counts under the null
+    non_silent_count_list : list of lists
+        list of non-silent, silent, nonsense, lost stop, splice site,
+        lost start, and missense mutation counts under the null
     """
-    mycontexts = context_counts.index.tolist()
-    somatic_base = [base
-                    for one_context in mycontexts
-                    for base in context_to_mut[one_context]]
-
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
-
-    # determine result of random positions
+    effect_table = GeneEffectTable(gene_seq)
+    max_batch = memory_batch_size(context_counts.sum(), max_memory, max_batch)
     non_silent_count_list = []
-    for row in tmp_mut_pos:
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # calc deleterious mutation info
-        tmp_non_silent = cutils.calc_non_silent_info(tmp_mut_info['Reference AA'],
-                                                     tmp_mut_info['Somatic AA'],
-                                                     tmp_mut_info['Codon Pos'])
-        non_silent_count_list.append(tmp_non_silent)
+    for batch_size in split_batches(num_permutations, max_batch):
+        class_cts, _, _ = sample_class_counts(effect_table, context_counts,
+                                              context_to_mut, seq_context,
+                                              batch_size)
+        non_silent_count_list += non_silent_counts(class_cts).tolist()
     return non_silent_count_list
 
 
@@ -614,10 +1129,17 @@ def summary_permutation(context_counts,
                         num_permutations=10000,
                         min_frac=0.0,
                         min_recur=2,
-                        drop_silent=False):
+                        drop_silent=False,
+                        max_batch=25000,
+                        max_memory=None):
     """Performs null-permutations and summarizes the results as features over
     the gene.
 
+    Without scores, mutation counts are simulated for each variant class and
+    positions are only simulated for missense and lost start mutations
+    (see sample_class_counts). Scores need every mutation, so all positions
+    are simulated if score_dir is provided.
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -636,6 +1158,11 @@ def summary_permutation(context_counts,
     drop_silent : bool, default=False
         Flage on whether to drop all silent mutations. Some data sources
         do not report silent mutations, and the simulations should match this.
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
 
     Returns
     -------
@@ -644,45 +1171,104 @@ def summary_permutation(context_counts,
         with information on recurrent missense counts and missense positional
         entropy.
     """
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    gene_name = gene_seq.bed.gene_name
+    gene_len = gene_seq.bed.cds_len
+    max_batch = memory_batch_size(context_counts.sum(), max_memory, max_batch)
+    if score_dir:
+        return _summary_position_permutation(effect_table, context_counts,
+                                             context_to_mut, seq_context,
+                                             gene_seq, score_dir,
+                                             num_permutations, min_frac,
+                                             min_recur, drop_silent,
+                                             max_batch)
+
+    summary_info_list = []
+    for batch_size in split_batches(num_permutations, max_batch):
+        # simulate counts of variant classes, and positions of mutations
+        # which change the amino acid at a codon
+        class_cts, mis_pos, mis_mask = sample_class_counts(effect_table,
+                                                           context_counts,
+                                                           context_to_mut,
+                                                           seq_context,
+                                                           batch_size,
+                                                           position_classes=(ge.MISSENSE, ge.LOST_START))
+        non_silent_cts = non_silent_counts(class_cts)
+        if drop_silent:
+            # silent mutation count is index 1
+            non_silent_cts[:, 1] = 0
+
+        # calculate missense position statistics
+        mis_codon_pos = effect_table.codon_pos[mis_pos]
+        num_recur, pos_ent, _ = cutils.calc_pos_info_batch(mis_codon_pos,
+                                                           mis_mask,
+                                                           min_frac=min_frac,
+                                                           min_recur=min_recur)
+
+        for i in range(batch_size):
+            # count number of missense mutations at each codon
+            tmp_codon_pos, tmp_ct = np.unique(mis_codon_pos[i, mis_mask[i]], return_counts=True)
+            pos_ct = dict(zip(tmp_codon_pos.tolist(), tmp_ct.tolist()))
+
+            tmp_summary = non_silent_cts[i].tolist() + [int(num_recur[i]), float(pos_ent[i]), pos_ct]
+            sim_num = len(summary_info_list) + 1
+            summary_info_list.append([gene_name, sim_num, gene_len]+tmp_summary)
+    return summary_info_list
+
+
+def _summary_position_permutation(effect_table,
+                                  context_counts,
+                                  context_to_mut,
+                                  seq_context,
+                                  gene_seq,
+                                  score_dir,
+                                  num_permutations,
+                                  min_frac,
+                                  min_recur,
+                                  drop_silent,
+                                  max_batch=25000):
+    """Performs null-permutations for summary_permutation by simulating
+    the position of every mutation."""
     mycontexts = context_counts.index.tolist()
     somatic_base = [base
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
+    base_ix = effect_table.base_index(somatic_base)
+    max_batch = min(num_permutations, max_batch)
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
-
-    # determine result of random positions
     gene_name = gene_seq.bed.gene_name
     gene_len = gene_seq.bed.cds_len
     summary_info_list = []
-    for i, row in enumerate(tmp_mut_pos):
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # Get all metrics summarizing each gene
-        tmp_summary = cutils.calc_summary_info(tmp_mut_info['Reference AA'],
-                                               tmp_mut_info['Somatic AA'],
-                                               tmp_mut_info['Codon Pos'],
-                                               gene_name,
-                                               score_dir,
-                                               min_frac=min_frac,
-                                               min_recur=min_recur)
-
-        # drop silent if needed
-        if drop_silent:
-            # silent mutation count is index 1
-            tmp_summary[1] = 0
-
-        # limit the precision of floats
-        #pos_ent = tmp_summary[-1]
-        #tmp_summary[-1] = '{0:.5f}'.format(pos_ent)
+    for batch_size in split_batches(num_permutations, max_batch):
+        # get random positions determined by sequence context
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_effects = effect_table.effects(tmp_mut_pos, base_ix)
 
-        summary_info_list.append([gene_name, i+1, gene_len]+tmp_summary)
+        # determine result of random positions
+        for i in range(batch_size):
+            # get info about mutations
+            tmp_mut_info = effect_table.mut_info(tmp_effects, i)
+
+            # Get all metrics summarizing each gene
+            tmp_summary = cutils.calc_summary_info(tmp_mut_info['Reference AA'],
+                                                   tmp_mut_info['Somatic AA'],
+                                                   tmp_mut_info['Codon Pos'],
+                                                   gene_name,
+                                                   score_dir,
+                                                   min_frac=min_frac,
+                                                   min_recur=min_recur)
+
+            # drop silent if needed
+            if drop_silent:
+                # silent mutation count is index 1
+                tmp_summary[1] = 0
+
+            sim_num = len(summary_info_list) + 1
+            summary_info_list.append([gene_name, sim_num, gene_len]+tmp_summary)
     return summary_info_list
 
 
@@ -691,7 +1277,9 @@ def maf_permutation(context_counts,
                     seq_context,
                     gene_seq,
                     num_permutations=10000,
-                    drop_silent=False):
+                    drop_silent=False,
+                    max_batch=25000,
+                    max_memory=None):
     """Performs null-permutations across all genes and records the results in
     a format like a MAF file. This could be useful for examining the null
     permutations because the alternative approaches always summarize the results.
@@ -716,6 +1304,11 @@ def maf_permutation(context_counts,
     drop_silent : bool, default=False
         Flage on whether to drop all silent mutations. Some data sources
         do not report silent mutations, and the simulations should match this.
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
+    max_memory : int or None
+        memory budget in bytes, which limits the number of simulations per
+        batch (see memory_batch_size)
 
     Returns
     -------
@@ -727,57 +1320,62 @@ def maf_permutation(context_counts,
                                        for one_context in mycontexts
                                        for base in context_to_mut[one_context]])
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+    # pre-compute the effect of every possible mutation in the gene
+    effect_table = GeneEffectTable(gene_seq)
+    base_ix = effect_table.base_index(somatic_base)
+
+    # calculate the # of batches for simulations, limited by the memory budget
+    max_batch = min(num_permutations, memory_batch_size(len(base_ix), max_memory, max_batch))
+    pos_buffer = np.empty((max_batch, len(base_ix)), dtype=np.int32)
 
     # info about gene
     gene_name = gene_seq.bed.gene_name
     strand = gene_seq.bed.strand
     chrom = gene_seq.bed.chrom
-    gene_seq.bed.init_genome_coordinates()  # map seq pos to genome
 
-    # determine result of random positions
     maf_list = []
-    for row in tmp_mut_pos:
-        # get genome coordinate
-        pos2genome = np.vectorize(lambda x: gene_seq.bed.seqpos2genome[x]+1)
-        genome_coord = pos2genome(row)
-
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # get string describing variant
-        var_class = cutils.get_variant_classification(tmp_mut_info['Reference AA'],
-                                                      tmp_mut_info['Somatic AA'],
-                                                      tmp_mut_info['Codon Pos'])
-
-        # prepare output
-        for k, mysomatic_base in enumerate(somatic_base):
-            # format DNA change
-            ref_nuc = tmp_mut_info['Reference Nuc'][k]
-            nuc_pos = row[k]
-            dna_change = 'c.{0}{1}>{2}'.format(ref_nuc, nuc_pos, mysomatic_base)
-
-            # format protein change
-            ref_aa = tmp_mut_info['Reference AA'][k]
-            somatic_aa = tmp_mut_info['Somatic AA'][k]
-            codon_pos = tmp_mut_info['Codon Pos'][k]
-            protein_change = 'p.{0}{1}{2}'.format(ref_aa, codon_pos, somatic_aa)
-
-            # reverse complement if on negative strand
-            if strand == '-':
-                ref_nuc = utils.rev_comp(ref_nuc)
-                mysomatic_base = utils.rev_comp(mysomatic_base)
-
-            # append results
-            if drop_silent and var_class[k].decode() == 'Silent': continue
-            maf_line = [gene_name, strand, chrom, genome_coord[k], genome_coord[k],
-                        ref_nuc, mysomatic_base, base_context[k], dna_change,
-                        protein_change, var_class[k].decode()]
-            maf_list.append(maf_line)
+    for batch_size in split_batches(num_permutations, max_batch):
+        # get random positions determined by sequence context
+        tmp_mut_pos = seq_context.random_pos_matrix(context_counts.iteritems(),
+                                                    batch_size,
+                                                    out=pos_buffer[:batch_size])
+        tmp_effects = effect_table.effects(tmp_mut_pos, base_ix)
+
+        # determine result of random positions
+        genome_coords = gene_seq.bed.seqpos_to_genome(tmp_mut_pos) + 1
+        for i, row in enumerate(tmp_mut_pos):
+            # get genome coordinate
+            genome_coord = genome_coords[i]
+
+            # get info about mutations
+            tmp_mut_info = effect_table.mut_info(tmp_effects, i)
+
+            # get string describing variant
+            var_class = effect_table.variant_classification(tmp_effects, i)
+
+            # prepare output
+            for k, mysomatic_base in enumerate(somatic_base):
+                # format DNA change
+                ref_nuc = tmp_mut_info['Reference Nuc'][k]
+                nuc_pos = row[k]
+                dna_change = 'c.{0}{1}>{2}'.format(ref_nuc, nuc_pos, mysomatic_base)
+
+                # format protein change
+                ref_aa = tmp_mut_info['Reference AA'][k]
+                somatic_aa = tmp_mut_info['Somatic AA'][k]
+                codon_pos = tmp_mut_info['Codon Pos'][k]
+                protein_change = 'p.{0}{1}{2}'.format(ref_aa, codon_pos, somatic_aa)
+
+                # reverse complement if on negative strand
+                if strand == '-':
+                    ref_nuc = utils.rev_comp(ref_nuc)
+                    mysomatic_base = utils.rev_comp(mysomatic_base)
+
+                # append results
+                if drop_silent and var_class[k] == 'Silent': continue
+                maf_line = [gene_name, strand, chrom, genome_coord[k], genome_coord[k],
+                            ref_nuc, mysomatic_base, base_context[k], dna_change,
+                            protein_change, var_class[k]]
+                maf_list.append(maf_line)
 
     return maf_list
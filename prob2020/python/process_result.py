@@ -5,7 +5,16 @@ import prob2020.python.p_value as mypval
 import numpy as np
 import pandas as pd
 
-def handle_tsg_results(permutation_result):
+
+def ci_columns(p_val_cols, p_value_ci=False):
+    """Names of the p-value confidence interval columns, which are only
+    reported for tail fits or screening (see tail_fit)."""
+    if not p_value_ci:
+        return []
+    return [p_col + ' CI ' + bound for p_col in p_val_cols for bound in ['low', 'high']]
+
+
+def handle_tsg_results(permutation_result, p_value_ci=False):
     """Handles result from TSG results.
 
     Takes in output from multiprocess_permutation function and converts to
@@ -15,15 +24,19 @@ def handle_tsg_results(permutation_result):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    p_value_ci : bool
+        results contain the p-value confidence intervals
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
+    ci_cols = ci_columns(['inactivating p-value'], p_value_ci)
     permutation_df = pd.DataFrame(sorted(permutation_result, key=lambda x: x[2] if x[2] is not None else 1.1),
                                   columns=['gene', 'inactivating count', 'inactivating p-value',
-                                           'Total SNV Mutations', 'SNVs Unmapped to Ref Tx'])
+                                           'num iterations'] + ci_cols +
+                                          ['Total SNV Mutations', 'SNVs Unmapped to Ref Tx'])
     permutation_df['inactivating p-value'] = permutation_df['inactivating p-value'].astype('float')
     tmp_df = permutation_df[permutation_df['inactivating p-value'].notnull()]
 
@@ -41,11 +54,11 @@ def handle_tsg_results(permutation_result):
     col_order  = ['gene', 'Total SNV Mutations', 'SNVs Unmapped to Ref Tx',
                   #'Total Frameshift Mutations', 'Frameshifts Unmapped to Ref Tx',
                   'inactivating count', 'inactivating p-value',
-                  'inactivating BH q-value']
+                  'inactivating BH q-value'] + ci_cols + ['num iterations']
     return permutation_df[col_order]
 
 
-def handle_oncogene_results(permutation_result, num_permutations):
+def handle_oncogene_results(permutation_result, num_permutations, p_value_ci=False):
     """Takes in output from multiprocess_permutation function and converts to
     a better formatted dataframe.
 
@@ -53,15 +66,21 @@ def handle_oncogene_results(permutation_result, num_permutations):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    num_permutations : int
+        number of iterations, used in place of p-values of zero when
+        combining p-values
+    p_value_ci : bool
+        results contain the p-value confidence intervals
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
+    ci_cols = ci_columns(['entropy p-value', 'vest p-value'], p_value_ci)
     mycols = ['gene', 'num recurrent', 'position entropy',
               'mean vest score', 'entropy p-value',
-              'vest p-value', 'Total Mutations', 'Unmapped to Ref Tx']
+              'vest p-value', 'num iterations'] + ci_cols + ['Total Mutations', 'Unmapped to Ref Tx']
     permutation_df = pd.DataFrame(permutation_result, columns=mycols)
 
     # get benjamani hochberg adjusted p-values
@@ -85,12 +104,12 @@ def handle_oncogene_results(permutation_result, num_permutations):
                  'num recurrent', 'position entropy',
                  'mean vest score', 'entropy p-value',
                  'vest p-value', 'combined p-value', 'entropy BH q-value',
-                 'vest BH q-value', 'combined BH q-value']
+                 'vest BH q-value', 'combined BH q-value'] + ci_cols + ['num iterations']
     permutation_df = permutation_df.sort_values(by=['combined p-value'])
     return permutation_df[col_order]
 
 
-def handle_hotmaps_results(permutation_result):
+def handle_hotmaps_results(permutation_result, report_index=False, p_value_ci=False):
     """Takes in output from multiprocess_permutation function and converts to
     a better formatted dataframe.
 
@@ -98,18 +117,24 @@ def handle_hotmaps_results(permutation_result):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    report_index : bool
+        results contain the index of the mutations in the input file
+    p_value_ci : bool
+        results contain the p-value confidence intervals
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
-    if len(permutation_result[0])  == 6:
-        mycols = ['gene', 'window length', 'codon position', 'mutation count',
-                  'windowed sum', 'p-value']
+    ci_cols = ci_columns(['p-value'], p_value_ci)
+    if not report_index:
+        stat_cols = ['gene', 'window length', 'codon position', 'mutation count',
+                     'windowed sum', 'p-value']
     else:
-        mycols = ['gene', 'window length', 'codon position', 'index', 'mutation count',
-                  'windowed sum', 'p-value']
+        stat_cols = ['gene', 'window length', 'codon position', 'index', 'mutation count',
+                     'windowed sum', 'p-value']
+    mycols = stat_cols + ['num iterations'] + ci_cols
 
     permutation_df = pd.DataFrame(permutation_result, columns=mycols)
 
@@ -122,7 +147,7 @@ def handle_hotmaps_results(permutation_result):
 
     # order output
     #permutation_df = permutation_df.set_index('gene', drop=False)  # make sure genes are indices
-    col_order = mycols + ['q-value']
+    col_order = stat_cols + ['q-value'] + ci_cols + ['num iterations']
     permutation_df = permutation_df.sort_values(by=['window length', 'p-value'])
     return permutation_df[col_order]
 
@@ -160,7 +185,7 @@ def handle_protein_results(permutation_result):
     return permutation_df[col_order]
 
 
-def handle_effect_results(permutation_result):
+def handle_effect_results(permutation_result, p_value_ci=False):
     """Takes in output from multiprocess_permutation function and converts to
     a better formatted dataframe.
 
@@ -168,15 +193,18 @@ def handle_effect_results(permutation_result):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    p_value_ci : bool
+        results contain the p-value confidence intervals
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
+    ci_cols = ci_columns(['entropy-on-effect p-value'], p_value_ci)
     mycols = ['gene', 'num recurrent', 'num inactivating', 'entropy-on-effect',
-              'entropy-on-effect p-value',
-              'Total Mutations', 'Unmapped to Ref Tx']
+              'entropy-on-effect p-value', 'num iterations'] + ci_cols + \
+             ['Total Mutations', 'Unmapped to Ref Tx']
     permutation_df = pd.DataFrame(sorted(permutation_result, key=lambda x: x[4] if x[4] is not None else 1.1),
                                   columns=mycols)
 
@@ -188,5 +216,6 @@ def handle_effect_results(permutation_result):
     permutation_df['num recurrent'] = permutation_df['num recurrent'].fillna(-1).astype(int)  # fix dtype isssue
     col_order = ['gene', 'Total Mutations', 'Unmapped to Ref Tx',
                  'num recurrent', 'num inactivating', 'entropy-on-effect',
-                 'entropy-on-effect p-value', 'entropy-on-effect BH q-value']
+                 'entropy-on-effect p-value', 'entropy-on-effect BH q-value'] + \
+                ci_cols + ['num iterations']
     return permutation_df[col_order]
@@ -0,0 +1,360 @@
+"""Compiled reference files combining a BED file and gene FASTA.
+
+A compiled reference holds the exon and splice site sequences, the BED
+lines and optionally the sequence contexts of every gene in a
+single file which is memory mapped when opened. Workers can therefore
+attach to it without parsing the BED file or seeking within the gene FASTA
+for every exon.
+
+The file starts with a magic string and a JSON header describing the
+location of each array, followed by the arrays themselves.
+"""
+import prob2020.python.utils as utils
+from prob2020.python.bed_line import BedLine
+from prob2020.python.gene_sequence import GeneSequence
+import prob2020.python.sequence_context as sequence_context
+import numpy as np
+import pysam
+import struct
+import json
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)  # module logger
+
+MAGIC = b'P2020REF'
+VERSION = 1
+_ALIGN = 64  # byte alignment of arrays within the file
+
+
+def _context_key(nuc_context):
+    """Name used for a level of sequence context in the compiled reference."""
+    return str(float(nuc_context))
+
+
+def is_compiled_reference(path):
+    """Checks whether a file is a compiled reference.
+
+    Parameters
+    ----------
+    path : str
+        path to file
+
+    Returns
+    -------
+    is_ref : bool
+        True if the file starts with the compiled reference magic string
+    """
+    try:
+        with open(path, 'rb') as handle:
+            return handle.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def open_gene_fasta(path):
+    """Opens the gene sequences from either a gene FASTA or a compiled
+    reference.
+
+    Parameters
+    ----------
+    path : str
+        path to gene FASTA from extract_gene_seq or a compiled reference
+
+    Returns
+    -------
+    gene_fa : pysam.Fastafile or CompiledReference
+        object used by GeneSequence to fetch gene sequences
+    """
+    if is_compiled_reference(path):
+        return CompiledReference(path)
+    else:
+        return pysam.Fastafile(path)
+
+
+def bed_path(input_path, bed_path=None):
+    """Gets the BED file to use for the genes.
+
+    Compiled references contain the BED file, so a separate BED file
+    is only required for a gene FASTA.
+
+    Parameters
+    ----------
+    input_path : str
+        gene FASTA or compiled reference (-i option)
+    bed_path : str or None
+        BED file (-b option)
+
+    Returns
+    -------
+    bed_path : str
+        path to read BED lines from with utils.bed_generator
+    """
+    if bed_path:
+        return bed_path
+    elif is_compiled_reference(input_path):
+        return input_path
+    else:
+        raise ValueError('A BED file (-b) is required unless the input '
+                         '(-i) is a compiled reference')
+
+
+def get_context_index(gene_fa, nuc_context, index_dir=None):
+    """Gets the index of pre-computed sequence contexts, if any.
+
+    Parameters
+    ----------
+    gene_fa : pysam.Fastafile or CompiledReference
+        gene sequences from open_gene_fasta
+    nuc_context : float
+        level of sequence context
+    index_dir : str or None
+        directory of an on-disk context index (--context-index option)
+
+    Returns
+    -------
+    context_index : ContextIndex, CompiledContextIndex or None
+        index to pass to SequenceContext
+    """
+    if index_dir:
+        return sequence_context.ContextIndex(index_dir)
+    elif isinstance(gene_fa, CompiledReference):
+        return gene_fa.context_index(nuc_context)
+    else:
+        return None
+
+
+def compile_reference(bed_path, fasta_path, output_path, contexts=()):
+    """Compiles a BED file and gene FASTA into a single reference file.
+
+    Parameters
+    ----------
+    bed_path : str
+        BED file annotation of genes
+    fasta_path : str
+        gene FASTA file from extract_gene_seq
+    output_path : str
+        path to save the compiled reference
+    contexts : list
+        levels of sequence context to pre-compute
+    """
+    gene_fa = pysam.Fastafile(fasta_path)
+    gs = GeneSequence(gene_fa)
+
+    genes = []
+    seq_parts, seq_bounds = [], [0]
+    context_arrays = {c: {'context_pos': [], 'context_offsets': [], 'pos_context': []}
+                      for c in contexts}
+    for bed in utils.bed_generator(bed_path):
+        try:
+            gs.set_gene(bed)
+        except KeyError:
+            logger.warning('{0} was not found in the gene FASTA, skipping . . .'.format(bed.gene_name))
+            continue
+
+        # record exon and splice site sequences
+        exons, five_prime_ss, three_prime_ss = gs._fetch_seq()
+        gene_info = {'name': bed.gene_name,
+                     'bed': list(bed.bed_tuple),
+                     'seq_index': len(seq_bounds) - 1,
+                     'num_exons': len(exons),
+                     'num_five_ss': len(five_prime_ss),
+                     'num_three_ss': len(three_prime_ss),
+                     'contexts': {}}
+        for seg in exons + five_prime_ss + three_prime_ss:
+            seq_parts.append(seg.upper().encode('ascii'))
+            seq_bounds.append(seq_bounds[-1] + len(seg))
+
+        # record sequence contexts
+        for c in contexts:
+            gs.nuc_context = c
+            sc = sequence_context.SequenceContext(gs)
+            arrays = context_arrays[c]
+            gene_info['contexts'][_context_key(c)] = {
+                'names': sc.context_names,
+                'pos_index': sum(len(x) for x in arrays['context_pos']),
+                'offset_index': sum(len(x) for x in arrays['context_offsets'])}
+            arrays['context_pos'].append(sc.context_pos)
+            arrays['context_offsets'].append(sc.context_offsets)
+            arrays['pos_context'].append(sc.pos_context)
+        genes.append(gene_info)
+    gene_fa.close()
+
+    # combine arrays across genes
+    arrays = OrderedDict()
+    arrays['seq'] = np.frombuffer(b''.join(seq_parts), dtype=np.uint8)
+    arrays['seq_bounds'] = np.array(seq_bounds, dtype=np.int64)
+    for c in contexts:
+        for k, v in context_arrays[c].items():
+            dtype = np.int64 if k == 'context_offsets' else np.int32
+            arrays['{0}:{1}'.format(k, _context_key(c))] = np.concatenate(v).astype(dtype) if v else np.zeros(0, dtype=dtype)
+
+    # lay out arrays after the header
+    array_info, offset = OrderedDict(), 0
+    for k, v in arrays.items():
+        array_info[k] = {'offset': offset, 'dtype': v.dtype.str, 'shape': list(v.shape)}
+        offset += -(-v.nbytes // _ALIGN) * _ALIGN
+    header = {'version': VERSION,
+              'contexts': [_context_key(c) for c in contexts],
+              'arrays': array_info,
+              'genes': genes}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start // _ALIGN) * _ALIGN
+
+    # write file
+    with open(output_path, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(struct.pack('<Q', len(header_bytes)))
+        handle.write(header_bytes)
+        for k, v in arrays.items():
+            handle.seek(data_start + array_info[k]['offset'])
+            handle.write(v.tobytes())
+        handle.truncate(data_start + offset)
+
+
+class CompiledReference(object):
+    """Memory mapped compiled reference created by compile_reference.
+
+    CompiledReference can be used in place of the pysam.Fastafile for the
+    gene FASTA, and also provides the BED lines of the compiled genes.
+
+    Parameters
+    ----------
+    path : str
+        path to compiled reference
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{0} is not a compiled reference'.format(path))
+            header_len, = struct.unpack('<Q', handle.read(8))
+            header = json.loads(handle.read(header_len).decode('utf-8'))
+        if header['version'] != VERSION:
+            raise ValueError('Unsupported compiled reference version ({0})'.format(header['version']))
+        data_start = len(MAGIC) + 8 + header_len
+        data_start = -(-data_start // _ALIGN) * _ALIGN
+
+        # map arrays without reading them
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for k, info in header['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            start = data_start + info['offset']
+            nbytes = int(np.prod(info['shape'])) * dtype.itemsize
+            self.arrays[k] = self._mmap[start:start+nbytes].view(dtype).reshape(info['shape'])
+        self.contexts = header['contexts']
+        self.genes = header['genes']
+        self.gene2info = {g['name']: g for g in self.genes}
+
+    def close(self):
+        """Kept for compatibility with pysam.Fastafile."""
+        pass
+
+    def bed_generator(self):
+        """Iterates through the compiled genes yielding BED lines, in the
+        same order as the original BED file.
+
+        Yields
+        ------
+        bed : BedLine
+            BedLine object for each gene
+        """
+        for g in self.genes:
+            yield BedLine(list(g['bed']))
+
+    def _segment(self, ix):
+        """Returns the ix-th stored sequence as a string."""
+        bounds = self.arrays['seq_bounds']
+        return self.arrays['seq'][bounds[ix]:bounds[ix+1]].tobytes().decode('ascii')
+
+    def fetch_gene(self, gene_name):
+        """Fetches all sequences for a gene.
+
+        Parameters
+        ----------
+        gene_name : str
+            name of gene
+
+        Returns
+        -------
+        exons : list of str
+            list of exon nucleotide sequences
+        five_prime_ss : list of str
+            list of 5' splice site sequences
+        three_prime_ss : list of str
+            list of 3' splice site sequences
+        """
+        g = self.gene2info[gene_name]
+        ix = g['seq_index']
+        num_exons, num_five, num_three = g['num_exons'], g['num_five_ss'], g['num_three_ss']
+        exons = [self._segment(ix+i) for i in range(num_exons)]
+        ix += num_exons
+        five_prime_ss = [self._segment(ix+i) for i in range(num_five)]
+        ix += num_five
+        three_prime_ss = [self._segment(ix+i) for i in range(num_three)]
+        return exons, five_prime_ss, three_prime_ss
+
+    def fetch(self, reference=None, start=None, end=None):
+        """Fetches a sequence using the same ids as the gene FASTA, e.g.
+        "GENE;exon3" or "GENE;exon3;5SS".
+        """
+        fields = reference.split(';')
+        exons, five_prime_ss, three_prime_ss = self.fetch_gene(fields[0])
+        exon_num = int(fields[1][len('exon'):])
+        num_exons = len(exons)
+        if len(fields) == 2:
+            seq = exons[exon_num]
+        elif fields[2] == '5SS' and exon_num < num_exons - 1:
+            seq = five_prime_ss[exon_num]
+        elif fields[2] == '3SS' and 0 < exon_num:
+            seq = three_prime_ss[exon_num-1]
+        else:
+            raise KeyError('sequence "{0}" not present'.format(reference))
+        return seq[start:end]
+
+    def context_index(self, nuc_context):
+        """Returns an index of the pre-computed sequence contexts for use
+        by SequenceContext, or None if the context level was not compiled."""
+        if _context_key(nuc_context) not in self.contexts:
+            return None
+        return CompiledContextIndex(self, _context_key(nuc_context))
+
+
+class CompiledContextIndex(object):
+    """Sequence contexts stored in a compiled reference, with the same
+    interface as sequence_context.ContextIndex."""
+
+    def __init__(self, compiled_ref, nuc_context):
+        self.nuc_context = nuc_context
+        self.gene2info = compiled_ref.gene2info
+        arrays = compiled_ref.arrays
+        self.context_pos = arrays['context_pos:{0}'.format(nuc_context)]
+        self.context_offsets = arrays['context_offsets:{0}'.format(nuc_context)]
+        self.pos_context = arrays['pos_context:{0}'.format(nuc_context)]
+
+    def load(self, gene_seq):
+        """Loads the sequence contexts for a gene.
+
+        Returns
+        -------
+        context_info : dict or None
+            arrays for SequenceContext, None if the gene is not compiled
+        """
+        g = self.gene2info.get(gene_seq.bed.gene_name)
+        if g is None:
+            return None
+        info = g['contexts'][self.nuc_context]
+        num_pos = len(gene_seq.exon_seq) + 2*(g['num_five_ss'] + g['num_three_ss'])
+        num_names = len(info['names'])
+        pos_ix, offset_ix = info['pos_index'], info['offset_index']
+        return {'context_names': list(info['names']),
+                'context_pos': self.context_pos[pos_ix:pos_ix+num_pos],
+                'context_offsets': self.context_offsets[offset_ix:offset_ix+num_names+1],
+                'pos_context': self.pos_context[pos_ix:pos_ix+num_pos]}
+
+    def save(self, gene_seq, seq_context):
+        """Compiled references are read-only."""
+        pass
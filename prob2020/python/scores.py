@@ -1,7 +1,9 @@
 #from ..cython import cutils
 import numpy as np
+import scipy.sparse as sparse
 import os
 import prob2020.python.mymath as mymath
+import prob2020.python.gene_effect_table as ge
 import sys
 
 # import pickle module
@@ -11,6 +13,97 @@ except:
     if sys.version_info < (3,):
         print('Falling back to regular pickle module')
     import pickle as pickle
+from collections import OrderedDict
+
+# maximum number of bytes of loaded score objects kept by each process
+SCORE_CACHE_BYTES = 2**28
+
+
+def _object_size(obj):
+    """Approximates the memory used by a loaded score object."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + sys.getsizeof(obj)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_object_size(k) + _object_size(v)
+                                        for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_object_size(x) for x in obj)
+    else:
+        return sys.getsizeof(obj)
+
+
+class ScoreCache(object):
+    """Least recently used cache of score pickle files, bounded by the
+    approximate number of bytes used by the loaded objects.
+
+    Loaded objects are shared between callers and should not be modified.
+
+    Parameters
+    ----------
+    max_bytes : int
+        maximum size of the cache, objects larger than max_bytes
+        are not cached.
+    """
+
+    def __init__(self, max_bytes=SCORE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        """Removes all loaded score objects from the cache."""
+        self._cache.clear()
+        self.num_bytes = 0
+
+    def load(self, path):
+        """Loads a pickle file, or returns the cached object if it was
+        previously loaded.
+
+        Parameters
+        ----------
+        path : str
+            path to pickle file
+
+        Returns
+        -------
+        obj : object or None
+            unpickled object. Returns None if the file does not exist.
+        """
+        if path in self._cache:
+            obj, obj_size = self._cache.pop(path)
+            self._cache[path] = (obj, obj_size)
+            return obj
+
+        # read score file
+        if os.path.exists(path):
+            if sys.version_info < (3,):
+                # python 2.7 way
+                with open(path) as handle:
+                    obj = pickle.load(handle)
+            else:
+                # python 3.X way
+                with open(path, 'rb') as handle:
+                    obj = pickle.load(handle, encoding='latin-1')
+        else:
+            obj = None
+
+        # add to cache, evicting the least recently used objects
+        obj_size = _object_size(obj)
+        if obj_size <= self.max_bytes:
+            while self.num_bytes + obj_size > self.max_bytes:
+                _, (_, old_size) = self._cache.popitem(last=False)
+                self.num_bytes -= old_size
+            self._cache[path] = (obj, obj_size)
+            self.num_bytes += obj_size
+        return obj
+
+
+# process-local cache shared by all score look ups
+score_cache = ScoreCache()
+
 
 def retrieve_scores(gname, sdir,
                     codon_pos, germ_aa, somatic_aa,
@@ -18,7 +111,8 @@ def retrieve_scores(gname, sdir,
                     no_file_flag=-1):
     """Retrieves scores from pickle files.
 
-    Used by summary script.
+    Used by summary script. Score files are loaded through the process-local
+    score_cache, so repeated calls for the same gene do not re-read them.
 
     """
     # get variant types
@@ -26,17 +120,7 @@ def retrieve_scores(gname, sdir,
 
     # get information about MGA entropy
     mga_path = os.path.join(sdir, gname+".mgaentropy.pickle")
-    if os.path.exists(mga_path):
-        if sys.version_info < (3,):
-            # python 2.7 way
-            with open(mga_path) as handle:
-                mga_ent = pickle.load(handle)
-        else:
-            # python 3.X way
-            with open(mga_path, 'rb') as handle:
-                mga_ent = pickle.load(handle, encoding='latin-1')
-    else:
-        mga_ent = None
+    mga_ent = score_cache.load(mga_path)
     missense_pos = [p for i, p in enumerate(codon_pos)
                     if (germ_aa[i]!=somatic_aa[i]) and
                        (germ_aa[i] not in ['-', '*', 'Splice_Site']) and
@@ -56,17 +140,7 @@ def retrieve_scores(gname, sdir,
 
     # get information about VEST scores
     vest_path = os.path.join(sdir, gname+".vest.pickle")
-    if os.path.exists(vest_path):
-        if sys.version_info < (3,):
-            # python 2.7 way
-            with open(vest_path) as handle:
-                vest_score = pickle.load(handle)
-        else:
-            # python 3.X way
-            with open(vest_path, 'rb') as handle:
-                vest_score = pickle.load(handle, encoding='latin-1')
-    else:
-        vest_score = None
+    vest_score = score_cache.load(vest_path)
     total_vest = compute_vest_stat(vest_score,
                                    germ_aa, somatic_aa, codon_pos,
                                    stat_func=sum, default_val=default_vest)
@@ -95,16 +169,104 @@ def read_vest_pickle(gname, score_dir):
         dict containing vest scores for gene. Returns None if not found.
     """
     vest_path = os.path.join(score_dir, gname+".vest.pickle")
-    if os.path.exists(vest_path):
-        if sys.version_info < (3,):
-            with open(vest_path) as handle:
-                gene_vest = pickle.load(handle)
-        else:
-            with open(vest_path, 'rb') as handle:
-                gene_vest = pickle.load(handle, encoding='latin-1')
-        return gene_vest
-    else:
+    return score_cache.load(vest_path)
+
+
+def vest_array(vest_dict, num_codons, default_vest=0.0):
+    """Converts VEST scores for a gene into a dense array.
+
+    The array is indexed by [codon position, reference AA code, somatic AA
+    code] using the amino acid codes from gene_effect_table. The last
+    element along each axis is reserved for missing information (NA),
+    so it always holds the default value.
+
+    Parameters
+    ----------
+    vest_dict : dict
+        dictionary containing vest scores across the gene of interest
+    num_codons : int
+        number of codons in the gene. Scores for codons past the end
+        of the gene are dropped.
+    default_vest : float, default=0.0
+        value to use if VEST score not available for a given mutation
+
+    Returns
+    -------
+    gene_vest : np.array
+        (num_codons+1) X num_aa X num_aa array of vest scores
+    """
+    num_aa = len(ge.aa_names)
+    gene_vest = np.full((num_codons+1, num_aa, num_aa), default_vest, dtype=np.float32)
+    for codon, ref_dict in vest_dict.items():
+        # scores are indexed by 1-based codon position
+        if not 0 < codon <= num_codons:
+            continue
+        for ref, alt_dict in ref_dict.items():
+            if ref not in ge.aa2code:
+                continue
+            for alt, score in alt_dict.items():
+                if alt in ge.aa2code:
+                    gene_vest[codon-1, ge.aa2code[ref], ge.aa2code[alt]] = score
+    return gene_vest
+
+
+def read_vest_array(gname, score_dir, num_codons, default_vest=0.0):
+    """Read in VEST scores for given gene as a dense array.
+
+    Parameters
+    ----------
+    gname : str
+        name of gene
+    score_dir : str
+        directory containing vest scores
+    num_codons : int
+        number of codons in the gene
+    default_vest : float, default=0.0
+        value to use if VEST score not available for a given mutation
+
+    Returns
+    -------
+    gene_vest : np.array or None
+        array of vest scores for gene (see vest_array). Returns None if
+        not found.
+    """
+    vest_dict = read_vest_pickle(gname, score_dir)
+    if vest_dict is None:
         return None
+    return vest_array(vest_dict, num_codons, default_vest)
+
+
+def compute_vest_stat_batch(gene_vest, ref_aa, somatic_aa, codon_pos,
+                            default_val=0.0):
+    """Compute the mean missense VEST score for a batch of simulations.
+
+    Like compute_vest_stat, non-missense mutations are not filtered out
+    and take the default value in gene_vest.
+
+    Parameters
+    ----------
+    gene_vest : np.array
+        dense vest scores from vest_array
+    ref_aa : np.array
+        num_simulations X num_mutations matrix of reference AA codes
+    somatic_aa : np.array
+        matrix of somatic AA codes, same shape as ref_aa
+    codon_pos : np.array
+        matrix of codon positions (NA for splice sites), same shape as ref_aa
+    default_val : float
+        default value to return if VEST scores are missing or there
+        are no mutations
+
+    Returns
+    -------
+    score_stat : np.array
+        mean vest score for each simulation
+    """
+    num_sim, num_mut = np.shape(codon_pos)
+    if gene_vest is None or not num_mut:
+        return np.full(num_sim, default_val)
+    myscores = gene_vest[codon_pos, ref_aa, somatic_aa]
+    return myscores.mean(axis=1, dtype=np.float64)
 
 
 def compute_vest_stat(vest_dict, ref_aa, somatic_aa, codon_pos,
@@ -275,20 +437,121 @@ def read_neighbor_graph_pickle(gname, graph_dir):
     """
     graph_path = os.path.join(graph_dir, gname+".pickle")
     if os.path.exists(graph_path):
-        with open(graph_path) as handle:
+        with open(graph_path, 'rb') as handle:
             gene_graph = pickle.load(handle)
         return gene_graph
     else:
         return None
 
 
+def neighbor_graph_matrix(gene_graph, alpha=.5):
+    """Converts a neighbor graph into a sparse matrix which smooths mutation
+    counts over the graph.
+
+    Each mutated codon keeps (1-alpha) of its mutation count and adds
+    alpha of its count to each of its neighbors.
+
+    Parameters
+    ----------
+    gene_graph : dict
+        Graph of spatially near codons. keys = nodes, edges = key -> value.
+    alpha : float
+        smoothing factor
+
+    Returns
+    -------
+    graph_matrix : sparse.csr_matrix
+        num_codons X num_codons smoothing matrix, rows are codons in the
+        graph and columns are codons receiving weight. Codons which are not
+        nodes in the graph have empty rows.
+    """
+    num_codons = max(gene_graph) + 1
+    nodes, neighbors = [], []
+    for pos in gene_graph:
+        tmp_neighbors = set(gene_graph[pos])
+        nodes.extend([pos]*len(tmp_neighbors))
+        neighbors.extend(tmp_neighbors)
+    nodes, neighbors = np.array(nodes, dtype=int), np.array(neighbors, dtype=int)
+    if len(neighbors) and neighbors.max() >= num_codons:
+        raise ValueError('Neighbor graph contains codons which are not nodes')
+
+    # add neighbor weights and self weights
+    graph_nodes = np.array(list(gene_graph), dtype=int)
+    row = np.concatenate([nodes, graph_nodes])
+    col = np.concatenate([neighbors, graph_nodes])
+    weight = np.concatenate([np.repeat(alpha, len(nodes)),
+                             np.repeat(1-alpha, len(graph_nodes))])
+    graph_matrix = sparse.csr_matrix((weight, (row, col)),
+                                     shape=(num_codons, num_codons))
+    return graph_matrix
+
+
+def compute_ng_stat_batch(graph_matrix, codon_pos, is_missense):
+    """Compute the clustering score on the neighbor graph for a batch of
+    simulations.
+
+    Parameters
+    ----------
+    graph_matrix : sparse.csr_matrix
+        smoothing matrix from neighbor_graph_matrix
+    codon_pos : np.array
+        num_simulations X num_mutations matrix of codon positions
+    is_missense : np.array
+        boolean matrix, same shape as codon_pos, indicating which
+        mutations are missense
+
+    Returns
+    -------
+    graph_score : np.array
+        score measuring the clustering of missense mutations in the graph
+        for each simulation
+    coverage : np.array
+        number of nodes that received non-zero weight for each simulation
+    num_mut_codons : np.array
+        number of codons with a missense mutation for each simulation
+    """
+    codon_pos = np.asarray(codon_pos)
+    is_missense = np.asarray(is_missense, dtype=bool)
+    num_sim, num_codons = codon_pos.shape[0], graph_matrix.shape[0]
+
+    # count missense mutations in each codon
+    sim_ix = np.repeat(np.arange(num_sim), codon_pos.shape[1]).reshape(codon_pos.shape)
+    mut_codons = codon_pos[is_missense]
+    is_node = np.diff(graph_matrix.indptr) > 0
+    if np.any((mut_codons >= num_codons) | (mut_codons < 0)) or \
+       not np.all(is_node[mut_codons]):
+        raise ValueError('Mutated codon is not found in the neighbor graph')
+    pos_ct = sparse.csr_matrix((np.ones(len(mut_codons)), (sim_ix[is_missense], mut_codons)),
+                               shape=(num_sim, num_codons))
+    pos_ct.sum_duplicates()
+    num_mut_codons = np.diff(pos_ct.indptr)
+
+    # smooth out mutation counts
+    codon_vals = pos_ct.dot(graph_matrix).tocsr()
+    codon_vals.eliminate_zeros()
+    row_ix = np.repeat(np.arange(num_sim), np.diff(codon_vals.indptr))
+
+    # compute regular entropy
+    row_total = np.asarray(codon_vals.sum(axis=1)).ravel()
+    p = codon_vals.data / row_total[row_ix]
+    graph_score = -np.bincount(row_ix, weights=p*np.log2(p), minlength=num_sim)
+
+    # get coverage
+    coverage = np.bincount(row_ix, minlength=num_sim)
+
+    # skip if there are no missense mutations
+    graph_score[num_mut_codons == 0] = 1.0
+    return graph_score, coverage, num_mut_codons
+
+
 def compute_ng_stat(gene_graph, pos_ct, alpha=.5):
     """Compute the clustering score for the gene on its neighbor graph.
 
     Parameters
     ----------
-    gene_graph : dict
+    gene_graph : dict or sparse.csr_matrix
         Graph of spatially near codons. keys = nodes, edges = key -> value.
+        May also be the output of neighbor_graph_matrix.
     pos_ct : dict
         missense mutation count for each codon
     alpha : float
@@ -305,30 +568,9 @@ def compute_ng_stat(gene_graph, pos_ct, alpha=.5):
     if not len(pos_ct):
         return 1.0, 0
 
-    max_pos = max(gene_graph)
-    codon_vals = np.zeros(max_pos+1)
-
-    # smooth out mutation counts
-    for pos in pos_ct:
-        mut_count = pos_ct[pos]
-
-        # update neighbor values
-        neighbors = list(gene_graph[pos])
-        num_neighbors = len(neighbors)
-        codon_vals[neighbors] += alpha*mut_count
-
-        # update self-value
-        codon_vals[pos] += (1-alpha)*mut_count
-
-    # compute the normalized entropy
-    #total_cts = float(np.count_nonzero(codon_vals))
-    #graph_score = mymath.normalized_mutation_entropy(codon_vals, total_cts=total_cts)
-
-    # compute regular entropy
-    p = codon_vals / np.sum(codon_vals)
-    graph_score = mymath.shannon_entropy(p)
-
-    # get coverage
-    coverage = np.count_nonzero(p)
-
-    return graph_score, coverage
+    if isinstance(gene_graph, dict):
+        gene_graph = neighbor_graph_matrix(gene_graph, alpha)
+    codon_pos = np.array([[pos for pos in pos_ct for k in range(pos_ct[pos])]])
+    is_missense = np.ones(codon_pos.shape, dtype=bool)
+    graph_score, coverage, _ = compute_ng_stat_batch(gene_graph, codon_pos, is_missense)
+    return float(graph_score[0]), int(coverage[0])
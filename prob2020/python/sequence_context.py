@@ -1,23 +1,273 @@
 import numpy as np
+import os
+import hashlib
+import tempfile
 import prob2020.python.utils as utils
+import prob2020.python.gene_effect_table as ge
 import prob2020.python.mutation_context
 
+# nucleotides which form the 64 trinucleotides in the context lookup table
+_table_bases = 'ACGT'
+_context_tables = {}  # lookup tables for each level of context
+
+
+def _context_name(left, mid, right, nuc_context):
+    """Returns the name of the sequence context for a mutated base (mid)
+    given its upstream (left) and downstream (right) bases."""
+    if nuc_context == 1:
+        return mid
+    elif nuc_context == 2:
+        return left + mid
+    elif nuc_context == 1.5:
+        return prob2020.python.mutation_context.get_chasm_context(left+mid+right)
+    else:
+        return left + mid + right
+
+
+def trinuc_context_table(nuc_context):
+    """Creates a lookup table from trinucleotides to sequence contexts.
+
+    Trinucleotides are encoded as 16*left + 4*mid + right using the base
+    index from gene_effect_table.
+
+    Parameters
+    ----------
+    nuc_context : {1, 1.5, 2, 3}
+        level of sequence context
+
+    Returns
+    -------
+    context_table : np.array
+        64 element array with the index into context_names for each
+        trinucleotide
+    context_names : list of str
+        names of the contexts
+    """
+    if nuc_context not in _context_tables:
+        trinucs = [l+m+r for l in _table_bases for m in _table_bases for r in _table_bases]
+        table_names = [_context_name(t[0], t[1], t[2], nuc_context) for t in trinucs]
+        context_names = sorted(set(table_names))
+        name2ix = {c: i for i, c in enumerate(context_names)}
+        context_table = np.array([name2ix[c] for c in table_names], dtype=np.int32)
+        _context_tables[nuc_context] = (context_table, context_names)
+    context_table, context_names = _context_tables[nuc_context]
+    return context_table, list(context_names)
+
+
+class ContextIndex(object):
+    """On-disk index of sequence contexts.
+
+    Each gene is stored as a separate .npz file named by the gene, the
+    level of sequence context and a digest of the gene sequence, so
+    sequences from a different gene FASTA are never mixed up.
+
+    Parameters
+    ----------
+    index_dir : str
+        directory containing the index files
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        if not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                # directory may be created by another process
+                if not os.path.isdir(index_dir):
+                    raise
+
+    def path(self, gene_seq):
+        """Path of the index file for the gene sequence."""
+        seq_str = '|'.join([gene_seq.exon_seq,
+                            ','.join(gene_seq.five_prime_seq),
+                            ','.join(gene_seq.three_prime_seq)])
+        digest = hashlib.md5(seq_str.encode('ascii')).hexdigest()
+        fname = '{0}.{1}.{2}.npz'.format(gene_seq.bed.gene_name,
+                                         gene_seq.nuc_context,
+                                         digest)
+        return os.path.join(self.index_dir, fname)
+
+    def load(self, gene_seq):
+        """Loads the sequence contexts for a gene.
+
+        Returns
+        -------
+        context_info : dict or None
+            arrays stored by save, None if the gene is not indexed
+        """
+        path = self.path(gene_seq)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            context_info = {k: data[k] for k in data.files}
+        context_info['context_names'] = context_info['context_names'].tolist()
+        return context_info
+
+    def save(self, gene_seq, seq_context):
+        """Saves the sequence contexts of a gene."""
+        path = self.path(gene_seq)
+        # write to a temporary file first so readers never see partial files
+        handle, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.npz')
+        with os.fdopen(handle, 'wb') as tmp_file:
+            np.savez(tmp_file,
+                     context_names=np.array(seq_context.context_names, dtype=str),
+                     context_pos=seq_context.context_pos,
+                     context_offsets=seq_context.context_offsets,
+                     pos_context=seq_context.pos_context)
+        os.rename(tmp_path, path)
+
+
+class PrngDict(dict):
+    """Dictionary of random number generators for each sequence context.
+
+    Generators are only created when a context is first used, since
+    seeding a generator for each of the possible contexts is costly. Each
+    context has its own stream derived from the seed.
+    """
+
+    def __init__(self, seed=None):
+        super(PrngDict, self).__init__()
+        self.seed = seed
+
+    def __missing__(self, context):
+        prng = np.random.default_rng(utils.seed_sequence(self.seed, 'context', context))
+        self[context] = prng
+        return prng
+
 
 class SequenceContext(object):
     """The SequenceContext class allows for deciphering sequence context
     and for randomly permuting mutation positions while respecting sequence context.
+
+    Random positions are drawn from generators seeded by seed, which is
+    either an int or a SeedSequence from utils.seed_sequence (e.g. for the
+    stream of a single gene).
     """
 
-    def __init__(self, gene_seq, seed=None):
-        self._init_context(gene_seq)
-        self.seed = seed  # seed for random number generator
-        context_names = prob2020.python.mutation_context.get_all_context_names(gene_seq.nuc_context)
-        self.prng_dict = {
-            c: np.random.RandomState(seed=self.seed)
-            for c in context_names
-        }
+    def __init__(self, gene_seq, seed=None, context_index=None):
+        context_info = context_index.load(gene_seq) if context_index else None
+        if context_info is None:
+            self._init_context(gene_seq, **self._compute_context(gene_seq))
+            if context_index:
+                context_index.save(gene_seq, self)
+        else:
+            self._init_context(gene_seq, **context_info)
+        # seed for random number generators, see utils.seed_sequence
+        self.seed = utils.seed_sequence(seed)
+        self.prng_dict = PrngDict(self.seed)
+        # random number generator for sampling all contexts at once
+        self.prng = np.random.default_rng(self.seed)
 
-    def _init_context(self, gene_seq):
+    def _compute_context(self, gene_seq):
+        """Computes the sequence context of every position in the gene.
+
+        Contexts of coding positions are looked up from the trinucleotide
+        formed with their neighboring bases. The first and last coding base
+        use themselves as the missing neighbor. Splice site contexts come
+        from the flanking sequence of each splice site.
+
+        Parameters
+        ----------
+        gene_seq : GeneSequence
+            GeneSequence object from the gene_sequence module
+
+        Returns
+        -------
+        context_info : dict
+            context_names, context_pos, context_offsets and pos_context
+            arrays (see _init_context)
+        """
+        nuc_context = gene_seq.nuc_context
+        gene_len = len(gene_seq.exon_seq)  # get length of CDS
+        ss_seqs = gene_seq.five_prime_seq + gene_seq.three_prime_seq
+        num_pos = gene_len + 2*len(ss_seqs)
+
+        if nuc_context not in [1, 1.5, 2, 3]:
+            # case where there is no context,
+            # mutations occur with uniform probability at each
+            # position
+            return {'context_names': ['None'],
+                    'context_pos': np.arange(num_pos, dtype=np.int32),
+                    'context_offsets': np.array([0, num_pos], dtype=np.int64),
+                    'pos_context': np.zeros(num_pos, dtype=np.int32)}
+
+        # upstream and downstream base for each coding position
+        cds_pos = np.arange(gene_len)
+        left = np.maximum(cds_pos-1, 0)
+        right = np.minimum(cds_pos+1, gene_len-1)
+
+        # look up the context of each coding position
+        seq_ix = ge.encode_seq(gene_seq.exon_seq).astype(np.int32)
+        context_table, context_names = trinuc_context_table(nuc_context)
+        pos_context = np.zeros(num_pos, dtype=np.int32)
+        is_valid = seq_ix[cds_pos] < len(_table_bases)
+        if nuc_context != 1:
+            is_valid &= seq_ix[left] < len(_table_bases)
+        if nuc_context in [1.5, 3]:
+            is_valid &= seq_ix[right] < len(_table_bases)
+        else:
+            # downstream base does not matter
+            right = cds_pos
+        trinuc = 16*seq_ix[left] + 4*seq_ix[cds_pos] + seq_ix[right]
+        pos_context[:gene_len][is_valid] = context_table[trinuc[is_valid]]
+
+        # contexts containing bases outside of the lookup table
+        name2ix = {c: i for i, c in enumerate(context_names)}
+        seq = gene_seq.exon_seq
+        for i in np.flatnonzero(~is_valid):
+            c = _context_name(seq[left[i]], seq[i], seq[right[i]], nuc_context)
+            pos_context[i] = name2ix.setdefault(c, len(context_names))
+            if pos_context[i] == len(context_names):
+                context_names.append(c)
+
+        # sequence context for five prime and then three prime splice sites
+        for i, ss in enumerate(ss_seqs):
+            for k in [1, 2]:
+                if nuc_context in [1, 2]:
+                    index_context = int(nuc_context) - 1
+                    c = ss[k-index_context:k+1]
+                else:
+                    c = _context_name(ss[k-1], ss[k], ss[k+1], nuc_context)
+                pos = gene_len + 2*i + k - 1
+                pos_context[pos] = name2ix.setdefault(c, len(context_names))
+                if pos_context[pos] == len(context_names):
+                    context_names.append(c)
+
+        # order positions within a context. The first (and last, for
+        # contexts using the downstream base) coding position are listed
+        # after the splice sites.
+        if nuc_context == 1:
+            head, tail = np.arange(gene_len), []
+        elif nuc_context == 2:
+            head, tail = np.arange(1, gene_len), [0]
+        else:
+            head, tail = np.arange(1, gene_len-1), [0, gene_len-1]
+        tail = [p for p in tail if 0 <= p < gene_len]
+        pos_order = np.concatenate([head,
+                                    np.arange(gene_len, num_pos),
+                                    np.unique(tail)]).astype(np.int32)
+
+        # keep only contexts found in the gene, sorted by name
+        found_ix = np.unique(pos_context)
+        found_names = [context_names[i] for i in found_ix]
+        name_order = np.argsort(found_names, kind='stable')
+        remap = np.zeros(len(context_names), dtype=np.int32)
+        remap[found_ix[name_order]] = np.arange(len(found_ix))
+        pos_context = remap[pos_context]
+
+        # group positions by context
+        order_context = pos_context[pos_order]
+        context_pos = pos_order[np.argsort(order_context, kind='stable')]
+        context_offsets = np.zeros(len(found_ix)+1, dtype=np.int64)
+        context_offsets[1:] = np.cumsum(np.bincount(order_context, minlength=len(found_ix)))
+        return {'context_names': [found_names[i] for i in name_order],
+                'context_pos': context_pos,
+                'context_offsets': context_offsets,
+                'pos_context': pos_context}
+
+    def _init_context(self, gene_seq, context_names, context_pos,
+                      context_offsets, pos_context):
         """Initializes attributes defining mutation contexts and their position.
 
         The self.context2pos and self.pos2context dictionaries map from
@@ -26,133 +276,70 @@ class SequenceContext(object):
         sampling of mutation positions while respecting sequence context in the
         randomization-based test.
 
+        Positions for the i-th context in self.context_names are
+        self.context_pos[self.context_offsets[i]:self.context_offsets[i+1]],
+        while self.pos_context holds the index of the context for each
+        position.
+
         Parameters
         ----------
         gene_seq : GeneSequence
             GeneSequence object from the gene_sequence module
+        context_names : list of str
+            sorted names of the contexts found in the gene
+        context_pos : np.array
+            positions grouped by context
+        context_offsets : np.array
+            start of each context in context_pos
+        pos_context : np.array
+            context index for each position
         """
-        self.context2pos, self.pos2context = {}, {}
-        gene_len = len(gene_seq.exon_seq)  # get length of CDS
-        five_ss_len = 2*len(gene_seq.five_prime_seq)  # total length of 5' splice sites
-        three_ss_len = 2*len(gene_seq.three_prime_seq)  # total length of 3' splice sites
-
-        if gene_seq.nuc_context in [1, 2]:
-            # case where context matters
-            index_context = int(gene_seq.nuc_context) - 1  # subtract 1 since python is zero-based index
-            for i in range(index_context, gene_len):
-                nucs = gene_seq.exon_seq[i-index_context:i+1]
-                self.context2pos.setdefault(nucs, [])
-                self.context2pos[nucs].append(i)
-                self.pos2context[i] = nucs
-
-            # sequence context for five prime splice site
-            for i, five_ss in enumerate(gene_seq.five_prime_seq):
-                first_nucs = five_ss[1-index_context:1+1]
-                second_nucs = five_ss[2-index_context:2+1]
-                first_pos = 2*i + gene_len
-                second_pos = 2*i + gene_len + 1
-                self.context2pos.setdefault(first_nucs, [])
-                self.context2pos[first_nucs].append(first_pos)
-                self.context2pos.setdefault(second_nucs, [])
-                self.context2pos[second_nucs].append(second_pos)
-                self.pos2context[first_pos] = first_nucs
-                self.pos2context[second_pos] = second_nucs
-            # sequence context for three prime splice site
-            for i, three_ss in enumerate(gene_seq.three_prime_seq):
-                first_nucs = three_ss[1-index_context:1+1]
-                second_nucs = three_ss[2-index_context:2+1]
-                first_pos = 2*i + gene_len + five_ss_len
-                second_pos = 2*i + gene_len + five_ss_len + 1
-                self.context2pos.setdefault(first_nucs, [])
-                self.context2pos[first_nucs].append(first_pos)
-                self.context2pos.setdefault(second_nucs, [])
-                self.context2pos[second_nucs].append(second_pos)
-                self.pos2context[first_pos] = first_nucs
-                self.pos2context[second_pos] = second_nucs
-
-            # hack solution for context for first nuc
-            if gene_seq.exon_seq and gene_seq.nuc_context > 1:
-                self.pos2context[0] = gene_seq.exon_seq[0] * 2
-                self.context2pos.setdefault(gene_seq.exon_seq[0]*2, [])
-                self.context2pos[gene_seq.exon_seq[0]*2].append(0)
-        elif gene_seq.nuc_context in [1.5, 3]:
-            # use the nucleotide context from chasm if nuc
-            # context is 1.5 otherwise always use a three
-            # nucleotide context
-            ncontext = gene_seq.nuc_context
-            for i in range(1, len(gene_seq.exon_seq)-1):
-                nucs = gene_seq.exon_seq[i-1:i+2]
-                if ncontext == 1.5:
-                    context = prob2020.python.mutation_context.get_chasm_context(nucs)
-                else:
-                    context = nucs
-                self.context2pos.setdefault(context, [])
-                self.context2pos[context].append(i)
-                self.pos2context[i] = context
-
-            # sequence context for five prime splice site
-            for i, five_ss in enumerate(gene_seq.five_prime_seq):
-                first_nucs = five_ss[:3]
-                second_nucs = five_ss[1:4]
-                first_pos = 2*i + gene_len
-                second_pos = 2*i + gene_len + 1
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nucs)
-                    second_context = prob2020.python.mutation_context.get_chasm_context(second_nucs)
-                else:
-                    first_context = first_nucs
-                    second_context = second_nucs
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(first_pos)
-                self.context2pos.setdefault(second_context, [])
-                self.context2pos[second_context].append(second_pos)
-                self.pos2context[first_pos] = first_context
-                self.pos2context[second_pos] = second_context
-            # sequence context for three prime splice site
-            for i, three_ss in enumerate(gene_seq.three_prime_seq):
-                first_nucs = three_ss[:3]
-                second_nucs = three_ss[1:4]
-                first_pos = 2*i + gene_len + five_ss_len
-                second_pos = 2*i + gene_len + five_ss_len + 1
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nucs)
-                    second_context = prob2020.python.mutation_context.get_chasm_context(second_nucs)
-                else:
-                    first_context = first_nucs
-                    second_context = second_nucs
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(first_pos)
-                self.context2pos.setdefault(second_context, [])
-                self.context2pos[second_context].append(second_pos)
-                self.pos2context[first_pos] = first_context
-                self.pos2context[second_pos] = second_context
-
-            # hack solution for context for first nuc
-            if gene_seq.exon_seq:
-                first_nuc = gene_seq.exon_seq[0] + gene_seq.exon_seq[:2]
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nuc)
-                else:
-                    first_context = first_nuc
-                self.pos2context[0] = first_context
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(0)
-                last_nuc = gene_seq.exon_seq[-2:] + gene_seq.exon_seq[-1]
-                if ncontext == 1.5:
-                    last_context = prob2020.python.mutation_context.get_chasm_context(last_nuc)
-                else:
-                    last_context = last_nuc
-                last_pos = len(gene_seq.exon_seq) - 1
-                self.pos2context[last_pos] = first_context
-                self.context2pos.setdefault(last_context, [])
-                self.context2pos[last_context].append(last_pos)
+        self.context_names = context_names
+        self.context2ix = {c: i for i, c in enumerate(context_names)}
+        self.context_pos = context_pos.astype(np.int32)
+        self.context_offsets = context_offsets.astype(np.int64)
+        self.pos_context = pos_context.astype(np.int32)
+        self.context_pos.setflags(write=False)
+
+        # dictionary look ups
+        if context_names == ['None']:
+            self.context2pos = {'None': range(len(pos_context))}
         else:
-            # case where there is no context,
-            # mutations occur with uniform probability at each
-            # position
-            for i in range(gene_len + five_ss_len + three_ss_len):
-                self.pos2context[i] = 'None'
-            self.context2pos['None'] = range(gene_len + five_ss_len + three_ss_len)
+            self.context2pos = {c: self.context_positions(c).tolist()
+                                for c in context_names}
+        self._name_array = np.array(context_names, dtype=object)
+        self.pos2context = dict(enumerate(self._name_array[self.pos_context].tolist()))
+
+    def context_positions(self, ctxt):
+        """Returns the positions matching a sequence context.
+
+        Parameters
+        ----------
+        ctxt : str
+            mutation context
+
+        Returns
+        -------
+        context_pos : np.array
+            positions with the sequence context (read-only view)
+        """
+        ix = self.context2ix[ctxt]
+        return self.context_pos[self.context_offsets[ix]:self.context_offsets[ix+1]]
+
+    def pos_contexts(self, pos):
+        """Returns the sequence context of each position.
+
+        Parameters
+        ----------
+        pos : np.array
+            positions along the gene
+
+        Returns
+        -------
+        contexts : np.array
+            context name for each position (object array)
+        """
+        return self._name_array[self.pos_context[np.asarray(pos, dtype=np.intp)]]
 
     def is_valid_context(self, ctxt):
         """Checks if provided context is valid (previously seen).
@@ -185,7 +372,7 @@ class SequenceContext(object):
         Returns
         -------
         random_pos : np.array
-            num_permutations X num sized array that represents the
+            num_permutations X num sized int32 array that represents the
             randomly sampled positions for a specific context.
         """
         # make sure provide context is valid
@@ -200,7 +387,7 @@ class SequenceContext(object):
             raise ValueError(error_msg)
 
         # randomly select from available positions that fit the specified context
-        available_pos = self.context2pos[context]
+        available_pos = self.context_positions(context)
         random_pos = self.prng_dict[context].choice(available_pos, (num_permutations, num))
         return random_pos
 
@@ -227,3 +414,55 @@ class SequenceContext(object):
             position_list.append([contxt, pos_array])
         return position_list
 
+    def random_pos_matrix(self, context_iterable, num_permutations, out=None):
+        """Obtains random positions w/ replacement which match sequence context
+        for all contexts with a single draw.
+
+        Parameters
+        ----------
+        context_iterable: iterable containing two element tuple
+            Records number of mutations in each context. context_iterable
+            should be something like [('AA', 5), ...].
+        num_permutations : int
+            Number of permutations used in the permutation test.
+        out : np.array, optional
+            preallocated int32 array with shape num_permutations X total
+            number of mutations to fill with the sampled positions
+
+        Returns
+        -------
+        random_pos : np.array
+            num_permutations X total number of mutations array of
+            positions. Columns are ordered by context, following
+            context_iterable.
+        """
+        # find where to sample each column from in the concatenated positions
+        col_offset, col_size = [], []
+        for contxt, n in context_iterable:
+            if not self.is_valid_context(contxt):
+                error_msg = 'Context ({0}) was never seen in sequence.'.format(contxt)
+                raise ValueError(error_msg)
+            if n < 1:
+                error_msg = ('There must be at least one sample (specified {0}) '
+                             'for a context'.format(n))
+                raise ValueError(error_msg)
+            ix = self.context2ix[contxt]
+            col_offset += [self.context_offsets[ix]] * n
+            col_size += [self.context_offsets[ix+1] - self.context_offsets[ix]] * n
+        col_offset = np.array(col_offset, dtype=np.int64)
+        col_size = np.array(col_size, dtype=np.int64)
+        if out is None:
+            out = np.empty((num_permutations, len(col_size)), dtype=np.int32)
+
+        # draw a uniform index within the context for every mutation by
+        # scaling a single uniform draw by the context sizes, then look up
+        # the corresponding position
+        if len(col_size):
+            pos_ix = self.prng.random(out.shape)
+            pos_ix *= col_size
+            pos_ix = pos_ix.astype(np.int64)
+            np.minimum(pos_ix, col_size-1, out=pos_ix)  # guard against round-off
+            pos_ix += col_offset
+            np.take(self.context_pos, pos_ix, out=out)
+        return out
+
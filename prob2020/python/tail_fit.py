@@ -0,0 +1,214 @@
+"""Generalized Pareto approximation of small permutation p-values.
+
+P-values estimated from simulations can not resolve values much smaller
+than one over the number of simulations. When few null values are at least
+as extreme as the observed statistic, the tail of the null distribution is
+instead approximated by a generalized Pareto distribution (GPD) fit to the
+largest null values (Knijnenburg et al. 2009, Bioinformatics 25:i161),
+which extrapolates p-values below the resolution of the simulations.
+
+Statistics are oriented so that larger values are more extreme, e.g. the
+position entropy is negated. The GPD is fit by probability weighted moments
+(Hosking and Wallis 1987), which is fast enough to fit many bootstrap
+samples for confidence intervals.
+"""
+import numpy as np
+import scipy.stats as stats
+
+# number of largest null values kept to fit the tail of the null distribution
+TAIL_SIZE = 250
+
+# p-values with fewer null values at least as extreme as the observed
+# statistic are estimated from the tail fit
+MIN_EXCEED = 10
+
+# minimum number of null values above the tail threshold to fit a GPD
+MIN_TAIL_EXCEED = 20
+
+# bootstrap samples and confidence level of the p-value confidence intervals
+NUM_BOOTSTRAP = 200
+CI_LEVEL = .95
+
+
+def top_values(values, size=TAIL_SIZE):
+    """Keeps the largest values.
+
+    Parameters
+    ----------
+    values : np.array
+        null values, larger values being more extreme
+    size : int
+        number of values to keep
+
+    Returns
+    -------
+    top : np.array
+        the largest size values (unordered)
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) <= size:
+        return values
+    return np.partition(values, len(values) - size)[-size:]
+
+
+def tail_from_hist(null_hist, size=TAIL_SIZE):
+    """Gets the largest values of a null distribution stored as a histogram
+    of integer values (e.g. the hotmaps windowed sums)."""
+    null_hist = np.asarray(null_hist)
+    values = np.flatnonzero(null_hist)[::-1]
+    counts = np.cumsum(null_hist[values])
+    num_bins = np.searchsorted(counts, size) + 1
+    top = np.repeat(values[:num_bins], null_hist[values[:num_bins]])
+    return top[:size].astype(float)
+
+
+def fit_gpd(exceed):
+    """Fits generalized Pareto distributions by probability weighted moments.
+
+    Tails estimated to be bounded (negative shape) are approximated by an
+    exponential tail instead, which never underestimates the p-value far
+    beyond the largest null values.
+
+    Parameters
+    ----------
+    exceed : np.array
+        2D array of positive exceedances over the tail threshold, one sample
+        per row, each row sorted in ascending order
+
+    Returns
+    -------
+    shape : np.array
+        shape parameter (xi) of each sample, at least zero
+    scale : np.array
+        scale parameter of each sample
+    """
+    num_exceed = exceed.shape[1]
+    weights = 1 - (np.arange(1, num_exceed+1) - .35) / num_exceed
+    a0 = exceed.mean(axis=1)
+    a1 = (exceed * weights).mean(axis=1)
+    denom = a0 - 2*a1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shape = 2 - a0 / denom
+        scale = 2 * a0 * a1 / denom
+    is_exponential = ~((denom > 0) & (shape > 0))
+    shape = np.where(is_exponential, 0., shape)
+    scale = np.where(is_exponential, a0, scale)
+    return shape, scale
+
+
+def gpd_sf(y, shape, scale):
+    """Survival function of the generalized Pareto distribution."""
+    y = np.maximum(y, 0)
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        sf_pareto = (1 + shape * y / scale) ** (-1. / shape)
+        sf_exponential = np.exp(-y / scale)
+    return np.where(shape > 1e-8, sf_pareto, sf_exponential)
+
+
+def tail_p_values(obs, tail, num_sim):
+    """Estimates p-values from a GPD fit to the tail of the null distribution.
+
+    The smallest value in tail is used as threshold, so the p-value is the
+    fraction of simulations above the threshold times the GPD probability
+    of exceeding the observed statistic. Confidence intervals come from
+    bootstrap samples of the exceedances, using a fixed seed so results are
+    reproducible.
+
+    Parameters
+    ----------
+    obs : np.array
+        observed statistics, larger values being more extreme
+    tail : np.array
+        largest null values (see top_values)
+    num_sim : int
+        number of simulated null values
+
+    Returns
+    -------
+    pvals : np.array or None
+        (p-value, lower, upper confidence bound) for each observed statistic,
+        NaN for statistics not beyond the threshold. None if the tail could
+        not be fit.
+    """
+    obs = np.atleast_1d(np.asarray(obs, dtype=float))
+    tail = np.sort(np.asarray(tail, dtype=float))
+    if not len(tail):
+        return None
+    threshold = tail[0]
+    exceed = tail[tail > threshold] - threshold
+    if len(exceed) < MIN_TAIL_EXCEED:
+        return None
+    frac_exceed = len(exceed) / float(num_sim)
+
+    # fit the observed exceedances and bootstrap samples at once
+    prng = np.random.default_rng(0)
+    boot_ix = prng.integers(0, len(exceed), size=(NUM_BOOTSTRAP, len(exceed)))
+    samples = np.vstack([exceed[None, :], np.sort(exceed[boot_ix], axis=1)])
+    shape, scale = fit_gpd(samples)
+    sim_pvals = frac_exceed * gpd_sf(obs[None, :] - threshold,
+                                     shape[:, None], scale[:, None])
+
+    alpha = (1 - CI_LEVEL) / 2.
+    ci_low, ci_high = np.percentile(sim_pvals[1:], [100*alpha, 100*(1-alpha)], axis=0)
+    pvals = np.column_stack([sim_pvals[0], ci_low, ci_high])
+    pvals[obs <= threshold] = np.nan
+    return pvals
+
+
+def binomial_ci(num_null, num_sim):
+    """Clopper-Pearson confidence interval of empirical p-values."""
+    num_null = np.asarray(num_null, dtype=float)
+    alpha = (1 - CI_LEVEL) / 2.
+    with np.errstate(invalid='ignore'):
+        ci_low = stats.beta.ppf(alpha, num_null, num_sim - num_null + 1)
+        ci_high = stats.beta.ppf(1 - alpha, num_null + 1, num_sim - num_null)
+    ci_low = np.where(num_null > 0, ci_low, 0.)
+    ci_high = np.where(num_null < num_sim, ci_high, 1.)
+    return ci_low, ci_high
+
+
+def p_value_cis(obs, num_null, num_sim, tail=None):
+    """Calculates p-values and their confidence intervals.
+
+    P-values are the empirical fraction of null values at least as extreme
+    as the observed statistic, unless there are fewer than MIN_EXCEED of
+    them and the tail of the null distribution can be fit.
+
+    Parameters
+    ----------
+    obs : np.array
+        observed statistics, larger values being more extreme
+    num_null : np.array
+        number of null values at least as extreme as each observed statistic
+    num_sim : int
+        number of simulated null values
+    tail : np.array or None
+        largest null values, None to only use the empirical p-values
+
+    Returns
+    -------
+    pvals : np.array
+        (p-value, lower, upper confidence bound) for each observed statistic
+    """
+    num_null = np.atleast_1d(np.asarray(num_null, dtype=float))
+    ci_low, ci_high = binomial_ci(num_null, num_sim)
+    pvals = np.column_stack([num_null / num_sim, ci_low, ci_high])
+    is_tail = num_null < MIN_EXCEED
+    if tail is not None and is_tail.any():
+        tail_pvals = tail_p_values(np.atleast_1d(obs)[is_tail], tail, num_sim)
+        if tail_pvals is not None:
+            is_fit = ~np.isnan(tail_pvals[:, 0])
+            pvals[np.flatnonzero(is_tail)[is_fit]] = tail_pvals[is_fit]
+    return pvals
+
+
+def p_value_ci(obs, num_null, num_sim, tail=None):
+    """Calculates a single p-value and its confidence interval (see
+    p_value_cis).
+
+    Returns
+    -------
+    pval_ci : tuple
+        (p-value, lower, upper confidence bound)
+    """
+    return tuple(float(x) for x in p_value_cis([obs], [num_null], num_sim, tail)[0])
@@ -72,6 +72,36 @@ variant_indel = variant_frameshift + variant_in_frame_indel
 # all variants
 all_variants = variant_snv + variant_indel
 
+def seed_sequence(seed, *keys):
+    """Creates the seed of an independent random number stream.
+
+    Streams are identified by keys, such as the gene name, the kind of test
+    and the chunk of iterations, so the random numbers used for a gene do not
+    depend on the order genes are processed in or on the number of processes.
+
+    Parameters
+    ----------
+    seed : int, np.random.SeedSequence or None
+        user provided seed, None for a random seed. If a SeedSequence is
+        provided, the keys identify a stream derived from it.
+    keys : str or int
+        identifiers of the stream
+
+    Returns
+    -------
+    seed_seq : np.random.SeedSequence
+        seed for np.random.default_rng
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        entropy, spawn_key = seed.entropy, seed.spawn_key
+    else:
+        entropy, spawn_key = seed, ()
+    spawn_key = tuple(spawn_key) + tuple(int.from_bytes(k.encode('utf8'), 'little')
+                                         if isinstance(k, str) else int(k)
+                                         for k in keys)
+    return np.random.SeedSequence(entropy, spawn_key=spawn_key)
+
+
 def start_logging(log_file='', log_level='INFO', verbose=False):
     """Start logging information into the log directory.
 
@@ -215,7 +245,7 @@ def bed_generator(bed_path):
     Parameters
     ----------
     bed_path : str
-        path to BED file
+        path to BED file or a compiled reference
 
     Yields
     ------
@@ -223,6 +253,13 @@ def bed_generator(bed_path):
         A BedLine object which has parsed the individual line in
         a BED file.
     """
+    # imported here since the reference module depends on utils
+    import prob2020.python.reference as reference
+    if reference.is_compiled_reference(bed_path):
+        for bed in reference.CompiledReference(bed_path).bed_generator():
+            yield bed
+        return
+
     with open(bed_path) as handle:
         bed_reader = csv.reader(handle, delimiter='\t')
         for line in bed_reader:
@@ -236,7 +273,7 @@ def read_bed(file_path, restricted_genes=None):
     Parameters
     ----------
     file_path : str
-        path to BED file
+        path to BED file or a compiled reference
     filtered_genes: list
         list of gene names to not use
 
@@ -382,7 +419,7 @@ def calc_windowed_sum(aa_mut_pos,
         Window size as first key points to dictionary of mutated positions (key)
         with associated mutation count within the window size (value)
     """
-    pos_ctr, pos_sum = {}, {w: {} for w in window}
+    missense_pos = []
     num_pos = len(aa_mut_pos)
     # figure out the missense mutations
     for i in range(num_pos):
@@ -392,35 +429,70 @@ def calc_windowed_sum(aa_mut_pos,
            somatic_aa[i] != '*' and germ_aa[i] != somatic_aa[i]:
             # should have a position, but if not skip it
             if pos is not None:
-                pos_ctr.setdefault(pos, 0)
-                pos_ctr[pos] += 1
+                missense_pos.append(pos)
 
     # calculate windowed sum
-    pos_list = sorted(pos_ctr.keys())
-    max_window = max(window)
-    for ix, pos in enumerate(pos_list):
-        tmp_sum = {w: 0 for w in window}
-        # go through the same and lower positions
-        for k in reversed(range(ix+1)):
-            pos2 = pos_list[k]
-            if pos2 < pos-max_window: break
-            for w in window:
-                if pos-w <= pos2:
-                    tmp_sum[w] += pos_ctr[pos2]
-        # go though the higher positions
-        for l in range(ix+1, len(pos_list)):
-            pos2 = pos_list[l]
-            if pos2 > pos+max_window: break
-            for w in window:
-                if pos2 <= pos+w:
-                    tmp_sum[w] += pos_ctr[pos2]
-        # iterate through all other positions
-        #for pos2 in pos_list:
-            #for w in window:
-                #if pos-w <= pos2 <= pos+w:
-                    #tmp_sum[w] += pos_ctr[pos2]
-        # update windowed counts
-        for w in window:
-            pos_sum[w][pos] = tmp_sum[w]
-
+    num_codons = max(missense_pos) + 1 if missense_pos else 0
+    codon_pos = np.array([missense_pos], dtype=int)
+    is_missense = np.ones(codon_pos.shape, dtype=bool)
+    pos_ct, window_sum = calc_windowed_sum_batch(codon_pos, is_missense,
+                                                 window, num_codons)
+
+    # convert to dictionaries
+    mutated_pos = np.flatnonzero(pos_ct[0])
+    pos_ctr = {int(pos): int(pos_ct[0, pos]) for pos in mutated_pos}
+    pos_sum = {w: {int(pos): int(window_sum[w][0, pos]) for pos in mutated_pos}
+               for w in window}
     return pos_ctr, pos_sum
+
+
+def calc_windowed_sum_batch(codon_pos,
+                            is_missense,
+                            window,
+                            num_codons):
+    """Calculate the sum of mutations within a window around each codon for
+    a batch of simulations.
+
+    Missense mutations are counted for every codon in a simulations X
+    protein length matrix, and the windowed sums for all window sizes are
+    obtained from a single cumulative sum.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        num_simulations X num_mutations matrix of codon positions
+    is_missense : np.array
+        boolean matrix, same shape as codon_pos, indicating which
+        mutations are missense
+    window : list
+        List of windows to calculate for
+    num_codons : int
+        number of codons in the protein
+
+    Returns
+    -------
+    pos_ct : np.array
+        num_simulations X num_codons matrix of missense mutation counts
+    window_sum : dict
+        Window size as key points to a num_simulations X num_codons matrix
+        of the mutation count within the window size around each codon
+    """
+    codon_pos = np.asarray(codon_pos)
+    is_missense = np.asarray(is_missense, dtype=bool)
+    num_sim = codon_pos.shape[0]
+
+    # count missense mutations at each codon for every simulation
+    row_offset = np.arange(num_sim)[:, np.newaxis] * num_codons
+    flat_pos = (codon_pos + row_offset)[is_missense]
+    pos_ct = np.bincount(flat_pos, minlength=num_sim*num_codons).reshape(num_sim, num_codons)
+
+    # windowed sums are differences of the cumulative sum
+    cum_ct = np.zeros((num_sim, num_codons+1), dtype=pos_ct.dtype)
+    np.cumsum(pos_ct, axis=1, out=cum_ct[:, 1:])
+    codons = np.arange(num_codons)
+    window_sum = {}
+    for w in window:
+        lower = np.clip(codons - w, 0, num_codons)
+        upper = np.clip(codons + w + 1, 0, num_codons)
+        window_sum[w] = cum_ct[:, upper] - cum_ct[:, lower]
+    return pos_ct, window_sum
@@ -0,0 +1,59 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+import prob2020.python.utils as utils
+import prob2020.python.mutation_context as mc
+import numpy as np
+import pandas as pd
+import pickle
+
+
+def test_query_positions():
+    # CTNNB1 is on the + strand and TP53 on the - strand
+    for bed_name in ['data/CTNNB1.bed', 'data/tp53.bed']:
+        with open(os.path.join(file_dir, bed_name)) as handle:
+            bed = utils.BedLine(handle.readline().strip())
+        num_pos = bed.cds_len + bed.five_ss_len + bed.three_ss_len
+
+        # mapping to genome and back should give the original positions
+        seq_pos = np.arange(num_pos)
+        genome_pos = bed.seqpos_to_genome(seq_pos)
+        assert len(np.unique(genome_pos)) == num_pos
+        bed.init_genome_coordinates()
+        assert [bed.seqpos2genome[p] for p in seq_pos] == genome_pos.tolist()
+        coding_pos = bed.query_positions([bed.chrom]*bed.cds_len, genome_pos[:bed.cds_len])
+        assert coding_pos.tolist() == list(range(bed.cds_len))
+
+        # array and single position queries should agree, including
+        # splice sites and positions outside of the gene
+        query_coords = np.concatenate([np.arange(e-3, e+3)
+                                       for exon in bed.exons for e in exon])
+        query_coords = np.concatenate([query_coords, [bed.exons[0][0]-100]])
+        pos = bed.query_positions([bed.chrom]*len(query_coords), query_coords)
+        single_pos = [bed.query_position(bed.strand, bed.chrom, c) for c in query_coords]
+        assert [(p if p >= 0 else None) for p in pos.tolist()] == single_pos
+        assert pos[-1] == -1
+
+        # BedLine should survive pickling for multiprocessing
+        bed2 = pickle.loads(pickle.dumps(bed))
+        assert bed2.exons == bed.exons
+        assert np.array_equal(bed2.exon_offsets, bed.exon_offsets)
+
+
+def test_map_mutations():
+    with open(os.path.join(file_dir, 'data/tp53.bed')) as handle:
+        bed = utils.BedLine(handle.readline().strip())
+    cds_coord = bed.seqpos_to_genome([0, 10])
+    mut_info = pd.DataFrame({'Chromosome': [bed.chrom]*3,
+                             'Start_Position': [cds_coord[0], cds_coord[1], bed.exons[0][0]-100],
+                             'Tumor_Allele': ['A', 'C', 'G']})
+    mapped = mc.map_mutations(mut_info, bed)
+
+    # TP53 is on the - strand
+    assert mapped['Tumor_Allele'].tolist() == ['T', 'G', 'C']
+    assert mapped['Coding Position'].tolist()[:2] == [0, 10]
+    assert np.isnan(mapped['Coding Position'].iloc[2])
+    assert mut_info['Tumor_Allele'].tolist() == ['A', 'C', 'G'], 'Input should not change'
@@ -0,0 +1,74 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+
+import prob2020.python.exact as exact
+import prob2020.console.randomization_test as pt
+import itertools as it
+import numpy as np
+
+
+def test_poisson_binomial_sf():
+    # compare to brute force enumeration of all outcomes
+    probs = np.array([.1, .1, .5, .7, .2, .2, .2])
+    for k in range(len(probs)+2):
+        true_pval = 0
+        for outcome in it.product([0, 1], repeat=len(probs)):
+            outcome = np.array(outcome)
+            if outcome.sum() >= k:
+                true_pval += np.prod(np.where(outcome, probs, 1-probs))
+        pval = exact.poisson_binomial_sf(probs, k)
+        assert np.isclose(pval, true_pval), 'Exact p-value mismatch ({0} != {1})'.format(pval, true_pval)
+
+
+def test_saddlepoint_sf():
+    prng = np.random.RandomState(101)
+    probs = prng.beta(.5, 10, size=5000)
+    for k in [260, 300, 350]:
+        pval = exact.poisson_binomial_sf(probs, k)
+        approx_pval = exact.saddlepoint_sf(probs, k)
+        assert np.isclose(pval, approx_pval, rtol=1e-3), 'Saddlepoint approximation is inaccurate'
+
+    # degenerate probabilities
+    probs = np.array([0, 0, 1, 1, .5])
+    assert exact.saddlepoint_sf(probs, 2) == 1.0
+    assert exact.saddlepoint_sf(probs, 4) == 0.0
+
+
+def test_100genes_exact_main():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': os.path.join(file_dir, 'output/100genes_deleterious_exact_output.txt'),
+            'context': 1,
+            'use_unmapped': False,
+            'deleterious': 5,
+            'processes': 0,
+            'num_iterations': 1000,
+            'stop_criteria': 100,
+            'deleterious_pseudo_count': 0,
+            'unique': False,
+            'seed': None,
+            'exact': True,
+            'kind': 'tsg'}
+    result = pt.main(opts)
+    num_del_sig = np.sum(result['inactivating BH q-value'] < .1)
+    assert num_del_sig < 7, 'Few of the 100 test genes should be significant ({0})'.format(num_del_sig)
+
+    # q-values should agree with the simulated test on the same genes
+    opts['exact'] = False
+    opts['num_iterations'] = 10000
+    opts['seed'] = 101
+    opts['output'] = os.path.join(file_dir, 'output/100genes_deleterious_exact_sim_output.txt')
+    sim_result = pt.main(opts)
+    exact_qval = result['inactivating BH q-value']
+    sim_qval = sim_result['inactivating BH q-value'].reindex(exact_qval.index)
+    assert (exact_qval.isnull() == sim_qval.isnull()).all(), 'Exact and simulated tests should test the same genes'
+    is_tested = exact_qval.notnull()
+    max_diff = np.abs(exact_qval[is_tested] - sim_qval[is_tested]).max()
+    assert max_diff < .15, 'Exact q-values differ from simulated q-values ({0})'.format(max_diff)
+    exact_sig = set(exact_qval[exact_qval < .1].index)
+    sim_sig = set(sim_qval[sim_qval < .1].index)
+    assert len(exact_sig ^ sim_sig) <= 1, 'Exact and simulated significant genes differ ({0})'.format(exact_sig ^ sim_sig)
@@ -0,0 +1,122 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+# useful imports
+from prob2020.python.gene_sequence import GeneSequence
+from prob2020.python.gene_effect_table import GeneEffectTable, bases
+import prob2020.python.mutation_context as mc
+import prob2020.python.utils as utils
+import prob2020.cython.cutils as cutils
+import prob2020.python.scores as scores
+import numpy as np
+import pysam
+
+# read in tp53 sequence
+tp53_fasta = os.path.join(file_dir, 'data/tp53.fa')
+tp53_bed = os.path.join(file_dir, 'data/tp53.bed')
+gene_fa = pysam.Fastafile(tp53_fasta)
+with open(tp53_bed) as handle:
+    bed = utils.BedLine(handle.readline().strip())
+
+
+def test_effect_table_matches_aa_mut_info():
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    effect_table = GeneEffectTable(gs)
+
+    # check every position (coding and splice site) for each somatic base
+    pos = np.arange(effect_table.num_pos)
+    for base in bases:
+        somatic_base = [base] * len(pos)
+        true_info = mc.get_aa_mut_info(pos, somatic_base, gs)
+        base_ix = effect_table.base_index(somatic_base)
+        effects = effect_table.effects(pos[np.newaxis, :], base_ix)
+        aa_info = effect_table.mut_info(effects, 0)
+        for key in aa_info:
+            assert true_info[key] == aa_info[key], 'Mismatch for {0} ({1})'.format(key, base)
+
+        # variant classification should match the cython implementation
+        true_var_class = cutils.get_variant_classification(true_info['Reference AA'],
+                                                           true_info['Somatic AA'],
+                                                           true_info['Codon Pos'])
+        true_var_class = [v.decode() for v in true_var_class]
+        var_class = effect_table.variant_classification(effects, 0)
+        assert true_var_class == var_class, 'Variant classification mismatch ({0})'.format(base)
+
+
+def test_deleterious_count():
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    effect_table = GeneEffectTable(gs)
+
+    # each position is a separate "simulation" with a single mutation
+    pos = np.arange(effect_table.num_pos)[:, np.newaxis]
+    for base in bases:
+        base_ix = effect_table.base_index([base])
+        del_count = effect_table.deleterious_count(pos, base_ix)
+        aa_info = mc.get_aa_mut_info(pos[:, 0], [base]*len(pos), gs)
+        for i in range(len(pos)):
+            true_del = cutils.calc_deleterious_info([aa_info['Reference AA'][i]],
+                                                    [aa_info['Somatic AA'][i]],
+                                                    [aa_info['Codon Pos'][i]])
+            assert true_del == del_count[i], 'Deleterious mismatch at {0} ({1})'.format(i, base)
+
+
+def test_calc_pos_info_batch():
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    effect_table = GeneEffectTable(gs)
+
+    # simulations restricted to a small region to obtain recurrent positions
+    prng = np.random.RandomState(101)
+    pos = prng.randint(0, 60, size=(50, 10))
+    base_ix = effect_table.base_index(['A', 'C', 'G', 'T', 'A', 'C', 'G', 'T', 'A', 'C'])
+    effects = effect_table.effects(pos, base_ix)
+    is_missense = effect_table.is_missense[pos, base_ix]
+    for pseudo_count in [0, 2]:
+        batch_info = cutils.calc_pos_info_batch(effects['Codon Pos'], is_missense,
+                                                pseudo_count=pseudo_count, is_obs=0)
+        for i in range(len(pos)):
+            aa_info = effect_table.mut_info(effects, i)
+            true_info = cutils.calc_pos_info(aa_info['Codon Pos'],
+                                             aa_info['Reference AA'],
+                                             aa_info['Somatic AA'],
+                                             pseudo_count=pseudo_count,
+                                             is_obs=0)
+            for k in range(3):
+                assert true_info[k] == batch_info[k][i], 'Position statistic mismatch'
+
+
+def test_compute_vest_stat_batch():
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    effect_table = GeneEffectTable(gs)
+
+    # fake vest scores for every missense mutation in the gene
+    prng = np.random.RandomState(101)
+    pos = np.arange(effect_table.cds_len)
+    vest_dict = {}
+    for base in 'ACGT':
+        aa_info = mc.get_aa_mut_info(pos, [base]*len(pos), gs)
+        for i in range(len(pos)):
+            ref, alt = aa_info['Reference AA'][i], aa_info['Somatic AA'][i]
+            if ref != alt and ref != '*' and alt != '*':
+                vest_dict.setdefault(aa_info['Codon Pos'][i]+1, {}).setdefault(ref, {})[alt] = prng.rand()
+    gene_vest = scores.vest_array(vest_dict, bed.cds_len // 3 + 1)
+
+    # compare against the dictionary look up for random simulations
+    pos = prng.randint(0, effect_table.num_pos, size=(50, 10))
+    base_ix = effect_table.base_index(['A', 'C', 'G', 'T', 'A', 'C', 'G', 'T', 'A', 'C'])
+    effects = effect_table.effects(pos, base_ix)
+    vest_score = scores.compute_vest_stat_batch(gene_vest, effects['Reference AA'],
+                                                effects['Somatic AA'], effects['Codon Pos'])
+    for i in range(len(pos)):
+        aa_info = effect_table.mut_info(effects, i)
+        true_score = scores.compute_vest_stat(vest_dict,
+                                              aa_info['Reference AA'],
+                                              aa_info['Somatic AA'],
+                                              aa_info['Codon Pos'])
+        assert np.isclose(true_score, vest_score[i], atol=1e-6), 'VEST score mismatch'
@@ -5,8 +5,31 @@ file_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(file_dir, '..'))
 
 import prob2020.console.randomization_test as rt
+import prob2020.python.utils as utils
 import numpy as np
 
+
+def test_calc_windowed_sum_batch():
+    codon_pos = np.array([[0, 2, 2, 9, 5],
+                          [4, 4, 4, 4, 0]])
+    is_missense = np.array([[1, 1, 1, 1, 0],
+                            [1, 1, 0, 1, 1]], dtype=bool)
+    pos_ct, window_sum = utils.calc_windowed_sum_batch(codon_pos, is_missense, [1, 3], 10)
+    assert pos_ct.tolist() == [[1, 0, 2, 0, 0, 0, 0, 0, 0, 1],
+                               [1, 0, 0, 0, 3, 0, 0, 0, 0, 0]]
+    assert window_sum[1][0, [0, 2, 9]].tolist() == [1, 2, 1]
+    assert window_sum[3][0, [0, 2, 9]].tolist() == [3, 3, 1]
+    assert window_sum[3][1, [0, 4]].tolist() == [1, 3]
+
+    # dictionary interface gives the same result
+    pos_ctr, pos_sum = utils.calc_windowed_sum([0, 2, 2, 9, None],
+                                               ['A', 'C', 'C', 'D', 'E'],
+                                               ['C', 'D', 'D', '*', 'F'],
+                                               [1, 3])
+    assert pos_ctr == {0: 1, 2: 2}
+    assert pos_sum == {1: {0: 1, 2: 2}, 3: {0: 3, 2: 3}}
+
+
 def test_ctnnb1_hotmaps_main():
     opts = {'input': os.path.join(file_dir, 'data/CTNNB1.fa'),
             'bed': os.path.join(file_dir, 'data/CTNNB1.bed'),
@@ -23,16 +46,17 @@ def test_ctnnb1_hotmaps_main():
             'report_index': True,
             'null_distr_dir': os.path.join(file_dir, 'output/hotmaps1d_null'),
             'kind': 'hotmaps1d'}
-    # single nucleotide context
-    result = rt.main(opts)
+    for window in ['3', '6', '9']:
+        opts['window'] = window
+        result = rt.main(opts)
+        assert (result['window length'] == int(window)).all()
 
-    # di-nucleotide case
-    opts['window'] = '6'
-    result = rt.main(opts)
-
-    # no context case
-    opts['window'] = '9'
-    result = rt.main(opts)
+        # codons of the CTNNB1 hotspot should have significant windows
+        hotspot = result[result['codon position'].isin([32, 33, 34, 37])]
+        assert len(hotspot) == 4
+        assert (hotspot['p-value'] < .01).all(), 'CTNNB1 hotspot should be significant ({0})'.format(hotspot['p-value'].max())
+        null_path = os.path.join(opts['null_distr_dir'], 'CTNNB1.{0}.txt'.format(window))
+        assert os.path.exists(null_path)
 
 
 def test_100genes_main():
@@ -57,5 +81,41 @@ def test_100genes_main():
     assert num_sig < 9, 'Few of the 100 test genes should not be significant ({0})'.format(num_sig)
 
 
+
+def test_100genes_screen():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'use_unmapped': False,
+            'processes': 0,
+            'num_iterations': 2000,
+            'stop_criteria': 1000,
+            'unique': False,
+            'seed': 42,
+            'window': '3',
+            'report_index': False,
+            'null_distr_dir': None,
+            'kind': 'hotmaps1d',
+            'screen': True,
+            'screen_iterations': 200,
+            'screen_fdr': .1}
+    result = rt.main(opts)
+
+    # p-values of windowed sums are estimated from many windows per
+    # simulation, so the confidence intervals are narrower than the number
+    # of iterations alone allows
+    is_screened = result['num iterations'] <= 200
+    assert is_screened.any() and not is_screened.all()
+    screened = result[is_screened & (result['p-value'] > 0)]
+    assert (screened['p-value CI low'] <= screened['p-value']).all()
+    assert (screened['p-value'] <= screened['p-value CI high']).all()
+    assert ((screened['p-value'] * 200) % 1 != 0).any()
+
+    # genes with significant windows are rerun
+    assert (result.loc[result['q-value'] < .01, 'num iterations'] > 200).all()
+
+
 if __name__ == '__main__':
     test_100genes_main()
@@ -0,0 +1,55 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+from prob2020.python.mutation_store import MutationStore
+import pandas as pd
+import pickle
+
+
+def test_mutation_store():
+    mut_df = pd.read_csv(os.path.join(file_dir, 'data/sim_summary_mutations.txt'), sep='\t')
+    mut_store = MutationStore(mut_df)
+    assert len(mut_store) == len(mut_df)
+    assert set(mut_store.genes) == set(mut_df['Gene'].unique())
+    assert mut_store.df['Tumor_Allele'].dtype.name == 'category'
+
+    # gene mutations should match a boolean scan of the mutations
+    for gene in mut_df['Gene'].unique():
+        expected = mut_df[mut_df['Gene']==gene]
+        gene_df = mut_store.gene_mutations(gene, ['Start_Position', 'Tumor_Allele'])
+        assert gene_df.index.tolist() == expected.index.tolist()
+        assert gene_df['Start_Position'].tolist() == expected['Start_Position'].tolist()
+        assert gene_df['Tumor_Allele'].tolist() == expected['Tumor_Allele'].tolist()
+    assert len(mut_store.gene_mutations('NOT_A_GENE')) == 0
+
+    # subsets only contain the requested genes
+    genes = mut_store.genes[:2]
+    sub_store = mut_store.subset(genes + ['NOT_A_GENE'])
+    assert sorted(sub_store.genes) == sorted(genes)
+    assert len(sub_store) == sum(len(mut_store.gene_mutations(g)) for g in genes)
+
+
+def test_shared_mutation_store():
+    mut_df = pd.read_csv(os.path.join(file_dir, 'data/sim_summary_mutations.txt'), sep='\t')
+    mut_store = MutationStore(mut_df)
+    shared_store = mut_store.share()
+    try:
+        # pickled handles only contain the gene ranges of their subset
+        genes = mut_store.genes[:3]
+        sub_store = pickle.loads(pickle.dumps(shared_store.subset(genes)))
+        assert sorted(sub_store.genes) == sorted(genes)
+        assert sub_store.columns == mut_store.columns
+        for gene in genes:
+            expected = mut_store.gene_mutations(gene)
+            gene_df = sub_store.gene_mutations(gene)
+            assert gene_df.index.tolist() == expected.index.tolist()
+            for col in mut_store.columns:
+                assert gene_df[col].dtype == expected[col].dtype
+                assert gene_df[col].tolist() == expected[col].tolist()
+        assert len(sub_store.column('Tumor_Sample')) == len(sub_store)
+    finally:
+        shared_store.close()
+    assert not os.path.exists(shared_store.path)
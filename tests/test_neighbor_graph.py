@@ -0,0 +1,137 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+import prob2020.console.randomization_test as rt
+import prob2020.python.scores as scores
+import prob2020.python.utils as utils
+import prob2020.python.mymath as mymath
+import prob2020.python.permutation as pm
+from prob2020.python.gene_sequence import GeneSequence
+from prob2020.python.sequence_context import SequenceContext
+from prob2020.python.gene_effect_table import GeneEffectTable
+from collections import Counter
+import pandas as pd
+import numpy as np
+import pysam
+import pickle
+
+
+def test_compute_ng_stat():
+    # simple chain graph 0 - 1 - 2 - 3
+    gene_graph = {0: set([1]), 1: set([0, 2]), 2: set([1, 3]), 3: set([2])}
+    pos_ct = {1: 2, 3: 1}
+
+    # smoothed counts are 0.5*neighbor counts + 0.5*self counts
+    codon_vals = np.array([1.0, 1.0, 1.5, 0.5])
+    expected_score = mymath.shannon_entropy(codon_vals / codon_vals.sum())
+    graph_score, coverage = scores.compute_ng_stat(gene_graph, pos_ct)
+    assert np.isclose(graph_score, expected_score)
+    assert coverage == 4
+
+    # batch version should agree with the single simulation version
+    graph_matrix = scores.neighbor_graph_matrix(gene_graph)
+    codon_pos = np.array([[1, 3, 1, 0], [2, 2, 2, 0], [0, 1, 2, 3]])
+    is_missense = np.array([[1, 1, 1, 0], [1, 1, 1, 0], [0, 0, 0, 0]], dtype=bool)
+    graph_score, coverage, num_mut_codons = scores.compute_ng_stat_batch(graph_matrix,
+                                                                        codon_pos,
+                                                                        is_missense)
+    assert np.isclose(graph_score[0], expected_score)
+    assert np.isclose(graph_score[1], scores.compute_ng_stat(gene_graph, {2: 3})[0])
+    assert graph_score[2] == 1.0, 'No missense mutations should have a score of one'
+    assert coverage.tolist() == [4, 3, 0]
+    assert num_mut_codons.tolist() == [2, 1, 0]
+
+
+def test_protein_permutation_counts():
+    with open(os.path.join(file_dir, 'data/CTNNB1.bed')) as handle:
+        bed = utils.BedLine(handle.readline().strip())
+    gs = GeneSequence(pysam.Fastafile(os.path.join(file_dir, 'data/CTNNB1.fa')), nuc_context=1)
+    gs.set_gene(bed)
+    num_codons = bed.cds_len // 3 + 1
+    gene_graph = {i: set([j for j in [i-1, i+1] if 0 <= j < num_codons])
+                  for i in range(num_codons)}
+    graph_matrix = scores.neighbor_graph_matrix(gene_graph)
+    context_counts = pd.Series([6, 6], index=['C', 'G'])
+    context_to_mut = {'C': ['T']*6, 'G': ['A']*6}
+    num_permutations, stop_criteria = 500, 20
+
+    # the same simulations as protein_permutation, scored one at a time
+    effect_table = GeneEffectTable(gs)
+    base_ix = effect_table.base_index(['T']*6 + ['A']*6)
+    sc = SequenceContext(gs, seed=42)
+    mut_pos = sc.random_pos_matrix(context_counts.iteritems(), num_permutations)
+    codon_pos = effect_table.codon_pos[mut_pos]
+    is_missense = effect_table.is_missense[mut_pos, base_ix]
+    sim_pos_ct = [Counter(codon_pos[i][is_missense[i]]) for i in range(num_permutations)]
+    sim_ng_stat = [scores.compute_ng_stat(graph_matrix, pos_ct) for pos_ct in sim_pos_ct]
+
+    # the first stop_criteria-1 simulations give the expected relative
+    # increase in coverage
+    rel_inc = [cov / float(len(pos_ct))
+               for (_, cov), pos_ct in zip(sim_ng_stat[:stop_criteria-1], sim_pos_ct)
+               if cov]
+    exp_rel_inc = np.mean(rel_inc)
+
+    # clustered and spread out observed mutations
+    for obs_codons in [[32, 32, 33, 33, 34, 34, 35, 37], list(range(50, 700, 50))]:
+        obs_pos_ct = Counter(obs_codons)
+        graph_score, _ = scores.compute_ng_stat(graph_matrix, obs_pos_ct)
+        obs_stat = graph_score / np.log2(exp_rel_inc*len(obs_pos_ct))
+
+        # every simulation is counted, each normalized by its own number
+        # of mutated codons
+        null_ct, num_sim = 0, 0
+        for (ent, _), pos_ct in zip(sim_ng_stat, sim_pos_ct):
+            sim_stat = ent / np.log2(exp_rel_inc*len(pos_ct)) if pos_ct else 1.0
+            null_ct += sim_stat - utils.epsilon <= obs_stat
+            num_sim += 1
+            if null_ct >= stop_criteria:
+                break
+
+        pval, perm_obs_stat = pm.protein_permutation(graph_score, len(obs_pos_ct),
+                                                     context_counts, context_to_mut,
+                                                     SequenceContext(gs, seed=42), gs,
+                                                     graph_matrix,
+                                                     num_permutations=num_permutations,
+                                                     stop_criteria=stop_criteria)
+        assert np.isclose(perm_obs_stat, obs_stat)
+        assert np.isclose(pval, null_ct / float(num_sim)), '{0} != {1}'.format(pval, null_ct / float(num_sim))
+
+
+def test_ctnnb1_protein_main():
+    # chain graph connecting neighboring codons of CTNNB1
+    with open(os.path.join(file_dir, 'data/CTNNB1.bed')) as handle:
+        bed = utils.BedLine(handle.readline().strip())
+    num_codons = bed.cds_len // 3
+    gene_graph = {i: set([j for j in [i-1, i+1] if 0 <= j < num_codons])
+                  for i in range(num_codons)}
+    graph_dir = os.path.join(file_dir, 'output/neighbor_graph')
+    if not os.path.exists(graph_dir):
+        os.makedirs(graph_dir)
+    with open(os.path.join(graph_dir, 'CTNNB1.pickle'), 'wb') as handle:
+        pickle.dump(gene_graph, handle)
+
+    opts = {'input': os.path.join(file_dir, 'data/CTNNB1.fa'),
+            'bed': os.path.join(file_dir, 'data/CTNNB1.bed'),
+            'mutations': os.path.join(file_dir, 'data/CTNNB1_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'use_unmapped': False,
+            'recurrent': 3,
+            'fraction': .02,
+            'neighbor_graph_dir': graph_dir,
+            'processes': 0,
+            'num_iterations': 1000,
+            'stop_criteria': 100,
+            'unique': 0,
+            'seed': 42,
+            'kind': 'protein'}
+    result = rt.main(opts)
+
+    # mutations of CTNNB1 cluster in its hotspot codons
+    pval = result['normalized graph-smoothed position entropy p-value'].iloc[0]
+    assert pval < 0.01, 'CTNNB1 should have a low p-value ({0})'.format(pval)
+    assert result['normalized graph-smoothed position entropy'].iloc[0] != 0
@@ -0,0 +1,125 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+import prob2020.python.utils as utils
+import prob2020.python.parallel as parallel
+import prob2020.console.randomization_test as rt
+from prob2020.python.mutation_store import MutationStore
+import pandas as pd
+
+
+def test_gene_batches():
+    mut_df = pd.read_csv(os.path.join(file_dir, 'data/100genes_mutations.txt'), sep='\t')
+    mut_df = mut_df.rename(columns={'Hugo_Symbol': 'Gene'})
+    mut_store = MutationStore(mut_df)
+    bed_list = list(utils.bed_generator(os.path.join(file_dir, 'data/100genes.bed')))
+
+    batches = parallel.gene_batches(bed_list, mut_store, 8)
+    batch_genes = [b.gene_name for batch in batches for b in batch]
+
+    # every gene with mutations is processed exactly once
+    expected = [b.gene_name for b in bed_list if b.gene_name in mut_store]
+    assert sorted(batch_genes) == sorted(expected)
+
+    # the most expensive genes are scheduled first
+    costs = [parallel.gene_cost(b, mut_store) for batch in batches for b in batch]
+    assert costs == sorted(costs, reverse=True)
+    assert len(batches) >= 8
+
+    assert parallel.gene_batches(bed_list, mut_store.subset([]), 8) == []
+
+
+def test_gene_chunks():
+    mut_df = pd.read_csv(os.path.join(file_dir, 'data/100genes_mutations.txt'), sep='\t')
+    mut_df = mut_df.rename(columns={'Hugo_Symbol': 'Gene'})
+    mut_store = MutationStore(mut_df)
+    bed_list = list(utils.bed_generator(os.path.join(file_dir, 'data/100genes.bed')))
+
+    # genes with many mutations are replaced by the first chunk of their iterations
+    num_iter = 200001
+    batches = parallel.gene_batches(bed_list, mut_store, 32, num_iterations=num_iter)
+    chunks = [b for batch in batches for b in batch
+              if isinstance(b, parallel.GeneChunk)]
+    assert chunks
+    assert len(set(c.gene_name for c in chunks)) == len(chunks)
+    for c in chunks:
+        start, end = mut_store.gene2range[c.gene_name]
+        assert c.index == 0 and c.null_counts is None
+        assert c.num_chunks == parallel.num_gene_chunks(end - start, num_iter) > 1
+        assert sum(c.chunk_iterations) == num_iter
+
+    # chunks do not depend on the number of batches (i.e. processes)
+    split_list = parallel.split_genes(bed_list, mut_store, num_iter)
+    for num_batches in [1, 4]:
+        other_chunks = [b for batch in parallel.gene_batches(bed_list, mut_store, num_batches,
+                                                             num_iterations=num_iter)
+                        for b in batch if isinstance(b, parallel.GeneChunk)]
+        assert (sorted((c.gene_name, c.chunk_iterations) for c in other_chunks) ==
+                sorted((c.gene_name, c.chunk_iterations) for c in chunks))
+    assert len([b for b in split_list if isinstance(b, parallel.GeneChunk)]) == len(chunks)
+    assert not any(isinstance(b, parallel.GeneChunk)
+                   for b in parallel.split_genes(bed_list, mut_store, 1000))
+
+    # the next chunk is only run if the simulations did not stop
+    chunk = max(chunks, key=lambda c: c.num_chunks)
+    assert chunk.num_chunks > 2
+    null_counts = {'num_sim': chunk.num_iterations, 'deleterious': 3}
+    next_chunk = parallel.ChunkResult(chunk, [], null_counts).next_chunk()
+    assert next_chunk.index == 1 and next_chunk.null_counts is null_counts
+    stopped_counts = {'num_sim': chunk.num_iterations - 1, 'deleterious': 100}
+    assert parallel.ChunkResult(chunk, [], stopped_counts).next_chunk() is None
+    assert parallel.ChunkResult(chunk, [], None).next_chunk() is None
+    next_counts = {'num_sim': sum(chunk.chunk_iterations[:2]), 'deleterious': 5}
+    assert parallel.ChunkResult(next_chunk, [], next_counts).next_chunk().index == 2
+    last_chunk = parallel.GeneChunk(chunk.bed, chunk.num_chunks-1, chunk.chunk_iterations,
+                                    null_counts)
+    assert parallel.ChunkResult(last_chunk, [], next_counts).next_chunk() is None
+
+    # chunk results are returned once the simulations of a gene finished
+    batch_result = ([['row']] + [parallel.ChunkResult(c, [], None) for c in chunks] +
+                    [parallel.ChunkResult(chunk, [], null_counts)])
+    results, complete = parallel.collect_chunks(batch_result)
+    assert results == [['row']]
+    assert sorted(r.gene_name for r in complete) == sorted(c.gene_name for c in chunks)
+    assert [c.index for c in parallel.next_chunks(batch_result)] == [1]
+
+
+def test_chunk_continuation():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'use_unmapped': False,
+            'deleterious': 1,
+            'processes': 0,
+            'num_iterations': 2000,
+            'stop_criteria': 20,
+            'deleterious_pseudo_count': 0,
+            'unique': False,
+            'seed': 42,
+            'kind': 'tsg'}
+    chunk_mutations = parallel.CHUNK_MUTATIONS
+    try:
+        # split genes with more than 5 mutations into chunks
+        parallel.CHUNK_MUTATIONS = 5 * opts['num_iterations']
+        result = rt.main(opts)
+
+        # seeded results do not depend on the number of processes
+        opts['processes'] = 2
+        pool_result = rt.main(opts)
+        assert pool_result.equals(result)
+    finally:
+        parallel.CHUNK_MUTATIONS = chunk_mutations
+    result = result[result['inactivating p-value'].notnull()]
+    num_iter = result['num iterations']
+    assert (num_iter <= opts['num_iterations']).all()
+
+    # chunks stop at the simulation reaching the stopping criteria
+    is_stopped = (num_iter < opts['num_iterations']) & (result['Total SNV Mutations'] > 5)
+    assert is_stopped.any()
+    null_del_ct = (result['inactivating p-value'] * num_iter).round()
+    assert (null_del_ct[is_stopped] == opts['stop_criteria']).all()
@@ -8,6 +8,8 @@ sys.path.append(os.path.join(file_dir, '..'))
 import prob2020.console.randomization_test as pt
 import prob2020.python.utils as utils
 import prob2020.python.mutation_context as mc
+import prob2020.python.permutation as pm
+import prob2020.python.p_value as mypval
 import numpy as np
 
 
@@ -111,5 +113,114 @@ def test_100genes_main():
     assert num_ent_sig < 9, 'Few of the 100 test genes should not be significant ({0})'.format(num_ent_sig)
 
 
+def test_max_memory():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'tsg_score': .1,
+            'recurrent': 3,
+            'fraction': .02,
+            'use_unmapped': False,
+            'processes': 0,
+            'num_iterations': 300,
+            'stop_criteria': 100,
+            'score_dir': None,
+            'recurrent_pseudo_count': 0,
+            'unique': False,
+            'seed': 42,
+            'kind': 'oncogene'}
+    result = pt.main(opts)
+
+    # small batches of simulations should give identical results
+    opts['max_memory'] = 0.01
+    assert pm.memory_batch_size(100, 0.01 * 2**20) < 300
+    small_batch_result = pt.main(opts)
+    assert result.equals(small_batch_result)
+
+
 if __name__ == '__main__':
     test_100genes_main()
+
+
+def test_ramp_batches():
+    batch_sizes = pm.ramp_batches(30000, 25000)
+    assert batch_sizes == [200, 800, 3200, 12800, 13000]
+    assert pm.ramp_batches(150, 25000) == [150]
+    assert pm.ramp_batches(1000, 100) == [100]*10
+    assert pm.ramp_batches(0, 100) == []
+
+
+def test_stop_alpha():
+    # a p-value of 0.3 is quickly found to be above 0.05
+    null_cts = np.cumsum(np.arange(1000) % 10 < 3)
+    is_done = pm.sequential_stop(null_cts, np.arange(1, 1001), 100, 0.05)
+    assert 20 < np.argmax(is_done) < 100
+    assert not pm.sequential_stop(null_cts, np.arange(1, 1001), 1000).any()
+
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'tsg_score': .1,
+            'recurrent': 3,
+            'fraction': .02,
+            'use_unmapped': False,
+            'processes': 0,
+            'num_iterations': 2000,
+            'stop_criteria': 100,
+            'score_dir': None,
+            'recurrent_pseudo_count': 0,
+            'unique': False,
+            'seed': 42,
+            'kind': 'oncogene'}
+    result = pt.main(opts)
+    opts['stop_alpha'] = 0.05
+    stop_result = pt.main(opts).loc[result.index]
+
+    # non-significant genes stop early, significant genes are unaffected
+    assert stop_result['num iterations'].sum() < result['num iterations'].sum()
+    assert (stop_result['num iterations'] <= result['num iterations']).all()
+    is_sig = result['entropy p-value'] < 0.01
+    assert is_sig.any()
+    assert result.loc[is_sig, 'entropy p-value'].equals(stop_result.loc[is_sig, 'entropy p-value'])
+
+
+def test_screen():
+    # only p-values whose lower bound could be significant are candidates
+    pval_lower = np.array([0.0, 0.005, 0.4, 0.85, np.nan])
+    is_candidate = mypval.screen_candidates(pval_lower, .1)
+    assert is_candidate.tolist() == [True, True, False, False, False]
+
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'tsg_score': .1,
+            'recurrent': 3,
+            'fraction': .02,
+            'use_unmapped': False,
+            'processes': 0,
+            'num_iterations': 2000,
+            'stop_criteria': 1000,
+            'score_dir': None,
+            'recurrent_pseudo_count': 0,
+            'unique': False,
+            'seed': 42,
+            'kind': 'oncogene',
+            'screen': True,
+            'screen_iterations': 200,
+            'screen_fdr': .1}
+    result = pt.main(opts)
+    opts['screen'] = False
+    full_result = pt.main(opts).loc[result.index]
+
+    # candidate genes get the same results as a full run
+    is_full = result['num iterations'] > 200
+    assert is_full.any() and not is_full.all()
+    assert result.loc[is_full, 'entropy p-value'].equals(full_result.loc[is_full, 'entropy p-value'])
+    assert (result['num iterations'] <= 200).sum() > len(result) / 2
+    assert (result['entropy p-value CI low'] <= result['entropy p-value']).all()
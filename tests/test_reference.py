@@ -0,0 +1,56 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+import prob2020.python.reference as reference
+import prob2020.python.utils as utils
+from prob2020.python.gene_sequence import GeneSequence
+from prob2020.python.sequence_context import SequenceContext
+import numpy as np
+import pysam
+import tempfile
+import shutil
+
+
+def test_compile_reference():
+    fasta_path = os.path.join(file_dir, 'data/100genes.fa')
+    bed_path = os.path.join(file_dir, 'data/100genes.bed')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ref_path = os.path.join(tmp_dir, '100genes.p2020ref')
+        reference.compile_reference(bed_path, fasta_path, ref_path, [1.5])
+        assert reference.is_compiled_reference(ref_path)
+        assert not reference.is_compiled_reference(fasta_path)
+        assert reference.bed_path(ref_path) == ref_path
+
+        # BED lines should be identical
+        compiled_ref = reference.open_gene_fasta(ref_path)
+        orig_beds = list(utils.bed_generator(bed_path))
+        compiled_beds = list(utils.bed_generator(ref_path))
+        assert [b.bed_tuple for b in orig_beds] == [b.bed_tuple for b in compiled_beds]
+
+        gs = GeneSequence(pysam.Fastafile(fasta_path), nuc_context=1.5)
+        compiled_gs = GeneSequence(compiled_ref, nuc_context=1.5)
+        context_index = reference.get_context_index(compiled_ref, 1.5)
+        assert reference.get_context_index(compiled_ref, 2) is None
+        for bed in orig_beds[:10]:
+            gs.set_gene(bed)
+            compiled_gs.set_gene(bed)
+
+            # sequences should match the gene FASTA
+            assert gs.exon_seq == compiled_gs.exon_seq
+            assert gs.five_prime_seq == compiled_gs.five_prime_seq
+            assert gs.three_prime_seq == compiled_gs.three_prime_seq
+            assert compiled_ref.fetch(bed.gene_name + ';exon0') == gs.fasta.fetch(bed.gene_name + ';exon0')
+
+            # pre-computed sequence contexts should match
+            sc = SequenceContext(gs)
+            compiled_sc = SequenceContext(compiled_gs, context_index=context_index)
+            assert sc.context_names == compiled_sc.context_names
+            assert np.array_equal(sc.context_pos, compiled_sc.context_pos)
+            assert np.array_equal(sc.context_offsets, compiled_sc.context_offsets)
+            assert sc.pos2context == compiled_sc.pos2context
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -7,9 +7,12 @@ sys.path.append(os.path.join(file_dir, '..'))
 
 # useful imports
 from prob2020.python.gene_sequence import GeneSequence
-from prob2020.python.sequence_context import SequenceContext
+from prob2020.python.sequence_context import SequenceContext, ContextIndex
 import prob2020.python.utils as utils
+import numpy as np
 import pysam
+import shutil
+import tempfile
 
 # set up global variables
 fake_fasta = os.path.join(file_dir, 'data/fake_sequence.fa')
@@ -41,6 +44,21 @@ def test_dinuc_context_constructor():
     gs = GeneSequence(gene_fa, nuc_context=2)
     gs.set_gene(bed)
     sc = SequenceContext(gs)
+    true_counts = {'AA': 4, 'AC': 1, 'AG': 1, 'AT': 4, 'CA': 1, 'CC': 1,
+                   'CG': 1, 'GA': 4, 'TA': 1, 'TC': 1, 'TG': 2}
+    true_ctxt2pos = {'AA': [6, 19, 20, 0],
+                     'AC': [1],
+                     'AG': [12],
+                     'AT': [3, 7, 10, 14],
+                     'CA': [2],
+                     'CC': [16],
+                     'CG': [17],
+                     'GA': [5, 9, 13, 18],
+                     'TA': [11],
+                     'TC': [15],
+                     'TG': [4, 8]}
+    _check_true_counts(sc, true_counts)
+    _check_true_context_pos(sc, true_ctxt2pos)
 
 
 def test_chasm_context_constructor():
@@ -77,6 +95,46 @@ def test_no_context_constructor():
     _check_true_context_pos(sc, true_ctxt2pos)
 
 
+def test_random_pos_matrix():
+    gs = GeneSequence(gene_fa, nuc_context=1.5)
+    gs.set_gene(bed)
+    sc = SequenceContext(gs, seed=101)
+    context_counts = [('A', 3), ('C*pG', 1), ('T', 2)]
+    random_pos = sc.random_pos_matrix(context_counts, 2000)
+    assert random_pos.shape == (2000, 6)
+
+    # every column should be sampled from the positions of its context
+    col = 0
+    for ctxt, n in context_counts:
+        for k in range(n):
+            sampled_pos = np.unique(random_pos[:, col])
+            assert sampled_pos.tolist() == sorted(sc.context2pos[ctxt]), 'Wrong positions for {0}'.format(ctxt)
+            col += 1
+
+    # preallocated buffer should be filled in place
+    out = np.zeros((10, 6), dtype=np.int32)
+    result = sc.random_pos_matrix(context_counts, 10, out=out)
+    assert result is out
+
+
+def test_context_index():
+    index_dir = tempfile.mkdtemp()
+    try:
+        context_index = ContextIndex(index_dir)
+        for nuc_context in [0, 1, 1.5, 2, 3]:
+            gs = GeneSequence(gene_fa, nuc_context=nuc_context)
+            gs.set_gene(bed)
+            sc = SequenceContext(gs, context_index=context_index)
+            assert context_index.load(gs) is not None, 'Context index was not saved'
+
+            # contexts loaded from the index should match computed contexts
+            sc_index = SequenceContext(gs, context_index=context_index)
+            assert sc.context2pos == sc_index.context2pos
+            assert sc.pos2context == sc_index.pos2context
+    finally:
+        shutil.rmtree(index_dir)
+
+
 def _check_true_counts(seq_context, true_counts):
     for letter in true_counts:
         true_ct = true_counts[letter]
@@ -5,6 +5,16 @@ file_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(file_dir, '../'))
 
 import prob2020.console.annotate as sm
+import prob2020.python.permutation as pm
+import prob2020.python.gene_effect_table as ge
+import prob2020.python.utils as utils
+import prob2020.python.scores as scores
+from prob2020.python.gene_sequence import GeneSequence
+from prob2020.python.sequence_context import SequenceContext
+from prob2020.python.gene_effect_table import GeneEffectTable
+import numpy as np
+import pandas as pd
+import pysam
 
 def test_sim_summary():
     opts = {'input': os.path.join(file_dir, 'data/sim_summary.fa'),
@@ -36,5 +46,54 @@ def test_sim_summary():
     sm.main(opts)
 
 
+
+def test_sample_class_counts():
+    gene_fa = pysam.Fastafile(os.path.join(file_dir, 'data/tp53.fa'))
+    with open(os.path.join(file_dir, 'data/tp53.bed')) as handle:
+        bed = utils.BedLine(handle.readline().strip())
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    sc = SequenceContext(gs, seed=101)
+    effect_table = GeneEffectTable(gs)
+
+    context_cts = pd.Series({'C': 4, 'G': 3})
+    context_to_mut = {'C': ['T', 'T', 'A', 'G'], 'G': ['A', 'A', 'T']}
+    class_cts, mis_pos, mis_mask = pm.sample_class_counts(effect_table, context_cts,
+                                                          context_to_mut, sc, 500,
+                                                          position_classes=(ge.MISSENSE,))
+    # every mutation is assigned a class
+    assert np.all(class_cts.sum(axis=1) == 7)
+
+    # simulated positions match the simulated missense counts
+    assert np.all(mis_mask.sum(axis=1) == class_cts[:, ge.MISSENSE])
+    assert np.all(np.in1d(effect_table.codon_pos[mis_pos[mis_mask]], np.arange(len(gs.exon_seq)//3)))
+
+    # non-silent counts follow the same order as calc_non_silent_info
+    non_silent_cts = pm.non_silent_counts(class_cts)
+    assert np.all(non_silent_cts[:, 0] == non_silent_cts[:, 2:].sum(axis=1))
+    assert np.all(non_silent_cts[:, 6] == class_cts[:, ge.MISSENSE])
+
+
 if __name__ == '__main__':
     test_sim_summary()
+
+
+def test_score_cache():
+    score_dir = os.path.join(file_dir, 'data/scores')
+    vest_paths = [os.path.join(score_dir, g+'.vest.pickle') for g in ['A1BG', 'A1CF', 'A2M']]
+
+    # cached object should be returned on repeated loads
+    score_cache = scores.ScoreCache()
+    first_load = score_cache.load(vest_paths[0])
+    assert score_cache.load(vest_paths[0]) is first_load
+    assert score_cache.load(os.path.join(score_dir, 'missing.vest.pickle')) is None
+
+    # least recently used objects are evicted once the byte limit is reached
+    obj_size = [scores._object_size(scores.ScoreCache().load(p)) for p in vest_paths]
+    max_bytes = max(obj_size[0]+obj_size[1], obj_size[1]+obj_size[2])
+    score_cache = scores.ScoreCache(max_bytes=max_bytes)
+    for p in vest_paths:
+        score_cache.load(p)
+    assert len(score_cache) == 2
+    assert score_cache.num_bytes <= max_bytes
+    assert vest_paths[0] not in score_cache._cache
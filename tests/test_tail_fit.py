@@ -0,0 +1,76 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '..'))
+
+import prob2020.python.tail_fit as tail_fit
+import prob2020.console.randomization_test as rt
+import numpy as np
+
+
+def test_p_value_ci():
+    prng = np.random.RandomState(101)
+    null_values = prng.exponential(size=10000)
+    tail = tail_fit.top_values(null_values)
+    assert len(tail) == tail_fit.TAIL_SIZE
+    assert tail.min() == np.sort(null_values)[-tail_fit.TAIL_SIZE]
+
+    # extrapolated p-values are close to the exponential distribution's
+    for obs in [10, 12]:
+        pval, ci_low, ci_high = tail_fit.p_value_ci(obs, 0, len(null_values), tail)
+        assert ci_low < pval < ci_high
+        assert ci_low < np.exp(-obs) < ci_high
+        assert np.exp(-obs) / 5 < pval < np.exp(-obs) * 5
+
+    # p-values with enough extreme null values stay empirical
+    num_null = np.sum(null_values >= 3)
+    pval, ci_low, ci_high = tail_fit.p_value_ci(3, num_null, len(null_values), tail)
+    assert pval == num_null / 10000.
+    assert ci_low < pval < ci_high
+    assert tail_fit.p_value_ci(12, 0, len(null_values))[:2] == (0, 0)
+
+    # histograms give the same tail as the values
+    null_hist = np.bincount(prng.poisson(3, size=5000))
+    tail = tail_fit.tail_from_hist(null_hist)
+    values = np.repeat(np.arange(len(null_hist)), null_hist)
+    assert np.sort(tail).tolist() == np.sort(tail_fit.top_values(values)).tolist()
+
+
+def test_tail_fit_main():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': '',
+            'context': 1,
+            'tsg_score': .1,
+            'recurrent': 3,
+            'fraction': .02,
+            'use_unmapped': False,
+            'processes': 0,
+            'num_iterations': 1000,
+            'stop_criteria': 100,
+            'score_dir': None,
+            'recurrent_pseudo_count': 0,
+            'unique': False,
+            'seed': 42,
+            'window': '3',
+            'report_index': False,
+            'null_distr_dir': None,
+            'kind': 'hotmaps1d'}
+    result = rt.main(opts)
+    opts['tail_fit'] = True
+    tail_result = rt.main(opts).loc[result.index]
+
+    # the smallest p-values are extrapolated below the simulation's resolution
+    assert (tail_result['p-value'] <= tail_result['p-value CI high']).all()
+    assert (tail_result['p-value'] >= tail_result['p-value CI low']).all()
+    is_zero = result['p-value'] == 0
+    assert is_zero.any()
+    assert (tail_result.loc[is_zero, 'p-value'] > 0).all()
+    assert (tail_result.loc[is_zero, 'p-value'] < 1. / opts['num_iterations']).all()
+
+    # other p-values are unchanged
+    is_empirical = result['p-value'] > .1
+    assert is_empirical.any()
+    assert tail_result.loc[is_empirical, 'p-value'].equals(result.loc[is_empirical, 'p-value'])